@@ -0,0 +1,85 @@
+"""
+Банки (темы) вопросов.
+
+У каждого вопроса в таблице questions есть bank; пользователь выбирает банк командой /bank
+(по умолчанию DEFAULT_BANK). Банк загружается в память при первом обращении к нему,
+поисковый индекс для /find строится при первом поиске, а банки, к которым никто
+не обращался дольше BANK_IDLE_SECONDS, выгружаются (evict_idle). Так память и стоимость
+выбора вопроса зависят только от банков, которыми реально пользуются.
+Банк по умолчанию не выгружается.
+"""
+import asyncio
+import logging
+import time
+
+import config
+from search import SearchIndex
+from storage import load_questions, get_bank_sizes
+
+log = logging.getLogger("banks")
+
+
+class Bank:
+    def __init__(self, name, questions):
+        self.name = name
+        self.questions = questions
+        self.by_text = {q["question"]: q for q in questions}
+        self.by_id = {q["id"]: q for q in questions}  # question_id в logs
+        self._search_index = None
+        self.last_used = time.monotonic()
+
+    @property
+    def search_index(self) -> SearchIndex:
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.questions)
+        return self._search_index
+
+
+loaded = {}     # name -> Bank
+sizes = {}      # name -> число вопросов (все банки в БД, для /bank)
+_loading = {}   # name -> asyncio.Task загрузки: параллельные запросы ждут одну и ту же
+
+
+def put(name: str, questions) -> Bank:
+    bank = loaded[name] = Bank(name, questions)
+    sizes[name] = len(questions)
+    return bank
+
+
+async def refresh_sizes() -> None:
+    # Новый список собирается целиком до замены: пока идёт запрос, sizes остаётся прежним,
+    # иначе get() на это время не нашёл бы ни одного банка и current_bank сбросил бы выбор пользователя
+    fresh = await asyncio.to_thread(get_bank_sizes)
+    fresh.update({name: len(bank.questions) for name, bank in loaded.items() if name not in fresh})
+    sizes.clear()
+    sizes.update(fresh)
+
+
+async def get(name: str):
+    """Загруженный банк (при необходимости загружает его); None, если такого банка нет."""
+    bank = loaded.get(name)
+    if bank is None:
+        if name not in sizes:
+            return None
+        task = _loading.get(name)
+        if task is None:
+            task = _loading[name] = asyncio.create_task(asyncio.to_thread(load_questions, name))
+            task.add_done_callback(lambda _: _loading.pop(name, None))
+        questions = await asyncio.shield(task)
+        bank = loaded.get(name) or put(name, questions)
+        log.info("Bank %s loaded: %d questions", name, len(questions))
+    bank.last_used = time.monotonic()
+    return bank
+
+
+def evict_idle(max_idle: float = None) -> list[str]:
+    """Выгрузить банки, не использовавшиеся дольше max_idle секунд; возвращает их имена."""
+    max_idle = config.BANK_IDLE_SECONDS if max_idle is None else max_idle
+    now = time.monotonic()
+    evicted = [
+        name for name, bank in loaded.items()
+        if name != config.DEFAULT_BANK and now - bank.last_used > max_idle
+    ]
+    for name in evicted:
+        del loaded[name]
+    return evicted
@@ -1,22 +1,40 @@
+import os
 import random
+import signal
 import asyncio
-import psycopg2
-import psycopg2.extras
+import logging
+import tempfile
+import uuid
 import config
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+import health  # до aiogram: от импорта health отсчитывается время старта
+import storage
+import broadcast
+import banks
+import capture
+import checkpoint
+import difficulty
+import journal
+import leaderboard
+import profiler
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from aiogram import Bot, Dispatcher, types, F, html
 from aiogram.enums.parse_mode import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject, ExceptionTypeFilter
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram import Router
 
-from database import (
-    init_db, update_stats,
-    reset_user_stats, get_all_user_shown_questions_count,
-    log_user_answer, get_daily_user_stats,
+from storage import (
+    init_db, record_answer, get_user_totals,
+    reset_user_stats, get_user_daily_stats,
+    ensure_log_partitions, archive_log_partitions,
+    broadcast_create, broadcast_list, broadcast_finish,
     get_user_wrong_answers, get_mistake_questions,
-    blacklist_add, blacklist_remove, blacklist_list, blacklist_is_blocked
+    blacklist_add, blacklist_remove_many, blacklist_list,
+    record_exam_attempt, replay_answers, load_questions,
+    get_user_bank, set_user_bank
 )
 
 bot = Bot(
@@ -25,49 +43,198 @@ bot = Bot(
 )
 dp = Dispatcher()
 router = Router()
+log = logging.getLogger("bot")
 
-questions = []
+user_bank = {}             # user_id -> имя выбранного банка (кэш user_banks)
 user_question_map = {}
 last_question_text = {}
-user_progress = {}
+user_progress = {}         # user_id -> {"total", "correct", "seen", "banks"} (кэш user_totals и user_bank_totals)
 user_seen_questions = {}   # user_id -> set(question_text)
 
 mistake_mode = {}          # user_id -> True/False
 mistake_questions = {}     # user_id -> list of mistake questions
 retry_attempts = {}        # user_id -> number of retries for current question
 
+ANSWER_PAUSE = 1.5         # пауза на разбор ответа перед следующим вопросом, секунд
+prefetch_epoch = {}        # user_id -> счётчик инвалидаций заранее подготовленного вопроса
+delivered_count = {}       # user_id -> сколько вопросов отправлено (видно, что вопрос уже прислан)
+
 # Кэш последнего списка из /blacklist и ожидание ввода номеров для разблокировки
 blacklist_cache = {}       # user_id -> [question_text]
 awaiting_unban = {}        # user_id -> True/False
+blocked_known = {}         # user_id -> set(question_text), последний прочитанный из БД чёрный список
+
+find_results = {}          # user_id -> (запрос, найденные вопросы) для листания /find
+exam_sessions = {}         # user_id -> состояние экзамена (вариант, ответы, таймер)
+
+background_tasks = set()   # фоновые задачи, живут от startup до shutdown
+inflight = 0               # апдейтов в обработке (для дренажа при остановке)
+DRAIN_TIMEOUT = 20
+restored_texts = []        # контрольная точка прошлого запуска: таблица строк
+restored_sessions = {}     # user_id -> сессия, восстанавливается при первом апдейте пользователя
+restore_checkpoint = True  # False у воркера, перезапущенного супервизором после падения
+MAINTENANCE_INTERVAL = 6 * 60 * 60
+
+
+def set_question_bank(new_questions):
+    # Банк по умолчанию загружается при старте (в многопроцессном режиме его передаёт супервизор),
+    # остальные — при первом обращении (banks.get)
+    banks.put(config.DEFAULT_BANK, new_questions)
+
+
+async def current_bank(user_id):
+    name = user_bank.get(user_id)
+    if name is None:
+        try:
+            name = await journal.call(get_user_bank, user_id) or config.DEFAULT_BANK
+        except journal.DatabaseUnavailable:
+            return await banks.get(config.DEFAULT_BANK)
+        user_bank[user_id] = name
+    bank = await banks.get(name)
+    if bank is None:
+        # Банк удалён из БД — возвращаем пользователя в банк по умолчанию
+        user_bank[user_id] = config.DEFAULT_BANK
+        bank = await banks.get(config.DEFAULT_BANK)
+    return bank
+
+
+# ======= Контрольная точка сессий =======
+
+def owns_user(user_id) -> bool:
+    """Пользователь обслуживается этим воркером (в многопроцессном режиме — по хешу, как в supervisor)."""
+    if config.WORKERS <= 1:
+        return True
+    import supervisor
+    return supervisor.jump_hash(user_id, config.WORKERS) == config.WORKER_INDEX
+
+
+def checkpoint_path(index=None, kind=checkpoint.SAVED):
+    return checkpoint.path(config.CHECKPOINT_DIR, config.WORKER_INDEX if index is None else index, kind)
+
+
+def dump_sessions():
+    """Снимок in-memory сессий для контрольной точки."""
+    table = checkpoint.TextTable()
+    loop_time = asyncio.get_running_loop().time()
+    sessions = {}
+    users = set(user_question_map) | set(user_seen_questions) | set(mistake_mode) | set(exam_sessions)
+    for user_id in filter(owns_user, users):
+        session = {}
+        if user_id in user_bank:
+            session["bank"] = user_bank[user_id]
+        q = user_question_map.get(user_id)
+        if q:
+            session["q"] = [table.ref(q["question"]), [table.ref(o) for o in q["shuffled_options"]], q.get("seed")]
+            session["retry"] = retry_attempts.get(user_id, 0)
+        if user_id in last_question_text:
+            session["last"] = table.ref(last_question_text[user_id])
+        if user_seen_questions.get(user_id):
+            session["seen"] = [table.ref(t) for t in user_seen_questions[user_id]]
+        if mistake_mode.get(user_id):
+            session["mistakes"] = [table.ref(m["question"]) for m in mistake_questions.get(user_id, [])]
+        exam = exam_sessions.get(user_id)
+        if exam:
+            session["exam"] = {
+                "chat_id": exam["chat_id"],
+                "items": [
+                    [
+                        table.ref(item["question"]), [table.ref(o) for o in item["shuffled_options"]],
+                        table.ref(item["correct"]), item.get("seed"),
+                    ]
+                    for item in exam["items"]
+                ],
+                "answers": [table.ref(a) for a in exam["answers"]],
+                "index": exam["index"],
+                "started_at": exam["started_at"].isoformat(),
+                "remaining": max(exam["deadline"] - loop_time, 0),
+            }
+        sessions[user_id] = session
+    return table, sessions
+
+
+def _restore_exam_item(questions_by_text, text, question, options, correct, seed=None):
+    shuffled = [text(o) for o in options]
+    # Вопрос, которого больше нет в банке, досдаётся как есть и пишется в logs текстом
+    bank_q = questions_by_text.get(text(question)) or {
+        "question": text(question), "options": shuffled, "correct": text(correct)
+    }
+    return {**bank_q, "shuffled_options": shuffled, "seed": seed}
+
+
+async def restore_session(user_id):
+    global restored_texts
+    session = restored_sessions.pop(user_id, None)
+    if session is None:
+        return
+    offset = session["text_offset"]
+    texts = restored_texts  # глобальная таблица очищается, когда восстановлены все сессии
+    if "bank" in session:
+        user_bank[user_id] = session["bank"]
+    questions_by_text = (await current_bank(user_id)).by_text
+
+    def text(i):
+        return None if i is None else texts[offset + i]
+
+    if "q" in session:
+        question, options, *seed = session["q"]
+        bank_q = questions_by_text.get(text(question))
+        if bank_q:
+            user_question_map[user_id] = {
+                **bank_q, "shuffled_options": [text(o) for o in options], "seed": seed[0] if seed else None
+            }
+            retry_attempts[user_id] = session.get("retry", 0)
+    if "last" in session:
+        last_question_text[user_id] = text(session["last"])
+    if "seen" in session:
+        user_seen_questions[user_id] = {text(i) for i in session["seen"]}
+    if "mistakes" in session:
+        mistake_mode[user_id] = True
+        mistake_questions[user_id] = [
+            questions_by_text[text(i)] for i in session["mistakes"] if text(i) in questions_by_text
+        ]
+    if "exam" in session:
+        saved = session["exam"]
+        exam = {
+            "chat_id": saved["chat_id"],
+            "items": [_restore_exam_item(questions_by_text, text, *item) for item in saved["items"]],
+            "answers": [text(a) for a in saved["answers"]],
+            "index": saved["index"],
+            "started_at": datetime.fromisoformat(saved["started_at"]),
+            "deadline": asyncio.get_running_loop().time() + saved["remaining"],
+        }
+        exam["timer"] = asyncio.create_task(_exam_timer(user_id, exam))
+        exam_sessions[user_id] = exam
+
+    if not restored_sessions:
+        restored_texts = []
+
+
+# Запись апдейтов для replay.py — внешним слоем, чтобы в замер вошла вся обработка
+if config.CAPTURE_DIR:
+    dp.update.outer_middleware(capture.middleware)
+
+
+@dp.update.outer_middleware()
+async def session_middleware(handler, event, data):
+    global inflight
+    user = data.get("event_from_user")
+    chat = data.get("event_chat")
+    if user is not None and chat is not None and chat.type == "private":
+        broadcast.remember(user.id)  # получатель рассылок
+    inflight += 1  # до первого await: при остановке апдейт уже виден drain_inflight
+    try:
+        if user is not None and user.id in restored_sessions:
+            await restore_session(user.id)
+        return await handler(event, data)
+    finally:
+        inflight -= 1
 
 
-def load_questions_from_postgres():
-    connection = psycopg2.connect(
-        host=config.DB_HOST,
-        port=config.DB_PORT,
-        user=config.DB_USER,
-        password=config.DB_PASSWORD,
-        dbname=config.DB_NAME
-    )
-
-    with connection:
-        with connection.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            cursor.execute("""
-                SELECT question, option_a, option_b, option_c, option_d, option_e, correct_answer
-                FROM questions
-            """)
-            result = cursor.fetchall()
-
-            all_qs = []
-            for row in result:
-                options = [row[k] for k in ['option_a', 'option_b', 'option_c', 'option_d', 'option_e'] if row[k]]
-                all_qs.append({
-                    "question": row["question"],
-                    "options": options,
-                    "correct": row["correct_answer"]
-                })
-
-    return all_qs
+async def drain_inflight(timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while inflight and loop.time() < deadline:
+        await asyncio.sleep(0.1)
 
 
 def create_keyboard(num_options):
@@ -79,15 +246,53 @@ def create_keyboard(num_options):
 
 @router.message(Command("start"))
 async def start_handler(message: types.Message):
+    if message.chat.type != "private":
+        # Личная сессия в группе была бы одна на всех участников
+        await message.answer("👥 В группе играем все вместе: /quiz")
+        return
     user_id = message.chat.id
     mistake_mode[user_id] = False
+    invalidate_prefetch(user_id)
     await message.answer("🧠 Привет! Это тренажёр по медэкспертизе. Начнём!")
     await send_next_question(user_id)
 
 
-async def send_progress_report(chat_id, user_id):
+async def get_progress(user_id):
+    # Агрегаты хранятся в user_totals; в сессии — кэш, который обновляется при каждом ответе.
+    # В многопроцессном режиме ответы в группах пишет воркер группы, а не владелец пользователя
+    # (см. supervisor.route_key) — кэш владельца их не видит, поэтому читаем из БД
     progress = user_progress.get(user_id)
-    if not progress:
+    if progress is None or config.WORKERS > 1:
+        try:
+            progress = await journal.call(get_user_totals, user_id)
+        except journal.DatabaseUnavailable:
+            return progress or {"total": 0, "correct": 0, "seen": 0}
+        user_progress[user_id] = progress
+    return progress
+
+
+def count_offline_answer(user_id, is_correct):
+    # БД недоступна: ответ ушёл в журнал, агрегаты пока ведём в кэше
+    # (после доигровки журнала они перечитываются из user_totals)
+    progress = dict(user_progress.get(user_id) or {"total": 0, "correct": 0, "seen": 0})
+    progress["total"] += 1
+    progress["correct"] += 1 if is_correct else 0
+    user_progress[user_id] = progress
+    return progress
+
+
+async def get_blocked(user_id):
+    try:
+        blocked = set(await journal.call(blacklist_list, user_id))
+    except journal.DatabaseUnavailable:
+        return blocked_known.get(user_id, set())
+    blocked_known[user_id] = blocked
+    return blocked
+
+
+async def send_progress_report(chat_id, user_id):
+    progress = await get_progress(user_id)
+    if not progress["total"]:
         await bot.send_message(chat_id, "📭 Нет статистики.")
         return
 
@@ -95,26 +300,80 @@ async def send_progress_report(chat_id, user_id):
     correct_count = progress["correct"]
     incorrect = total - correct_count
     percent = round(correct_count / total * 100, 1) if total else 0.0
-    answered_qs = get_all_user_shown_questions_count(user_id)
-    remaining = max(len(questions) - answered_qs, 0)
 
     report = (
         f"📊 <b>Промежуточный отчёт</b>\n"
         f"Всего решено: <b>{total}</b>\n"
         f"Верно: <b>{correct_count}</b>\n"
         f"Ошибок: <b>{incorrect}</b>\n"
-        f"Точность: <b>{percent}%</b>\n"
-        f"📚 Ещё не отвечено: <b>{remaining}</b>"
+        f"Точность: <b>{percent}%</b>"
     )
+    bank = await current_bank(user_id)
+    # Просмотренные по банкам приходят вместе с агрегатами; их нет, если кэш собран без БД
+    banks_seen = progress.get("banks")
+    if banks_seen is not None:
+        remaining = max(len(bank.questions) - banks_seen.get(bank.name, 0), 0)
+        report += f"\n📚 Ещё не отвечено в банке «{html.quote(bank.name)}»: <b>{remaining}</b>"
     await bot.send_message(chat_id, report)
 
 
-async def send_next_question(chat_id):
-    user_id = chat_id
+def shuffle_options(q):
+    """
+    Перемешанные варианты вопроса. Перестановку задаёт seed, он пишется в logs вместе
+    с номерами вариантов в банке — по ним показанный порядок восстанавливается.
+    """
+    seed = random.getrandbits(31)
+    shuffled = q["options"].copy()
+    random.Random(seed).shuffle(shuffled)
+    return {"seed": seed, "shuffled_options": shuffled}
+
+
+def build_answer(user_id, q, selected):
+    """
+    Ответ в формате storage (record_answer, _record_answers_batch, журнал).
+    q — вопрос из банка с seed показанной перестановки; варианты кодируются номером
+    в q["options"], текст остаётся только если номера нет.
+    """
+    selected = selected.strip()
+    correct = (q["correct"] or "").strip()
+    ordinals = {}
+    for i, option in enumerate(q["options"]):
+        ordinals.setdefault(option.strip(), i)
+    now = datetime.now(timezone.utc)
+    return {
+        "event_id": str(uuid.uuid4()), "user_id": user_id, "date": now.date(), "answered_ts": now,
+        "correct": selected == correct, "question": q["question"], "question_id": q.get("id"),
+        "user_option": ordinals.get(selected), "correct_option": ordinals.get(correct), "seed": q.get("seed"),
+        "user_answer": selected, "correct_answer": correct,
+    }
+
+
+def resolve_logged(bank, row):
+    """Вопрос банка для строки logs: по question_id, а у нераспознанных старых строк — по тексту."""
+    if row["question_id"] is not None:
+        return bank.by_id.get(row["question_id"])
+    return bank.by_text.get(row["question"])
+
+
+def logged_option(q, ordinal, text):
+    return q["options"][ordinal] if ordinal is not None and ordinal < len(q["options"]) else text
+
+
+def invalidate_prefetch(user_id):
+    # Заранее подготовленный следующий вопрос больше не годится (блокировка, смена режима, сброс)
+    prefetch_epoch[user_id] = prefetch_epoch.get(user_id, 0) + 1
+
+
+async def prepare_next_question(user_id):
+    """
+    Выбирает и рендерит следующий вопрос, не трогая состояние сессии,
+    поэтому его можно готовить заранее, пока пользователь читает разбор ответа.
+    """
     previous_question = last_question_text.get(user_id)
+    questions = (await current_bank(user_id)).questions
 
     # исключаем заблокированные вопросы
-    blocked_set = set(blacklist_list(user_id))
+    blocked_set = await get_blocked(user_id)
 
     def is_allowed(qtext: str) -> bool:
         return (qtext not in blocked_set) and (qtext != previous_question)
@@ -125,7 +384,7 @@ async def send_next_question(chat_id):
         if not pool:
             pool = [q for q in pool_src if q["question"] not in blocked_set]
     else:
-        seen = user_seen_questions.setdefault(user_id, set())
+        seen = user_seen_questions.get(user_id, set())
         pool = [q for q in questions if (q["question"] not in seen) and is_allowed(q["question"])]
         if not pool:
             pool = [q for q in questions if is_allowed(q["question"])]
@@ -135,13 +394,23 @@ async def send_next_question(chat_id):
             pool = questions  # крайний случай
 
     if not pool:
-        await bot.send_message(chat_id, "📭 Вопросов не найдено.")
-        return
+        return None
 
     q = random.choice(pool)
-    shuffled = q["options"].copy()
-    random.shuffle(shuffled)
-    q["shuffled_options"] = shuffled
+    shuffled = shuffle_options(q)
+
+    text = f"<b>Вопрос:</b>\n{q['question']}\n\n"
+    for idx, option in enumerate(shuffled["shuffled_options"], 1):
+        text += f"{idx}. {option}\n"
+
+    # Копия: вопрос из банка общий для всех пользователей, перемешивание — у каждого своё
+    return {**q, **shuffled, "text": text}
+
+
+async def deliver_question(chat_id, user_id, q):
+    if q is None:
+        await bot.send_message(chat_id, "📭 Вопросов не найдено.")
+        return
 
     user_question_map[user_id] = q
     last_question_text[user_id] = q["question"]
@@ -149,13 +418,15 @@ async def send_next_question(chat_id):
         user_seen_questions.setdefault(user_id, set()).add(q["question"])
 
     retry_attempts[user_id] = 0
+    delivered_count[user_id] = delivered_count.get(user_id, 0) + 1
 
-    text = f"<b>Вопрос:</b>\n{q['question']}\n\n"
-    for idx, option in enumerate(shuffled, 1):
-        text += f"{idx}. {option}\n"
+    keyboard = create_keyboard(len(q["shuffled_options"]))
+    await bot.send_message(chat_id, q["text"], reply_markup=keyboard)
 
-    keyboard = create_keyboard(len(shuffled))
-    await bot.send_message(chat_id, text, reply_markup=keyboard)
+
+async def send_next_question(chat_id):
+    user_id = chat_id
+    await deliver_question(chat_id, user_id, await prepare_next_question(user_id))
 
 
 @router.callback_query(F.data.startswith("opt_"))
@@ -168,23 +439,28 @@ async def handle_answer(callback: types.CallbackQuery):
         return
 
     index = int(callback.data.replace("opt_", ""))
-    selected = q["shuffled_options"][index].strip()
-    correct = (q["correct"] or "").strip()
-    is_correct = selected == correct
+    answer = build_answer(user_id, q, q["shuffled_options"][index])
+    is_correct = answer["correct"]
+    correct = answer["correct_answer"]
 
-    update_stats(user_id, q["question"], is_correct)
-    log_user_answer(user_id, datetime.utcnow().date(), is_correct, q["question"], selected, correct)
+    try:
+        progress = await journal.call(record_answer, answer)
+        user_progress[user_id] = progress
+    except journal.DatabaseUnavailable:
+        journal.append(answer)
+        progress = count_offline_answer(user_id, is_correct)
 
-    progress = user_progress.setdefault(user_id, {"total": 0, "correct": 0})
-    progress["total"] += 1
-    if is_correct:
-        progress["correct"] += 1
+    difficulty.record(q["question"], is_correct)
+    leaderboard.record(user_id, is_correct, callback.from_user.full_name)
 
     text = (
         f"✅ Верно!\n<b>{q['question']}</b>\nОтвет: <b>{correct}</b>"
         if is_correct else
         f"❌ Неверно!\n<b>{q['question']}</b>\nПравильный ответ: <b>{correct}</b>"
     )
+    rate = difficulty.correct_rate(q["question"])
+    if rate is not None:
+        text += f"\n📊 Верно отвечают {rate}% пользователей"
 
     # Кнопка "Больше не показывать" — появляется после ответа
     kb = InlineKeyboardBuilder()
@@ -193,8 +469,10 @@ async def handle_answer(callback: types.CallbackQuery):
 
     # Режим тренировки ошибок
     if mistake_mode.get(user_id):
-        if is_correct and q in mistake_questions.get(user_id, []):
-            mistake_questions[user_id].remove(q)
+        if is_correct:
+            mistake_questions[user_id] = [
+                m for m in mistake_questions.get(user_id, []) if m["question"] != q["question"]
+            ]
         elif not is_correct:
             retry_attempts[user_id] += 1
             if retry_attempts[user_id] < 2:
@@ -207,11 +485,23 @@ async def handle_answer(callback: types.CallbackQuery):
             await bot.send_message(callback.message.chat.id, "🎯 Все ошибки отработаны! Возвращаемся к обычному режиму.")
             mistake_mode[user_id] = False
 
+    # Пауза на разбор ответа: следующий вопрос выбирается и рендерится в это же время,
+    # так что пользователь ждёт ровно ANSWER_PAUSE
+    epoch = prefetch_epoch.get(user_id, 0)
+    delivered = delivered_count.get(user_id, 0)
+    pause = asyncio.create_task(asyncio.sleep(ANSWER_PAUSE))
+    prefetch = asyncio.create_task(prepare_next_question(user_id))
+
     if progress["total"] % 50 == 0:
         await send_progress_report(callback.message.chat.id, user_id)
 
-    await asyncio.sleep(1.5)
-    await send_next_question(callback.message.chat.id)
+    await pause
+    next_q = await prefetch
+    if delivered_count.get(user_id, 0) != delivered or user_id in exam_sessions:
+        return  # за время паузы вопрос уже прислан другой командой (/start, /errors) или начат экзамен
+    if prefetch_epoch.get(user_id, 0) != epoch:
+        next_q = await prepare_next_question(user_id)
+    await deliver_question(callback.message.chat.id, user_id, next_q)
 
 
 # Нажатие "Больше не показывать"
@@ -225,8 +515,13 @@ async def on_block_question(callback: types.CallbackQuery):
         return
 
     question_text = q["question"]
-    if not blacklist_is_blocked(user_id, question_text):
-        blacklist_add(user_id, question_text)
+    invalidate_prefetch(user_id)
+    try:
+        await journal.call(blacklist_add, user_id, question_text)
+    except journal.DatabaseUnavailable:
+        await bot.send_message(callback.message.chat.id, "⚠️ База данных временно недоступна — вопрос не заблокирован. Попробуйте чуть позже.")
+        return
+    blocked_known.setdefault(user_id, set()).add(question_text)
 
     try:
         await callback.message.edit_reply_markup(reply_markup=None)
@@ -282,7 +577,9 @@ def _parse_indices(text: str, max_n: int) -> list[int]:
 @router.message(Command("blacklist"))
 async def blacklist_handler(message: types.Message):
     user_id = message.from_user.id
-    items = blacklist_list(user_id)  # список строк-вопросов
+    bank = await current_bank(user_id)
+    # Чёрный список показываем в пределах текущего банка
+    items = [t for t in await journal.call(blacklist_list, user_id) if t in bank.by_text]  # список строк-вопросов
     if not items:
         awaiting_unban.pop(user_id, None)
         blacklist_cache.pop(user_id, None)
@@ -316,16 +613,11 @@ async def maybe_unban_numbers(message: types.Message):
         await message.answer("Не удалось распознать номера. Пример: <code>1 3 5-7</code>")
         return
 
-    # Разблокируем выбранные
-    unlocked = []
-    for i in idxs:
-        qtext = items[i - 1]
-        blacklist_remove(user_id, qtext)
-        unlocked.append(i)
-
-    # Обновим список
-    new_items = blacklist_list(user_id)
+    # Разблокируем выбранные одним запросом и сразу получим обновлённый список
+    new_items = await journal.call(blacklist_remove_many, user_id, [items[i - 1] for i in idxs])
+    unlocked = idxs
     blacklist_cache[user_id] = new_items
+    blocked_known[user_id] = set(new_items)
     awaiting_unban[user_id] = False
 
     reply = f"✅ Разблокировано: {', '.join(map(str, unlocked))}."
@@ -341,6 +633,11 @@ async def maybe_unban_numbers(message: types.Message):
 # ===========================================
 
 
+def history_since():
+    # Нижняя граница по дате: запросы к logs затрагивают только нужные партиции
+    return datetime.utcnow().date() - timedelta(days=config.HISTORY_DAYS)
+
+
 @router.message(Command("progress"))
 async def progress_handler(message: types.Message):
     await send_progress_report(message.chat.id, message.from_user.id)
@@ -350,10 +647,11 @@ async def progress_handler(message: types.Message):
 async def weekly_stats_handler(message: types.Message):
     user_id = message.from_user.id
     today = datetime.utcnow().date()
+    daily = await journal.call(get_user_daily_stats, user_id, today - timedelta(days=6), timeout=config.HISTORY_DB_TIMEOUT)
     text_lines = []
     for i in range(7):
         day = today - timedelta(days=i)
-        total, correct = get_daily_user_stats(user_id, day)
+        total, correct = daily.get(day, (0, 0))
         if total == 0:
             continue
         percent = round(correct / total * 100, 1)
@@ -369,7 +667,21 @@ async def weekly_stats_handler(message: types.Message):
 
 @router.message(Command("stats"))
 async def stats_handler(message: types.Message):
-    rows = get_user_wrong_answers(message.from_user.id)
+    bank = await current_bank(message.from_user.id)
+    # Тексты вопроса и вариантов берутся из банка в памяти, в logs — только номера
+    wrong = await journal.call(
+        get_user_wrong_answers, message.from_user.id, history_since(), timeout=config.HISTORY_DB_TIMEOUT
+    )
+    rows = []
+    for row in wrong:
+        q = resolve_logged(bank, row)
+        if q:
+            rows.append({
+                "question": q["question"],
+                "user_answer": logged_option(q, row["user_option"], row["user_answer"]),
+                "correct_answer": logged_option(q, row["correct_option"], row["correct_answer"]),
+                "answered_at": row["answered_at"],
+            })
     if not rows:
         await message.answer("📬 У вас пока нет ошибок.")
         return
@@ -389,8 +701,12 @@ async def stats_handler(message: types.Message):
 @router.message(Command("errors"))
 async def train_mistakes_handler(message: types.Message):
     user_id = message.from_user.id
+    bank = await current_bank(user_id)
+    logged = await journal.call(get_mistake_questions, user_id, history_since(), timeout=config.HISTORY_DB_TIMEOUT)
     mistake_mode[user_id] = True
-    mistake_questions[user_id] = get_mistake_questions(user_id)
+    invalidate_prefetch(user_id)
+    resolved = (resolve_logged(bank, row) for row in logged)
+    mistake_questions[user_id] = list({q["question"]: q for q in resolved if q}.values())
     if not mistake_questions[user_id]:
         await message.answer("🎉 Нет ошибок для повторения — хорошая работа!")
         mistake_mode[user_id] = False
@@ -402,15 +718,699 @@ async def train_mistakes_handler(message: types.Message):
 @router.message(Command("reset"))
 async def reset_handler(message: types.Message):
     user_id = message.from_user.id
-    reset_user_stats(user_id)
-    user_progress[user_id] = {"total": 0, "correct": 0}
+    user_progress[user_id] = {"total": 0, "correct": 0, "seen": 0, "banks": {}}
     user_seen_questions[user_id] = set()
+    invalidate_prefetch(user_id)
+    leaderboard.forget(user_id)
     # Сброс локальных состояний, связанных с blacklist UX
     blacklist_cache.pop(user_id, None)
     awaiting_unban.pop(user_id, None)
+    # Удаление истории идёт порциями в отдельном потоке и не блокирует остальных пользователей
+    await asyncio.to_thread(reset_user_stats, user_id)
     await message.answer("🔄 Ваша статистика сброшена.")
 
 
+# ======= Рейтинг недели =======
+
+TOP_SIZE = 10
+TOP_BOARDS = {"solved": "верные ответы", "accuracy": "точность"}
+
+
+def _format_number(n: int) -> str:
+    return f"{n:,}".replace(",", "\u00a0")
+
+
+def _format_top(user_id, board):
+    lines = [
+        f"🏆 <b>Рейтинг недели</b> (с {leaderboard.week.strftime('%d.%m')}): {TOP_BOARDS[board]}"
+    ]
+    for place, member_id, name, answered, correct in leaderboard.top(board, TOP_SIZE):
+        name = html.quote(name or "Участник")
+        if member_id == user_id:
+            name = f"<b>{name}</b>"
+        if board == "accuracy":
+            score = f"{round(correct / answered * 100, 1)}% ({correct}/{answered})"
+        else:
+            score = f"{correct} (из {answered})"
+        lines.append(f"{place}. {name} — {score}")
+    if len(lines) == 1:
+        lines.append("Пока никто не отвечал.")
+
+    position = leaderboard.rank(user_id, board)
+    answered = leaderboard.counts.get(user_id, (0, 0))[0]
+    if position:
+        place, total = position
+        lines.append(f"\nВаше место: <b>{_format_number(place)}</b> из {_format_number(total)}")
+    elif board == "accuracy" and answered:
+        lines.append(f"\nДо рейтинга точности осталось ответов: {leaderboard.MIN_ANSWERS - answered}")
+    else:
+        lines.append("\nВы ещё не отвечали на этой неделе.")
+
+    builder = InlineKeyboardBuilder()
+    for key, title in TOP_BOARDS.items():
+        if key != board:
+            builder.button(text=f"Рейтинг: {title}", callback_data=f"top_{key}")
+    return "\n".join(lines), builder.as_markup()
+
+
+@router.message(Command("top"))
+async def top_handler(message: types.Message):
+    text, keyboard = _format_top(message.from_user.id, "solved")
+    await message.answer(text, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("top_"))
+async def top_board_handler(callback: types.CallbackQuery):
+    await callback.answer()
+    board = callback.data.removeprefix("top_")
+    if board not in TOP_BOARDS:
+        return
+    text, keyboard = _format_top(callback.from_user.id, board)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+# ======= Банки вопросов =======
+
+BANK_MAINTENANCE_INTERVAL = 5 * 60
+
+
+def _bank_keyboard(current):
+    builder = InlineKeyboardBuilder()
+    for name in sorted(banks.sizes):
+        mark = "✅ " if name == current else ""
+        builder.button(text=f"{mark}{name} ({banks.sizes[name]})", callback_data=f"bank_{name}")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+async def switch_bank(chat_id, user_id, name):
+    if user_id in exam_sessions:
+        await bot.send_message(chat_id, "📝 Сначала завершите экзамен: /exam_stop")
+        return
+    bank = await banks.get(name)
+    if bank is None:
+        await bot.send_message(chat_id, f"Банка «{html.quote(name)}» нет. Список: /bank")
+        return
+    user_bank[user_id] = name
+    try:
+        await journal.call(set_user_bank, user_id, name)
+    except journal.DatabaseUnavailable:
+        pass  # выбор останется в памяти до рестарта
+    # Ошибки и поиск относятся к прежнему банку
+    mistake_mode[user_id] = False
+    find_results.pop(user_id, None)
+    invalidate_prefetch(user_id)
+    await bot.send_message(chat_id, f"📚 Банк «{html.quote(name)}»: {len(bank.questions)} вопросов.")
+    await send_next_question(chat_id)
+
+
+@router.message(Command("bank"))
+async def bank_handler(message: types.Message, command: CommandObject):
+    user_id = message.from_user.id
+    if command.args:
+        await switch_bank(message.chat.id, user_id, command.args.strip())
+        return
+    current = (await current_bank(user_id)).name
+    await message.answer(
+        f"📚 Текущий банк: <b>{html.quote(current)}</b>. Выберите другой:",
+        reply_markup=_bank_keyboard(current)
+    )
+
+
+@router.callback_query(F.data.startswith("bank_"))
+async def bank_select_handler(callback: types.CallbackQuery):
+    await callback.answer()
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+    await switch_bank(callback.message.chat.id, callback.from_user.id, callback.data.removeprefix("bank_"))
+
+
+async def bank_maintenance_loop():
+    while True:
+        await asyncio.sleep(BANK_MAINTENANCE_INTERVAL)
+        for name in banks.evict_idle():
+            log.info("Bank %s evicted (idle)", name)
+        try:
+            await banks.refresh_sizes()
+        except storage.Error as e:
+            log.warning("Bank list refresh failed: %s", e)
+
+
+# ======= Поиск по банку вопросов =======
+
+FIND_PAGE_SIZE = 5
+
+
+def _format_find_page(query, found, page):
+    pages = (len(found) + FIND_PAGE_SIZE - 1) // FIND_PAGE_SIZE
+    lines = [f"🔎 <b>{html.quote(query)}</b> — найдено: {len(found)} (стр. {page + 1}/{pages})"]
+    start = page * FIND_PAGE_SIZE
+    for i, q in enumerate(found[start:start + FIND_PAGE_SIZE], start + 1):
+        text = q["question"].strip().replace("\n", " ")
+        if len(text) > 200:
+            text = text[:197] + "..."
+        lines.append(f"\n{i}. {text}\n✅ <b>{q['correct']}</b>")
+
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="◀️", callback_data=f"find_{page - 1}")
+    if page < pages - 1:
+        builder.button(text="▶️", callback_data=f"find_{page + 1}")
+    return "\n".join(lines), builder.as_markup()
+
+
+@router.message(Command("find"))
+async def find_handler(message: types.Message, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Использование: <code>/find слова из вопроса</code> (можно начала слов)")
+        return
+    bank = await current_bank(message.from_user.id)
+    # Индекс строится лениво при первом поиске — это тоже должно идти в потоке, а не в цикле событий
+    found = await asyncio.to_thread(lambda: bank.search_index.search(query))
+    if not found:
+        await message.answer("🔎 Ничего не найдено.")
+        return
+    find_results[message.from_user.id] = (query, found)
+    text, keyboard = _format_find_page(query, found, 0)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("find_"))
+async def find_page_handler(callback: types.CallbackQuery):
+    await callback.answer()
+    cached = find_results.get(callback.from_user.id)
+    if not cached:
+        return
+    query, found = cached
+    text, keyboard = _format_find_page(query, found, int(callback.data.removeprefix("find_")))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+# ======= Режим экзамена =======
+# Вариант выбирается целиком при старте, ответы копятся в сессии,
+# в БД всё пишется одной транзакцией при завершении.
+
+EXAM_DEFAULT_SIZE = 20
+EXAM_MAX_SIZE = 100
+
+
+def _exam_question_text(exam) -> str:
+    item = exam["items"][exam["index"]]
+    left = max(int(exam["deadline"] - asyncio.get_running_loop().time()), 0)
+    text = (
+        f"📝 <b>Экзамен: вопрос {exam['index'] + 1} из {len(exam['items'])}</b> "
+        f"(осталось {left // 60}:{left % 60:02d})\n\n"
+        f"{item['question']}\n\n"
+    )
+    for idx, option in enumerate(item["shuffled_options"], 1):
+        text += f"{idx}. {option}\n"
+    return text
+
+
+def _exam_keyboard(exam):
+    item = exam["items"][exam["index"]]
+    builder = InlineKeyboardBuilder()
+    for i in range(len(item["shuffled_options"])):
+        builder.button(text=str(i + 1), callback_data=f"exam_{exam['index']}_{i}")
+    return builder.as_markup()
+
+
+async def _exam_timer(user_id, exam):
+    await asyncio.sleep(exam["deadline"] - asyncio.get_running_loop().time())
+    if exam_sessions.get(user_id) is exam:
+        await finish_exam(user_id, timed_out=True)
+
+
+async def finish_exam(user_id, timed_out=False):
+    exam = exam_sessions.pop(user_id, None)
+    if not exam:
+        return
+    if not timed_out:
+        exam["timer"].cancel()
+
+    answers = []
+    mistakes = []
+    for item, selected in zip(exam["items"], exam["answers"]):
+        answer = build_answer(user_id, item, selected)
+        answers.append(answer)
+        if not answer["correct"]:
+            mistakes.append((item["question"], answer["correct_answer"]))
+        difficulty.record(item["question"], answer["correct"])
+        leaderboard.record(user_id, answer["correct"], exam.get("name"))
+
+    try:
+        totals = await journal.call(
+            record_exam_attempt, user_id, exam["started_at"], datetime.utcnow(),
+            len(exam["items"]), timed_out, answers
+        )
+        if totals:
+            user_progress[user_id] = totals
+    except journal.DatabaseUnavailable:
+        # Ответы доиграются из журнала, сама попытка в exam_attempts не попадёт
+        for answer in answers:
+            journal.append(answer)
+            count_offline_answer(user_id, answer["correct"])
+
+    total = len(exam["items"])
+    correct_count = len(answers) - len(mistakes)
+    percent = round(correct_count / total * 100, 1)
+    elapsed = int((datetime.utcnow() - exam["started_at"]).total_seconds())
+    lines = [
+        "⏰ <b>Время вышло!</b>" if timed_out else "🏁 <b>Экзамен завершён</b>",
+        f"Результат: <b>{correct_count}</b> из {total} — <b>{percent}%</b>",
+        f"Отвечено: {len(answers)}, время: {elapsed // 60}:{elapsed % 60:02d}",
+    ]
+    if mistakes:
+        lines.append("\n<b>Ошибки:</b>")
+        for i, (question, correct) in enumerate(mistakes[:10], 1):
+            lines.append(f"{i}. {question[:60]}... — верно: {correct}")
+        if len(mistakes) > 10:
+            lines.append(f"…и ещё {len(mistakes) - 10}. Полный список — /stats, тренировка — /errors")
+    await bot.send_message(exam["chat_id"], "\n".join(lines))
+
+
+@router.message(Command("exam"))
+async def exam_handler(message: types.Message, command: CommandObject):
+    user_id = message.from_user.id
+    if user_id in exam_sessions:
+        await message.answer("📝 Экзамен уже идёт. Завершить досрочно: /exam_stop")
+        return
+    try:
+        size = int(command.args) if command.args else EXAM_DEFAULT_SIZE
+    except ValueError:
+        await message.answer(f"Использование: <code>/exam N</code> (N — число вопросов, до {EXAM_MAX_SIZE})")
+        return
+    size = min(max(size, 1), EXAM_MAX_SIZE)
+
+    blocked_set = await get_blocked(user_id)
+    pool = [q for q in (await current_bank(user_id)).questions if q["question"] not in blocked_set]
+    if not pool:
+        await message.answer("📭 Вопросов не найдено.")
+        return
+
+    items = [{**q, **shuffle_options(q)} for q in random.sample(pool, min(size, len(pool)))]
+
+    seconds = len(items) * config.EXAM_SECONDS_PER_QUESTION
+    exam = {
+        "chat_id": message.chat.id,
+        "name": message.from_user.full_name,
+        "items": items,
+        "answers": [],
+        "index": 0,
+        "started_at": datetime.utcnow(),
+        "deadline": asyncio.get_running_loop().time() + seconds,
+    }
+    exam["timer"] = asyncio.create_task(_exam_timer(user_id, exam))
+    exam_sessions[user_id] = exam
+    invalidate_prefetch(user_id)
+
+    await message.answer(
+        f"📝 <b>Экзамен</b>: {len(items)} вопросов, время — {seconds // 60} мин.\n"
+        f"Результат будет в конце. Досрочно завершить: /exam_stop"
+    )
+    await message.answer(_exam_question_text(exam), reply_markup=_exam_keyboard(exam))
+
+
+@router.callback_query(F.data.startswith("exam_"))
+async def exam_answer_handler(callback: types.CallbackQuery):
+    await callback.answer()
+    user_id = callback.from_user.id
+    exam = exam_sessions.get(user_id)
+    if not exam:
+        return
+    index, option = map(int, callback.data.removeprefix("exam_").split("_"))
+    if index != exam["index"]:
+        return  # нажатие на устаревшую клавиатуру
+
+    exam["answers"].append(exam["items"][index]["shuffled_options"][option])
+    exam["index"] += 1
+    if exam["index"] >= len(exam["items"]):
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await finish_exam(user_id)
+        return
+    await callback.message.edit_text(_exam_question_text(exam), reply_markup=_exam_keyboard(exam))
+
+
+@router.message(Command("exam_stop"))
+async def exam_stop_handler(message: types.Message):
+    if message.from_user.id not in exam_sessions:
+        await message.answer("Сейчас нет активного экзамена.")
+        return
+    await finish_exam(message.from_user.id)
+
+
+# ======= Групповая викторина =======
+# Один вопрос на чат: ответы участников копятся в памяти, счётчик под вопросом
+# обновляется не чаще раза в GROUP_EDIT_INTERVAL (правки склеиваются), а в БД ответы
+# всех участников пишутся одной пачкой при закрытии вопроса.
+
+GROUP_DEFAULT_SIZE = 10
+GROUP_MAX_SIZE = 50
+GROUP_PAUSE = 3            # пауза между результатами и следующим вопросом, секунд
+GROUP_TOP = 10
+
+group_quizzes = {}         # chat_id -> состояние викторины (вопросы, ответы, счёт)
+
+
+def _group_question_text(quiz) -> str:
+    item = quiz["items"][quiz["index"]]
+    text = f"👥 <b>Вопрос {quiz['index'] + 1} из {len(quiz['items'])}</b>\n\n{item['question']}\n\n"
+    for idx, option in enumerate(item["shuffled_options"], 1):
+        text += f"{idx}. {option}\n"
+    return text
+
+
+def _group_keyboard(quiz):
+    item = quiz["items"][quiz["index"]]
+    builder = InlineKeyboardBuilder()
+    for i in range(len(item["shuffled_options"])):
+        builder.button(text=str(i + 1), callback_data=f"gq_{quiz['index']}_{i}")
+    return builder.as_markup()
+
+
+def _group_tally_text(quiz) -> str:
+    return _group_question_text(quiz) + f"\n🙋 Ответили: <b>{len(quiz['answers'])}</b>"
+
+
+def _schedule_group_tally(quiz):
+    # Одна отложенная правка на вопрос: ответы, пришедшие за время ожидания, попадут в неё же
+    if quiz["edit_task"] is None:
+        quiz["edit_task"] = asyncio.create_task(_edit_group_tally(quiz, quiz["index"]))
+
+
+async def _edit_group_tally(quiz, index):
+    loop = asyncio.get_running_loop()
+    delay = quiz["last_edit"] + config.GROUP_EDIT_INTERVAL - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    quiz["edit_task"] = None
+    if group_quizzes.get(quiz["chat_id"]) is not quiz or quiz["index"] != index:
+        return
+    quiz["last_edit"] = loop.time()
+    try:
+        await bot.edit_message_text(
+            _group_tally_text(quiz), chat_id=quiz["chat_id"], message_id=quiz["message_id"],
+            reply_markup=_group_keyboard(quiz)
+        )
+    except TelegramRetryAfter as e:
+        quiz["last_edit"] = loop.time() + e.retry_after
+        _schedule_group_tally(quiz)
+    except TelegramBadRequest:
+        pass  # текст не изменился или сообщение удалено
+
+
+async def _record_group_answers(answers):
+    if not answers:
+        return
+    # Участники группы обслуживаются разными воркерами: личные кэши трогаем только у своих
+    try:
+        totals = await journal.call(replay_answers, answers)
+        user_progress.update((user_id, t) for user_id, t in totals.items() if owns_user(user_id))
+    except journal.DatabaseUnavailable:
+        for answer in answers:
+            journal.append(answer)
+            if answer["user_id"] in user_progress and owns_user(answer["user_id"]):
+                count_offline_answer(answer["user_id"], answer["correct"])
+
+
+def _take_group_answers(quiz):
+    """Ответы на текущий вопрос в формате _record_answers_batch; счёт участников обновляется."""
+    item = quiz["items"][quiz["index"]]
+    answers = []
+    for user_id, option in quiz["answers"].items():
+        answer = build_answer(user_id, item, item["shuffled_options"][option])
+        if answer["correct"]:
+            quiz["scores"][user_id] = quiz["scores"].get(user_id, 0) + 1
+        answers.append(answer)
+        difficulty.record(item["question"], answer["correct"])
+        leaderboard.record(user_id, answer["correct"], quiz["names"].get(user_id))
+    quiz["answers"] = {}
+    return answers
+
+
+async def _close_group_question(quiz):
+    if quiz["edit_task"] is not None:
+        quiz["edit_task"].cancel()
+        quiz["edit_task"] = None
+    item = quiz["items"][quiz["index"]]
+    chosen = list(quiz["answers"].values())
+    answers = _take_group_answers(quiz)
+    # Ответы уже забраны из викторины: пишем их под shield и до редактирования сообщения —
+    # /quiz_stop, отменивший задачу на любом из этих await, не должен их потерять
+    await asyncio.shield(_record_group_answers(answers))
+    right = sum(1 for a in answers if a["correct"])
+
+    text = _group_question_text(quiz) + f"\n✅ Правильный ответ: <b>{(item['correct'] or '').strip()}</b>\n"
+    if answers:
+        text += "Ответы: " + ", ".join(
+            f"{i + 1} — {chosen.count(i)}" for i in range(len(item["shuffled_options"]))
+        ) + f"\nВерно ответили: <b>{right}</b> из {len(answers)}"
+    else:
+        text += "Никто не ответил."
+    try:
+        await bot.edit_message_text(text, chat_id=quiz["chat_id"], message_id=quiz["message_id"])
+    except TelegramBadRequest:
+        pass
+
+
+async def _run_group_quiz(quiz):
+    chat_id = quiz["chat_id"]
+    try:
+        while quiz["index"] < len(quiz["items"]):
+            quiz["answers"] = {}
+            quiz["last_edit"] = asyncio.get_running_loop().time()
+            sent = await bot.send_message(chat_id, _group_tally_text(quiz), reply_markup=_group_keyboard(quiz))
+            quiz["message_id"] = sent.message_id
+            await asyncio.sleep(config.GROUP_QUESTION_SECONDS)
+            await _close_group_question(quiz)
+            quiz["index"] += 1
+            if quiz["index"] < len(quiz["items"]):
+                await asyncio.sleep(GROUP_PAUSE)
+    finally:
+        if group_quizzes.get(chat_id) is quiz:
+            del group_quizzes[chat_id]
+    await bot.send_message(chat_id, _group_scoreboard(quiz))
+
+
+def _group_scoreboard(quiz) -> str:
+    lines = [f"🏁 <b>Викторина завершена</b> ({quiz['index']} из {len(quiz['items'])} вопросов)"]
+    top = sorted(quiz["scores"].items(), key=lambda item: -item[1])[:GROUP_TOP]
+    if not top:
+        lines.append("Верных ответов не было.")
+    for place, (user_id, score) in enumerate(top, 1):
+        lines.append(f"{place}. {html.quote(quiz['names'].get(user_id, str(user_id)))} — {score}")
+    return "\n".join(lines)
+
+
+async def stop_group_quiz(chat_id):
+    """Досрочно закрывает викторину: ответы на открытый вопрос записываются, счёт публикуется."""
+    quiz = group_quizzes.pop(chat_id, None)
+    if not quiz:
+        return False
+    quiz["task"].cancel()
+    if quiz["edit_task"] is not None:
+        quiz["edit_task"].cancel()
+    await _record_group_answers(_take_group_answers(quiz))
+    return True
+
+
+@router.message(Command("quiz"))
+async def group_quiz_handler(message: types.Message, command: CommandObject):
+    chat_id = message.chat.id
+    if message.chat.type == "private":
+        await message.answer("👥 Викторина на всю группу запускается в групповом чате: добавьте бота в группу и пришлите /quiz")
+        return
+    if chat_id in group_quizzes:
+        await message.answer("👥 Викторина уже идёт. Остановить: /quiz_stop")
+        return
+    try:
+        size = int(command.args) if command.args else GROUP_DEFAULT_SIZE
+    except ValueError:
+        await message.answer(f"Использование: <code>/quiz N</code> (N — число вопросов, до {GROUP_MAX_SIZE})")
+        return
+    size = min(max(size, 1), GROUP_MAX_SIZE)
+
+    pool = (await banks.get(config.DEFAULT_BANK)).questions
+    if not pool:
+        await message.answer("📭 Вопросов не найдено.")
+        return
+    items = [{**q, **shuffle_options(q)} for q in random.sample(pool, min(size, len(pool)))]
+
+    quiz = {
+        "chat_id": chat_id,
+        "items": items,
+        "index": 0,
+        "message_id": None,
+        "answers": {},          # user_id -> номер варианта на текущий вопрос
+        "scores": {},           # user_id -> верных ответов за викторину
+        "names": {},            # user_id -> имя для итоговой таблицы
+        "last_edit": 0.0,
+        "edit_task": None,
+    }
+    group_quizzes[chat_id] = quiz
+    await message.answer(
+        f"👥 <b>Викторина</b>: {len(items)} вопросов, {config.GROUP_QUESTION_SECONDS} с на каждый.\n"
+        f"Отвечать может каждый участник, засчитывается первый ответ. Остановить: /quiz_stop"
+    )
+    quiz["task"] = asyncio.create_task(_run_group_quiz(quiz))
+
+
+@router.callback_query(F.data.startswith("gq_"))
+async def group_answer_handler(callback: types.CallbackQuery):
+    quiz = group_quizzes.get(callback.message.chat.id)
+    index, option = map(int, callback.data.removeprefix("gq_").split("_"))
+    if not quiz or index != quiz["index"]:
+        await callback.answer("Этот вопрос уже закрыт.")
+        return
+    user_id = callback.from_user.id
+    if user_id in quiz["answers"]:
+        await callback.answer("Ответ уже принят.")
+        return
+    quiz["answers"][user_id] = option
+    quiz["names"][user_id] = callback.from_user.full_name
+    await callback.answer(f"Ответ {option + 1} принят.")
+    _schedule_group_tally(quiz)
+
+
+@router.message(Command("quiz_stop"))
+async def group_quiz_stop_handler(message: types.Message):
+    quiz = group_quizzes.get(message.chat.id)
+    if not quiz or not await stop_group_quiz(message.chat.id):
+        await message.answer("Сейчас нет активной викторины.")
+        return
+    await message.answer(_group_scoreboard(quiz))
+
+
+# ======= Рассылки (только для администраторов) =======
+
+def is_admin(user_id: int) -> bool:
+    return user_id in config.ADMIN_IDS
+
+
+@router.message(Command("broadcast"))
+async def broadcast_handler(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        return
+    if not command.args:
+        await message.answer("Использование: <code>/broadcast текст сообщения</code>")
+        return
+    broadcast_id = await asyncio.to_thread(broadcast_create, command.args, message.from_user.id)
+    broadcast.start(bot, broadcast_id)
+    await message.answer(f"📣 Рассылка #{broadcast_id} запущена. Прогресс: /broadcast_status")
+
+
+@router.message(Command("broadcast_status"))
+async def broadcast_status_handler(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    jobs = await asyncio.to_thread(broadcast_list)
+    if not jobs:
+        await message.answer("Рассылок ещё не было.")
+        return
+    await message.answer("\n\n".join(broadcast.format_status(job) for job in jobs))
+
+
+@router.message(Command("broadcast_cancel"))
+async def broadcast_cancel_handler(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        broadcast_id = int(command.args)
+    except (TypeError, ValueError):
+        await message.answer("Использование: <code>/broadcast_cancel id</code>")
+        return
+    # Статус в БД проверяется после каждой пачки — это остановит рассылку в любом процессе
+    if await asyncio.to_thread(broadcast_finish, broadcast_id, "cancelled"):
+        await message.answer(f"⏹ Рассылка #{broadcast_id} остановлена.")
+    else:
+        await message.answer(f"Рассылка #{broadcast_id} не выполняется.")
+
+
+@router.message(Command("difficulty"))
+async def difficulty_export_handler(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    await difficulty.flush()
+    path = os.path.join(tempfile.gettempdir(), f"difficulty-{message.from_user.id}.csv")
+
+    def export():
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            return difficulty.export_csv(f)
+
+    count = await asyncio.to_thread(export)
+    await message.answer_document(
+        types.FSInputFile(path, filename="difficulty.csv"),
+        caption=f"📊 Сложность вопросов: {count} шт., от самых сложных к простым"
+    )
+
+
+PROFILE_DEFAULT_SECONDS = 10
+
+
+def format_profile(summary) -> str:
+    lines = [
+        f"🔬 <b>Профиль за {summary['seconds']} с</b> (воркер {config.WORKER_INDEX})",
+        f"Семплов: {summary['samples']}, цикл событий занят: <b>{round(summary['loop_busy'] * 100)}%</b>",
+        f"Медленных колбэков (> {int(profiler.SLOW_CALLBACK * 1000)} мс): <b>{summary['slow_callbacks']}</b>",
+    ]
+    if summary["top"]:
+        lines.append("\n<b>Чаще всего на вершине стека:</b>")
+        for name, count in summary["top"]:
+            lines.append(f"{round(count / summary['stacks'] * 100, 1)}% — <code>{html.quote(name)}</code>")
+    return "\n".join(lines)
+
+
+async def run_profile(seconds, chat_id=None):
+    try:
+        summary = await profiler.run(seconds, config.PROFILE_DIR, tag=f"w{config.WORKER_INDEX}-")
+    except RuntimeError:
+        if chat_id is not None:
+            await bot.send_message(chat_id, "⏳ Профилирование уже идёт.")
+        return
+    log.info("Profile written to %s (%d slow callbacks)", summary["folded_path"], summary["slow_callbacks"])
+    if chat_id is None:
+        return
+    await bot.send_message(chat_id, format_profile(summary))
+    await bot.send_document(
+        chat_id, types.FSInputFile(summary["folded_path"]),
+        caption="Стеки в формате folded: flamegraph.pl или speedscope.app"
+    )
+    if summary["slow_callbacks"]:
+        await bot.send_document(chat_id, types.FSInputFile(summary["slow_path"]))
+
+
+def start_profile(seconds, chat_id=None):
+    # Профиль идёт фоновой задачей, чтобы не держать обработчик (и дренаж при остановке)
+    task = asyncio.create_task(run_profile(seconds, chat_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+@router.message(Command("profile"))
+async def profile_handler(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        seconds = int(command.args) if command.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await message.answer(f"Использование: <code>/profile N</code> (секунд, до {profiler.MAX_SECONDS})")
+        return
+    if profiler.active:
+        await message.answer("⏳ Профилирование уже идёт.")
+        return
+    seconds = min(max(seconds, 1), profiler.MAX_SECONDS)
+    start_profile(seconds, message.chat.id)
+    # Команда приходит в воркер администратора (supervisor.route_key), профилируется только он
+    scope = (
+        f" Профилируется воркер {config.WORKER_INDEX} из {config.WORKERS}; все воркеры — kill -USR1 супервизору."
+        if config.WORKERS > 1 else ""
+    )
+    await message.answer(f"🔬 Профилирую {seconds} с, результат пришлю сюда.{scope}")
+
+
 @router.message(Command("help"))
 async def help_handler(message: types.Message):
     text = (
@@ -424,6 +1424,11 @@ async def help_handler(message: types.Message):
         "/stats — список ошибок\n"
         "/progress — прогресс\n"
         "/week — статистика по дням\n"
+        "/top — рейтинг недели\n"
+        "/find слова — поиск вопроса по тексту\n"
+        "/exam N — пробный экзамен на N вопросов с ограничением времени\n"
+        "/quiz N — викторина на N вопросов для всей группы (в групповом чате)\n"
+        "/bank — выбрать банк вопросов (тему)\n"
         "/reset — сбросить всё\n"
         "/blacklist — показать чёрный список; затем пришли номера для разблокировки\n"
         "/help — это меню"
@@ -431,10 +1436,175 @@ async def help_handler(message: types.Message):
     await message.answer(text)
 
 
+async def logs_maintenance_loop():
+    while True:
+        try:
+            await asyncio.to_thread(ensure_log_partitions)
+            if config.LOGS_RETENTION_MONTHS:
+                archived = await asyncio.to_thread(
+                    archive_log_partitions, config.LOGS_RETENTION_MONTHS, config.LOGS_ARCHIVE_DIR
+                )
+                for path in archived:
+                    log.info("Archived logs partition to %s", path)
+        except (storage.Error, OSError) as e:
+            log.warning("Logs maintenance failed: %s", e)
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+
+async def journal_replay_loop():
+    while True:
+        try:
+            replayed = await journal.replay()
+        except journal.DatabaseUnavailable:
+            replayed = {}
+        except (storage.Error, OSError) as e:
+            log.warning("Journal replay failed: %s", e)
+            replayed = {}
+        # Кэш агрегатов этих пользователей вёлся приблизительно — дальше берём из БД
+        # (в журнале бывают и ответы в группах от чужих пользователей — их кэш не наш)
+        for user_id, totals in replayed.items():
+            if owns_user(user_id):
+                user_progress[user_id] = totals
+        await asyncio.sleep(journal.REPLAY_INTERVAL)
+
+
+@router.error(ExceptionTypeFilter(storage.Error, journal.DatabaseUnavailable))
+async def database_error_handler(event: types.ErrorEvent):
+    log.warning("Database error in handler: %s", event.exception)
+    update = event.update
+    # Колбэк из групповой викторины — предупреждение в группу, а не в личку участнику
+    callback = update.callback_query
+    chat_id = (
+        update.message.chat.id if update.message else
+        callback.message.chat.id if callback and callback.message else
+        callback.from_user.id if callback else None
+    )
+    if chat_id is not None:
+        await bot.send_message(chat_id, "⚠️ База данных временно недоступна. Попробуйте чуть позже.")
+
+
+@router.startup()
+async def on_startup():
+    global restored_texts, restored_sessions
+    # Пока main() грузил схему и банк, проверки отвечал временный сервер (health.start_early);
+    # /readyz — 503 до конца этой функции
+    await health.start()
+    # Перезапущенный после падения воркер не поднимает сессии остановки заново: после неё
+    # пользователи уже отвечали, и снимок устарел
+    if restore_checkpoint:
+        restored_texts, restored_sessions = await health.timed("checkpoint", asyncio.to_thread(
+            checkpoint.load, checkpoint_path("*", checkpoint.CLAIMED)
+        ))
+    # Файлы всех воркеров прошлого запуска: берём только своих пользователей
+    # (число воркеров могло измениться — пользователь мог переехать)
+    restored_sessions = {user_id: s for user_id, s in restored_sessions.items() if owns_user(user_id)}
+    if restored_sessions:
+        log.info("Checkpoint: %d sessions to restore", len(restored_sessions))
+    else:
+        restored_texts = []
+    # kill -USR1 <pid> — профиль на PROFILE_SIGNAL_SECONDS в PROFILE_DIR; в многопроцессном режиме
+    # сигнал супервизору он пересылает всем воркерам, pid воркера — профиль только этого воркера
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, start_profile, config.PROFILE_SIGNAL_SECONDS
+        )
+    except (NotImplementedError, AttributeError):
+        pass  # Windows
+    capture.start()
+    # Фазы старта независимы друг от друга — идут параллельно, время каждой видно в /readyz
+    await asyncio.gather(
+        health.timed("bank_sizes", banks.refresh_sizes()),
+        health.timed("difficulty", asyncio.to_thread(difficulty.load)),
+        health.timed("leaderboard", asyncio.to_thread(leaderboard.load)),
+    )
+    background_tasks.add(asyncio.create_task(difficulty.flush_loop()))
+    background_tasks.add(asyncio.create_task(leaderboard.flush_loop()))
+    background_tasks.add(asyncio.create_task(broadcast.users_flush_loop()))
+    background_tasks.add(asyncio.create_task(bank_maintenance_loop()))
+    background_tasks.add(asyncio.create_task(journal.flush_loop()))
+    background_tasks.add(asyncio.create_task(journal_replay_loop()))
+    # Обслуживание журнала нужно в одном экземпляре: в многопроцессном режиме — в воркере 0
+    if config.WORKER_INDEX == 0:
+        background_tasks.add(asyncio.create_task(logs_maintenance_loop()))
+        await health.timed("broadcasts", broadcast.resume_all(bot))
+    health.set_ready()
+
+
+@router.shutdown()
+async def on_shutdown():
+    # Приём апдейтов уже остановлен (aiogram по SIGTERM/SIGINT или супервизор):
+    # даём дообработаться текущим апдейтам, дописываем данные и сохраняем сессии
+    health.ready = False
+    await drain_inflight(DRAIN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    broadcast.stop_all()
+    # Ответы на открытые вопросы групповых викторин записываем (или в журнал, если БД недоступна)
+    for chat_id in list(group_quizzes):
+        await stop_group_quiz(chat_id)
+    await journal.flush()
+    try:
+        await difficulty.flush()
+    except storage.Error as e:
+        log.warning("Final difficulty flush failed: %s", e)
+    try:
+        await leaderboard.flush()
+    except storage.Error as e:
+        log.warning("Final leaderboard flush failed: %s", e)
+    try:
+        await broadcast.flush_users()
+    except storage.Error as e:
+        log.warning("Final users flush failed: %s", e)
+
+    # Сессии прошлого запуска, к которым пользователи так и не вернулись, переносим дальше
+    for user_id in list(restored_sessions):
+        await restore_session(user_id)
+    for exam in exam_sessions.values():
+        exam["timer"].cancel()
+    table, sessions = dump_sessions()
+    await asyncio.to_thread(checkpoint.save, checkpoint_path(), table, sessions)
+    log.info("Checkpoint: saved %d sessions", len(sessions))
+    capture.stop()
+    await health.stop()
+
+
+def load_default_bank():
+    """
+    Схема и банк по умолчанию загружаются параллельно. Если init_db как раз мигрирует
+    таблицу questions (первый запуск новой версии) и чтение не удалось, банк читается
+    заново после миграции.
+    """
+    with ThreadPoolExecutor(2) as pool:
+        schema = pool.submit(health.timed_call, "schema", init_db)
+        bank = pool.submit(health.timed_call, "bank", load_questions, config.DEFAULT_BANK)
+        schema.result()
+        try:
+            questions = bank.result()
+        except storage.Error as e:
+            log.info("Bank load raced the schema migration (%s), reloading", e)
+            questions = health.timed_call("bank", load_questions, config.DEFAULT_BANK)
+    set_question_bank(questions)
+
+
 def main():
-    init_db()
-    global questions
-    questions = load_questions_from_postgres()
+    health.record("imports", health.elapsed_ms())
+    if hasattr(signal, "SIGUSR1"):
+        # До обработчика (on_startup или цикл супервизора) SIGUSR1 по умолчанию завершил бы процесс
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    health.start_early()
+    try:
+        restored = checkpoint.claim(config.CHECKPOINT_DIR)
+        if restored:
+            log.info("Checkpoint: %d files claimed for restore", restored)
+        load_default_bank()
+    finally:
+        health.stop_early()
+    if config.WORKERS > 1:
+        import supervisor
+        app_name = os.path.splitext(os.path.basename(__file__))[0]
+        supervisor.run(app_name, config.WORKERS, banks.loaded[config.DEFAULT_BANK].questions, bot.token)
+        return
     dp.include_router(router)
     dp.run_polling(bot)
 
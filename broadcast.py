@@ -0,0 +1,160 @@
+"""
+Рассылка сообщения всем пользователям.
+
+Задание хранится в Postgres (broadcasts), получатели читаются пачками через серверный курсор,
+отправка идёт с ограничением скорости и параллелизма, результат по каждому получателю
+и точка возобновления сохраняются после каждой пачки. После рестарта незавершённые
+рассылки продолжаются с последней сохранённой пачки (resume_all).
+
+Получатели — таблица users: все, кто писал боту в личке. Новые пользователи копятся
+в памяти (remember) и раз в USERS_FLUSH_INTERVAL секунд дописываются одним запросом;
+/reset эту таблицу не трогает, поэтому рассылку получают и те, кто сбросил статистику.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+
+import config
+import storage
+from storage import (
+    users_add, broadcast_get, broadcast_list, broadcast_open_recipients,
+    broadcast_fetch_recipients, broadcast_close_recipients, broadcast_save_progress, broadcast_finish
+)
+
+BATCH_SIZE = 100
+CONCURRENCY = 4
+USERS_FLUSH_INTERVAL = 30
+
+log = logging.getLogger("broadcast")
+
+running = {}  # broadcast_id -> asyncio.Task
+known_users = set()    # уже записаны в users (или ждут записи) — в этом процессе
+pending_users = set()  # ещё не записаны
+
+
+def remember(user_id: int) -> None:
+    if user_id not in known_users:
+        known_users.add(user_id)
+        pending_users.add(user_id)
+
+
+async def flush_users() -> None:
+    if not pending_users:
+        return
+    batch = sorted(pending_users)
+    pending_users.clear()
+    try:
+        await asyncio.to_thread(users_add, batch)
+    except storage.Error:
+        pending_users.update(batch)  # запишем в следующий раз
+        raise
+
+
+async def users_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(USERS_FLUSH_INTERVAL)
+        try:
+            await flush_users()
+        except storage.Error as e:
+            log.warning("Users flush failed: %s", e)
+
+
+async def _send_one(bot, user_id: int, text: str, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        while True:
+            try:
+                await bot.send_message(user_id, text)
+                return user_id, "sent", None
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError as e:
+                return user_id, "blocked", str(e)
+            except TelegramAPIError as e:
+                return user_id, "failed", str(e)
+
+
+def _close_recipients(opened) -> None:
+    # В потоке курсора, после открытия и выборок: курсор мог так и не открыться
+    if not opened.cancelled() and opened.exception() is None:
+        broadcast_close_recipients(opened.result())
+
+
+async def _run(bot, broadcast_id: int):
+    job = await asyncio.to_thread(broadcast_get, broadcast_id)
+    if not job or job["status"] != "running":
+        return
+
+    interval = 1 / config.BROADCAST_RATE
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    # Курсор живёт в одном своём потоке: при отмене задачи посреди выборки закрытие
+    # встаёт в очередь за ней, а не выполняется параллельно на том же соединении
+    cursor_thread = ThreadPoolExecutor(1, thread_name_prefix=f"broadcast-{broadcast_id}")
+    opened = cursor_thread.submit(broadcast_open_recipients, broadcast_id, job["last_user_id"])
+    try:
+        recipients = await asyncio.wrap_future(opened)
+        while True:
+            batch = await loop.run_in_executor(cursor_thread, broadcast_fetch_recipients, recipients, BATCH_SIZE)
+            if not batch:
+                break
+            sends = []
+            for user_id in batch:
+                sends.append(asyncio.create_task(_send_one(bot, user_id, job["text"], semaphore)))
+                await asyncio.sleep(interval)
+            results = await asyncio.gather(*sends)
+            status = await asyncio.to_thread(broadcast_save_progress, broadcast_id, results, batch[-1])
+            if status != "running":
+                log.info("Broadcast %s stopped: %s", broadcast_id, status)
+                return
+    finally:
+        # Без ожидания: отменённую задачу не держим, поток закроет курсор сам
+        cursor_thread.submit(_close_recipients, opened)
+        cursor_thread.shutdown(wait=False)
+
+    if await asyncio.to_thread(broadcast_finish, broadcast_id, "done"):
+        job = await asyncio.to_thread(broadcast_get, broadcast_id)
+        log.info("Broadcast %s done: sent %s, failed %s", broadcast_id, job["sent"], job["failed"])
+        if job["created_by"]:
+            try:
+                await bot.send_message(job["created_by"], format_status(job))
+            except TelegramAPIError:
+                pass
+
+
+def start(bot, broadcast_id: int) -> None:
+    if broadcast_id in running:
+        return
+    task = asyncio.create_task(_run(bot, broadcast_id))
+    running[broadcast_id] = task
+    task.add_done_callback(lambda t: _on_done(broadcast_id, t))
+
+
+def _on_done(broadcast_id: int, task: asyncio.Task) -> None:
+    running.pop(broadcast_id, None)
+    if not task.cancelled() and task.exception():
+        log.error("Broadcast %s crashed", broadcast_id, exc_info=task.exception())
+
+
+async def resume_all(bot) -> None:
+    """Продолжить рассылки, прерванные рестартом."""
+    for job in await asyncio.to_thread(broadcast_list, "running", 100):
+        log.info("Resuming broadcast %s from user %s", job["id"], job["last_user_id"])
+        start(bot, job["id"])
+
+
+def stop_all() -> None:
+    # Задания остаются в статусе running и будут продолжены после рестарта
+    for task in list(running.values()):
+        task.cancel()
+
+
+def format_status(job) -> str:
+    done = job["sent"] + job["failed"]
+    percent = round(done / job["total"] * 100, 1) if job["total"] else 100.0
+    return (
+        f"📣 <b>Рассылка #{job['id']}</b> — {job['status']}\n"
+        f"Обработано: <b>{done}</b> из {job['total']} ({percent}%)\n"
+        f"Доставлено: <b>{job['sent']}</b>, ошибок: <b>{job['failed']}</b>"
+    )
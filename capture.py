@@ -0,0 +1,80 @@
+"""
+Запись потока апдейтов для воспроизведения (python replay.py, см. там).
+
+Включается переменной CAPTURE_DIR. Каждый апдейт после обработки пишется строкой JSON
+в capture-<воркер>.jsonl:
+    {"t": время получения (unix), "ms": время обработки, "worker": индекс воркера,
+     "update": апдейт в том виде, в каком он пришёл от Telegram, "error": тип исключения}
+Файл ротируется по CAPTURE_MAX_BYTES (capture-0.jsonl.1, .2, ...). В цикле событий
+остаются только json.dumps и постановка в очередь — запись на диск идёт в отдельном
+потоке (QueueHandler/QueueListener). В файл попадают сообщения пользователей, поэтому
+запись включают на время разбора проблемы, а не постоянно.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+import config
+
+_log = logging.getLogger("capture")
+_log.propagate = False
+_listener = None
+
+
+def path(index=None) -> str:
+    name = f"capture-{config.WORKER_INDEX if index is None else index}.jsonl"
+    return os.path.join(config.CAPTURE_DIR, name)
+
+
+def start() -> None:
+    global _listener
+    if not config.CAPTURE_DIR or _listener is not None:
+        return
+    os.makedirs(config.CAPTURE_DIR, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        path(), maxBytes=config.CAPTURE_MAX_BYTES, backupCount=config.CAPTURE_BACKUPS, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records = queue.SimpleQueue()
+    _log.addHandler(logging.handlers.QueueHandler(records))
+    _log.setLevel(logging.INFO)
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+
+def stop() -> None:
+    """Дописывает очередь и закрывает файл."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    for handler in list(_log.handlers):
+        _log.removeHandler(handler)
+    _listener = None
+
+
+async def middleware(handler, event, data):
+    received = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        return await handler(event, data)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        if _listener is not None:
+            record = {
+                "t": round(received, 3),
+                "ms": round((time.perf_counter() - started) * 1000, 2),
+                "worker": config.WORKER_INDEX,
+                "update": event.model_dump(mode="json", exclude_none=True, by_alias=True),
+            }
+            if error:
+                record["error"] = error
+            _log.info(json.dumps(record, ensure_ascii=False))
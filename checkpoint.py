@@ -0,0 +1,102 @@
+"""
+Контрольная точка пользовательских сессий между рестартами.
+
+Формат — gzip JSON: {"saved_at", "texts": [...], "sessions": {user_id: {...}}}.
+Тексты вопросов вынесены в общую таблицу строк, в сессиях — только индексы в ней,
+поэтому файл остаётся компактным даже при больших множествах просмотренных вопросов.
+Запись атомарная (временный файл + os.replace).
+
+Файлы читаются один раз: при старте claim() переименовывает контрольные точки остановки
+в restore-*, воркеры восстанавливают сессии из них, а следующий claim() их удаляет. После
+падения (контрольная точка не записана) восстанавливать нечего — сессии прошлого
+запуска второй раз не поднимаются.
+"""
+import glob
+import gzip
+import json
+import os
+import time
+
+MAX_AGE = 24 * 60 * 60  # более старые контрольные точки не восстанавливаем
+# Файлы одной остановки пишутся почти одновременно; заметно более старые — остатки
+# прошлых запусков с другим числом воркеров
+SAME_RUN_WINDOW = 60
+SAVED = "checkpoint"   # пишется при остановке
+CLAIMED = "restore"    # забран при старте, читается воркерами этого запуска
+
+
+class TextTable:
+    """Таблица строк: текст -> индекс при сохранении."""
+
+    def __init__(self):
+        self.texts = []
+        self._index = {}
+
+    def ref(self, text):
+        if text is None:
+            return None
+        i = self._index.get(text)
+        if i is None:
+            i = self._index[text] = len(self.texts)
+            self.texts.append(text)
+        return i
+
+
+def path(directory: str, index, kind: str = SAVED) -> str:
+    return os.path.join(directory, f"{kind}-{index}.json.gz")
+
+
+def claim(directory: str) -> int:
+    """
+    Забирает контрольные точки последней остановки для этого запуска (вызывается один раз,
+    до старта воркеров). Оставшиеся от прошлого запуска restore-* уже были восстановлены — удаляются.
+    """
+    for stale in glob.glob(path(directory, "*", CLAIMED)):
+        os.remove(stale)
+    saved = glob.glob(path(directory, "*"))
+    for src in saved:
+        index = os.path.basename(src)[len(SAVED) + 1:-len(".json.gz")]
+        os.replace(src, path(directory, index, CLAIMED))
+    return len(saved)
+
+
+def save(path: str, texts: TextTable, sessions: dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    payload = {"saved_at": time.time(), "texts": texts.texts, "sessions": sessions}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            f.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode())
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+
+
+def load(pattern: str):
+    """
+    Читает все файлы по шаблону (забранные claim; в многопроцессном режиме у каждого воркера свой).
+    Возвращает (texts, {user_id: session}); устаревшие и битые файлы пропускаются.
+    """
+    payloads = []
+    for path in glob.glob(pattern):
+        try:
+            with gzip.open(path, "rb") as f:
+                payloads.append(json.loads(f.read()))
+        except (OSError, ValueError):
+            continue
+    if not payloads:
+        return [], {}
+    newest = max(p.get("saved_at", 0) for p in payloads)
+
+    texts = []
+    sessions = {}
+    for payload in payloads:
+        saved_at = payload.get("saved_at", 0)
+        if time.time() - saved_at > MAX_AGE or newest - saved_at > SAME_RUN_WINDOW:
+            continue
+        offset = len(texts)
+        texts.extend(payload["texts"])
+        for user_id, session in payload["sessions"].items():
+            session["text_offset"] = offset
+            sessions[int(user_id)] = session
+    return texts, sessions
@@ -6,8 +6,63 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BOT_TOKEN_TEST = os.getenv("BOT_TOKEN_TEST")
+# Хранилище: postgres (по умолчанию) или sqlite — встроенная база в файле SQLITE_PATH
+DB_BACKEND = os.getenv("DB_BACKEND", "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "state/deadright.db")
 DB_HOST = os.getenv("DB_HOST")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
-DB_PORT = int(os.getenv("DB_PORT", 3306))
\ No newline at end of file
+DB_PORT = int(os.getenv("DB_PORT", 5432))
+# Таймаут подключения к БД, секунд
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))
+# Запросы бота на горячем пути дольше DB_TIMEOUT секунд считаются сбоем; после
+# DB_BREAKER_THRESHOLD сбоев подряд бот на DB_BREAKER_RESET секунд уходит в автономный режим
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", 2))
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", 3))
+DB_BREAKER_RESET = float(os.getenv("DB_BREAKER_RESET", 15))
+# Таймаут запросов по истории ответов (/week, /stats, /errors) — они тяжелее горячего пути
+HISTORY_DB_TIMEOUT = float(os.getenv("HISTORY_DB_TIMEOUT", 10))
+
+# Число процессов-воркеров; при WORKERS > 1 бот запускается через supervisor.py
+WORKERS = int(os.getenv("WORKERS", 1))
+# Номер воркера (выставляет supervisor.py); фоновые задачи обслуживания идут только в воркере 0
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+
+# Журнал ответов: помесячные партиции старше LOGS_RETENTION_MONTHS уходят в архив (0 — хранить всё)
+LOGS_RETENTION_MONTHS = int(os.getenv("LOGS_RETENTION_MONTHS", 0))
+LOGS_ARCHIVE_DIR = os.getenv("LOGS_ARCHIVE_DIR", "archive")
+# Глубина истории для /stats и /errors в днях
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", 365))
+
+# Администраторы бота (id через запятую): рассылки и служебные команды
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# Скорость рассылки, сообщений в секунду (лимит Telegram ~30/с на бота — оставляем запас)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 20))
+
+# Время на один вопрос в режиме экзамена (/exam), секунд
+EXAM_SECONDS_PER_QUESTION = int(os.getenv("EXAM_SECONDS_PER_QUESTION", 60))
+# Групповая викторина (/quiz): время на вопрос и минимальный интервал между правками счётчика, секунд
+GROUP_QUESTION_SECONDS = int(os.getenv("GROUP_QUESTION_SECONDS", 30))
+GROUP_EDIT_INTERVAL = float(os.getenv("GROUP_EDIT_INTERVAL", 3))
+
+# Каталог для контрольной точки сессий (сохраняется при остановке, читается при старте)
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "state")
+# Профилирование (/profile N, SIGUSR1): каталог для дампов и длительность сессии по сигналу, секунд
+PROFILE_DIR = os.getenv("PROFILE_DIR", "logs")
+PROFILE_SIGNAL_SECONDS = int(os.getenv("PROFILE_SIGNAL_SECONDS", 30))
+# Банки вопросов: банк по умолчанию и через сколько секунд простоя банк выгружается из памяти
+DEFAULT_BANK = os.getenv("DEFAULT_BANK", "main")
+BANK_IDLE_SECONDS = int(os.getenv("BANK_IDLE_SECONDS", 30 * 60))
+# Локальный журнал ответов на время недоступности БД (доигрывается, когда БД вернётся)
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "state")
+# Запись потока апдейтов для воспроизведения (replay.py): каталог (пусто — запись выключена),
+# размер файла до ротации и сколько старых файлов хранить
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "")
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", 50 * 1024 * 1024))
+CAPTURE_BACKUPS = int(os.getenv("CAPTURE_BACKUPS", 5))
+# HTTP-проверки /healthz и /readyz (health.py): адрес, порт (0 — выключены; воркер N слушает
+# HEALTH_PORT + N) и задержка цикла событий, после которой процесс считается зависшим, секунд
+HEALTH_HOST = os.getenv("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", 8080))
+HEALTH_MAX_LAG = float(os.getenv("HEALTH_MAX_LAG", 5))
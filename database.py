@@ -1,17 +1,193 @@
 import psycopg2
 import psycopg2.extras
-from datetime import datetime
+import gzip
+import os
+import re
+import uuid
+from datetime import date, datetime
 import config
 
+__all__ = [
+    "Error", "CONNECTION_ERRORS",
+    "ping", "init_db", "load_questions", "insert_questions", "get_question_history_counts", "merge_duplicate_question",
+    "update_correct_answers",
+    "get_bank_sizes", "get_user_bank", "set_user_bank",
+    "ensure_log_partitions", "archive_log_partitions",
+    "blacklist_add", "blacklist_remove", "blacklist_remove_many", "blacklist_is_blocked", "blacklist_list",
+    "blacklist_clear",
+    "record_answer", "record_exam_attempt", "replay_answers", "get_user_totals",
+    "get_user_daily_stats", "get_user_wrong_answers", "get_mistake_questions", "reset_user_stats",
+    "question_totals_load", "question_totals_add", "iter_question_difficulty",
+    "leaderboard_add", "leaderboard_load", "leaderboard_prune",
+    "users_add", "broadcast_create", "broadcast_get", "broadcast_list", "broadcast_open_recipients",
+    "broadcast_fetch_recipients", "broadcast_close_recipients", "broadcast_save_progress", "broadcast_finish",
+]
+
+Error = psycopg2.Error
+# Connection loss, server shutdown, statement timeout
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
 def get_connection():
     return psycopg2.connect(
         host=config.DB_HOST,
         port=config.DB_PORT,
         user=config.DB_USER,
         password=config.DB_PASSWORD,
-        dbname=config.DB_NAME
+        dbname=config.DB_NAME,
+        connect_timeout=config.DB_CONNECT_TIMEOUT
     )
 
+def ping() -> None:
+    """Проверка связи с БД (для /readyz)."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT 1")
+
+QUESTION_OPTION_COLUMNS = ('option_a', 'option_b', 'option_c', 'option_d', 'option_e')
+
+
+def load_questions(bank=None):
+    """Вопросы одного банка (или всех, если bank не указан)."""
+    with get_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT id, question, option_a, option_b, option_c, option_d, option_e, correct_answer, bank
+                FROM questions
+                WHERE %(bank)s IS NULL OR bank = %(bank)s
+            """, {"bank": bank})
+            result = cursor.fetchall()
+
+            all_qs = []
+            for row in result:
+                options = [row[k] for k in QUESTION_OPTION_COLUMNS if row[k]]
+                all_qs.append({
+                    "id": row["id"],
+                    "question": row["question"],
+                    "options": options,
+                    "correct": row["correct_answer"],
+                    "bank": row["bank"]
+                })
+
+    return all_qs
+
+
+def insert_questions(items) -> int:
+    """Добавить вопросы в банк (существующие тексты пропускаются); возвращает число добавленных."""
+    rows = []
+    for q in items:
+        options = (list(q["options"]) + [None] * len(QUESTION_OPTION_COLUMNS))[:len(QUESTION_OPTION_COLUMNS)]
+        rows.append((q["question"], *options, q["correct"], q.get("bank") or config.DEFAULT_BANK))
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            inserted = psycopg2.extras.execute_values(c, """
+                INSERT INTO questions (question, option_a, option_b, option_c, option_d, option_e, correct_answer, bank)
+                VALUES %s
+                ON CONFLICT (question) DO NOTHING
+                RETURNING 1
+            """, rows, fetch=True)
+            return len(inserted)
+
+
+def update_correct_answers(fixes) -> int:
+    """
+    Sets correct_answer for [(question_id, option_text, option_ordinal)] and re-encodes
+    the logs rows of those questions that kept the correct answer as text.
+    Returns the number of re-encoded rows.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            psycopg2.extras.execute_values(c, """
+                UPDATE questions q SET correct_answer = v.correct
+                FROM (VALUES %s) AS v (id, correct, ordinal)
+                WHERE q.id = v.id
+            """, fixes)
+            c.execute("""
+                UPDATE logs l SET correct_option = v.ordinal, correct_answer = NULL
+                FROM unnest(%s::int[], %s::smallint[]) AS v (id, ordinal)
+                WHERE l.question_id = v.id AND l.correct_option IS NULL
+            """, ([f[0] for f in fixes], [f[2] for f in fixes]))
+            return c.rowcount
+
+
+def get_question_history_counts(questions) -> dict:
+    """Число пользователей с историей (stats) по каждому из вопросов."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT question, COUNT(*)
+                FROM stats
+                WHERE question = ANY(%s)
+                GROUP BY question
+            """, (list(questions),))
+            return dict(c.fetchall())
+
+
+def merge_duplicate_question(survivor: str, duplicate: str) -> None:
+    """
+    Moves all history of `duplicate` onto `survivor` (stats and global
+    counters are summed, logs and blacklist re-pointed) and removes `duplicate` from the
+    bank, in one transaction. user_totals.seen is corrected for users who
+    had seen both, user_bank_totals is moved to the survivor's bank.
+    """
+    params = {"s": survivor, "d": duplicate}
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                UPDATE user_totals t SET seen = t.seen - 1
+                FROM stats a
+                JOIN stats b ON b.user_id = a.user_id AND b.question = %(s)s
+                WHERE a.question = %(d)s AND t.user_id = a.user_id
+            """, params)
+            c.execute("""
+                UPDATE user_bank_totals t SET seen = t.seen - 1
+                FROM stats a
+                JOIN questions q ON q.question = a.question
+                WHERE a.question = %(d)s AND t.user_id = a.user_id AND t.bank = q.bank
+            """, params)
+            c.execute("""
+                INSERT INTO user_bank_totals (user_id, bank, seen)
+                SELECT a.user_id, q.bank, 1
+                FROM stats a
+                JOIN questions q ON q.question = %(s)s
+                WHERE a.question = %(d)s
+                  AND NOT EXISTS (SELECT 1 FROM stats b WHERE b.user_id = a.user_id AND b.question = %(s)s)
+                ON CONFLICT (user_id, bank) DO UPDATE SET seen = user_bank_totals.seen + 1
+            """, params)
+            c.execute("""
+                INSERT INTO stats (user_id, question, shown, wrong)
+                SELECT user_id, %(s)s, shown, wrong
+                FROM stats
+                WHERE question = %(d)s
+                ON CONFLICT (user_id, question) DO UPDATE SET
+                    shown = stats.shown + EXCLUDED.shown,
+                    wrong = stats.wrong + EXCLUDED.wrong
+            """, params)
+            c.execute("DELETE FROM stats WHERE question = %(d)s", params)
+            # Ordinals of the duplicate point into its own options: back to text, then re-encode
+            c.execute(EXPAND_LOGS + " AND q.question = %(d)s", params)
+            c.execute("UPDATE logs SET question = %(s)s WHERE question = %(d)s", params)
+            c.execute(COMPACT_LOGS + " AND l.question = %(s)s", params)
+            c.execute("""
+                INSERT INTO user_blocked_questions (user_id, question)
+                SELECT user_id, %(s)s
+                FROM user_blocked_questions
+                WHERE question = %(d)s
+                ON CONFLICT (user_id, question) DO NOTHING
+            """, params)
+            c.execute("DELETE FROM user_blocked_questions WHERE question = %(d)s", params)
+            c.execute("""
+                INSERT INTO question_totals (question, answered, correct)
+                SELECT %(s)s, answered, correct
+                FROM question_totals
+                WHERE question = %(d)s
+                ON CONFLICT (question) DO UPDATE SET
+                    answered = question_totals.answered + EXCLUDED.answered,
+                    correct = question_totals.correct + EXCLUDED.correct
+            """, params)
+            c.execute("DELETE FROM question_totals WHERE question = %(d)s", params)
+            c.execute("DELETE FROM questions WHERE question = %(d)s", params)
+
+
 def init_db():
     with get_connection() as conn:
         conn.autocommit = True
@@ -27,16 +203,77 @@ def init_db():
                 )
             """)
 
-            # Log of answers
+            # Question banks (topics): every question belongs to one bank.
+            # id is the compact reference to the question in logs
+            c.execute("SELECT to_regclass('questions') IS NOT NULL")
+            has_questions = c.fetchone()[0]
+            if has_questions:
+                c.execute("ALTER TABLE questions ADD COLUMN IF NOT EXISTS bank TEXT NOT NULL DEFAULT %s",
+                          (config.DEFAULT_BANK,))
+                c.execute("CREATE INDEX IF NOT EXISTS questions_bank_idx ON questions (bank)")
+                c.execute("ALTER TABLE questions ADD COLUMN IF NOT EXISTS id SERIAL")
+                c.execute("CREATE UNIQUE INDEX IF NOT EXISTS questions_id_idx ON questions (id)")
+
+            # Log of answers: partitioned by month, see init_logs()
+            init_logs(c, backfill=has_questions)
+
+            # Per-user aggregates: maintained in the same write as the answer
+            c.execute("SELECT to_regclass('user_totals') IS NULL")
+            backfill_totals = c.fetchone()[0]
             c.execute("""
-                CREATE TABLE IF NOT EXISTS logs (
-                    id BIGSERIAL PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS user_totals (
+                    user_id BIGINT PRIMARY KEY,
+                    total BIGINT NOT NULL DEFAULT 0,
+                    correct BIGINT NOT NULL DEFAULT 0,
+                    seen INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            if backfill_totals:
+                c.execute("""
+                    INSERT INTO user_totals (user_id, total, correct, seen)
+                    SELECT s.user_id, COALESCE(l.total, 0), COALESCE(l.correct, 0), s.seen
+                    FROM (
+                        SELECT user_id, COUNT(*) AS seen
+                        FROM stats
+                        WHERE shown > 0
+                        GROUP BY user_id
+                    ) s
+                    LEFT JOIN (
+                        SELECT user_id,
+                               COUNT(*) AS total,
+                               COUNT(*) FILTER (WHERE is_correct) AS correct
+                        FROM logs
+                        GROUP BY user_id
+                    ) l USING (user_id)
+                    ON CONFLICT (user_id) DO NOTHING
+                """)
+
+            # Seen questions per user and bank (the "not answered yet" line of /progress)
+            c.execute("SELECT to_regclass('user_bank_totals') IS NULL")
+            backfill_bank_totals = c.fetchone()[0]
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS user_bank_totals (
                     user_id BIGINT NOT NULL,
-                    question TEXT,
-                    user_answer TEXT,
-                    correct_answer TEXT,
-                    is_correct BOOLEAN NOT NULL,
-                    answered_at DATE NOT NULL
+                    bank TEXT NOT NULL,
+                    seen INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, bank)
+                )
+            """)
+            if backfill_bank_totals:
+                c.execute("""
+                    INSERT INTO user_bank_totals (user_id, bank, seen)
+                    SELECT s.user_id, q.bank, COUNT(*)
+                    FROM stats s
+                    JOIN questions q ON q.question = s.question
+                    WHERE s.shown > 0
+                    GROUP BY s.user_id, q.bank
+                    ON CONFLICT (user_id, bank) DO NOTHING
+                """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS user_banks (
+                    user_id BIGINT PRIMARY KEY,
+                    bank TEXT NOT NULL
                 )
             """)
 
@@ -49,6 +286,348 @@ def init_db():
                 )
             """)
 
+            # Global per-question counters (difficulty); incremented via batched deltas
+            c.execute("SELECT to_regclass('question_totals') IS NULL")
+            backfill_question_totals = c.fetchone()[0]
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS question_totals (
+                    question TEXT PRIMARY KEY,
+                    answered BIGINT NOT NULL DEFAULT 0,
+                    correct BIGINT NOT NULL DEFAULT 0
+                )
+            """)
+            if backfill_question_totals:
+                c.execute("""
+                    INSERT INTO question_totals (question, answered, correct)
+                    SELECT question, SUM(shown), SUM(shown - wrong)
+                    FROM stats
+                    GROUP BY question
+                    ON CONFLICT (question) DO NOTHING
+                """)
+
+            # Weekly leaderboard counters; updated_at lets workers pick up each other's changes
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS leaderboard (
+                    week DATE NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    answered INTEGER NOT NULL DEFAULT 0,
+                    correct INTEGER NOT NULL DEFAULT 0,
+                    name TEXT,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (week, user_id)
+                )
+            """)
+            c.execute("CREATE INDEX IF NOT EXISTS leaderboard_updated_idx ON leaderboard (week, updated_at)")
+
+            # Mock exam attempts (answers themselves go to stats/logs)
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS exam_attempts (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    started_at TIMESTAMPTZ NOT NULL,
+                    finished_at TIMESTAMPTZ NOT NULL,
+                    total INTEGER NOT NULL,
+                    answered INTEGER NOT NULL,
+                    correct INTEGER NOT NULL,
+                    timed_out BOOLEAN NOT NULL DEFAULT FALSE
+                )
+            """)
+
+            # Everyone who has used the bot in a private chat: broadcast recipients.
+            # Not touched by /reset, unlike the answer aggregates
+            c.execute("SELECT to_regclass('users') IS NULL")
+            backfill_users = c.fetchone()[0]
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    first_seen TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            if backfill_users:
+                c.execute("""
+                    INSERT INTO users (user_id)
+                    SELECT user_id FROM user_totals
+                    UNION SELECT user_id FROM user_banks
+                    UNION SELECT user_id FROM user_blocked_questions
+                    UNION SELECT DISTINCT user_id FROM stats
+                    ON CONFLICT (user_id) DO NOTHING
+                """)
+
+            # Broadcasts: the job and per-recipient delivery status
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id BIGSERIAL PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    created_by BIGINT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    finished_at TIMESTAMPTZ,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    last_user_id BIGINT NOT NULL DEFAULT 0
+                )
+            """)
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                    broadcast_id BIGINT NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+                    user_id BIGINT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    PRIMARY KEY (broadcast_id, user_id)
+                )
+            """)
+
+
+# ======= Банки вопросов =======
+
+def get_bank_sizes() -> dict:
+    """Банки и число вопросов в них: {bank: count}."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT bank, COUNT(*) FROM questions GROUP BY bank")
+            return dict(c.fetchall())
+
+
+def get_user_bank(user_id: int):
+    """Выбранный пользователем банк или None."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT bank FROM user_banks WHERE user_id = %s", (user_id,))
+            row = c.fetchone()
+            return row[0] if row else None
+
+
+def set_user_bank(user_id: int, bank: str) -> None:
+    with get_connection() as conn:
+        conn.autocommit = True
+        with conn.cursor() as c:
+            c.execute("""
+                INSERT INTO user_banks (user_id, bank)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET bank = EXCLUDED.bank
+            """, (user_id, bank))
+
+
+# ======= Партиционированный журнал ответов =======
+
+LOG_PARTITION_RE = re.compile(r"^logs_y(\d{4})m(\d{2})$")
+
+
+def _add_months(month: date, n: int) -> date:
+    y, m = divmod(month.month - 1 + n, 12)
+    return date(month.year + y, m + 1, 1)
+
+
+def _log_partition_name(month: date) -> str:
+    return f"logs_y{month.year}m{month.month:02d}"
+
+
+def _create_log_partitions(c, first: date, last: date) -> None:
+    """Create monthly partitions of logs covering [first, last] (by month)."""
+    month = first.replace(day=1)
+    while month <= last:
+        c.execute(f"""
+            CREATE TABLE IF NOT EXISTS {_log_partition_name(month)}
+            PARTITION OF logs
+            FOR VALUES FROM (%s) TO (%s)
+        """, (month, _add_months(month, 1)))
+        month = _add_months(month, 1)
+
+
+def init_logs(c, months_ahead: int = 2, backfill: bool = True) -> None:
+    """
+    Creates logs as a table partitioned by month on answered_at.
+    An old unpartitioned logs table is migrated in place, keeping ids,
+    and rows written before the compact encoding are converted (see _compact_logs).
+    """
+    c.execute("""
+        SELECT relkind FROM pg_class
+        WHERE oid = to_regclass('logs')
+    """)
+    row = c.fetchone()
+    relkind = row[0] if row else None
+    if relkind == "p":
+        ensure_log_partitions(c, months_ahead)
+    else:
+        _create_partitioned_logs(c, relkind, months_ahead)
+
+    # event_id makes answer writes idempotent: the bot's local journal (journal.py)
+    # may replay an answer that was in fact committed before a timeout
+    c.execute("ALTER TABLE logs ADD COLUMN IF NOT EXISTS event_id UUID")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS logs_event_id_idx ON logs (event_id, answered_at)")
+
+    c.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'logs' AND column_name = 'question_id'
+    """)
+    if c.fetchone() is None:
+        _compact_logs(c, backfill)
+
+
+def _option_ordinal_sql(column: str) -> str:
+    """
+    SQL for the ordinal of the text in logs.<column> among the non-empty options of
+    the question q (the order of load_questions()["options"]); NULL if not found.
+    """
+    whens = []
+    for i, option in enumerate(QUESTION_OPTION_COLUMNS):
+        before = " + ".join(
+            f"(CASE WHEN q.{prev} <> '' THEN 1 ELSE 0 END)" for prev in QUESTION_OPTION_COLUMNS[:i]
+        ) or "0"
+        whens.append(f"WHEN q.{option} <> '' AND trim(q.{option}) = trim(l.{column}) THEN {before}")
+    return "CASE " + " ".join(whens) + " END"
+
+
+def _option_text_sql(column: str) -> str:
+    """SQL for the text of the option with ordinal logs.<column> (inverse of _option_ordinal_sql)."""
+    whens = []
+    for i, option in enumerate(QUESTION_OPTION_COLUMNS):
+        before = " + ".join(
+            f"(CASE WHEN q.{prev} <> '' THEN 1 ELSE 0 END)" for prev in QUESTION_OPTION_COLUMNS[:i]
+        ) or "0"
+        whens.append(f"WHEN q.{option} <> '' AND l.{column} = {before} THEN q.{option}")
+    return "CASE " + " ".join(whens) + " END"
+
+
+# Text rows -> question id + option ordinals; text stays only where it did not resolve
+COMPACT_LOGS = f"""
+    UPDATE logs l SET
+        question_id = q.id,
+        question = NULL,
+        user_option = {_option_ordinal_sql("user_answer")},
+        correct_option = {_option_ordinal_sql("correct_answer")},
+        user_answer = CASE WHEN {_option_ordinal_sql("user_answer")} IS NULL THEN l.user_answer END,
+        correct_answer = CASE WHEN {_option_ordinal_sql("correct_answer")} IS NULL THEN l.correct_answer END
+    FROM questions q
+    WHERE q.question = l.question AND l.question_id IS NULL
+"""
+
+# The reverse, for rows whose question is about to disappear (merge_duplicate_question)
+EXPAND_LOGS = f"""
+    UPDATE logs l SET
+        question_id = NULL,
+        question = q.question,
+        user_answer = COALESCE(l.user_answer, {_option_text_sql("user_option")}),
+        correct_answer = COALESCE(l.correct_answer, {_option_text_sql("correct_option")}),
+        user_option = NULL,
+        correct_option = NULL,
+        seed = NULL
+    FROM questions q
+    WHERE q.id = l.question_id
+"""
+
+
+def _compact_logs(c, backfill: bool) -> None:
+    """
+    Compact answer encoding: question id, the chosen and the correct option as ordinals
+    in the bank's option list, the exact time and the seed of the shown permutation,
+    instead of three repeated texts per row. Existing rows are converted in the same
+    transaction; the space they free is reused by new rows (VACUUM FULL logs returns
+    it to the OS).
+    """
+    c.execute("BEGIN")
+    c.execute("""
+        ALTER TABLE logs
+            ADD COLUMN question_id INTEGER,
+            ADD COLUMN user_option SMALLINT,
+            ADD COLUMN correct_option SMALLINT,
+            ADD COLUMN seed INTEGER,
+            ADD COLUMN answered_ts TIMESTAMPTZ
+    """)
+    if backfill:
+        c.execute(COMPACT_LOGS)
+    c.execute("COMMIT")
+
+
+def _create_partitioned_logs(c, relkind, months_ahead: int) -> None:
+    c.execute("BEGIN")
+    if relkind == "r":
+        c.execute("ALTER TABLE logs RENAME TO logs_legacy")
+        c.execute("ALTER TABLE logs_legacy RENAME CONSTRAINT logs_pkey TO logs_legacy_pkey")
+        c.execute("ALTER INDEX IF EXISTS logs_user_id_idx RENAME TO logs_legacy_user_id_idx")
+    c.execute("CREATE SEQUENCE IF NOT EXISTS logs_id_seq")
+    c.execute("""
+        CREATE TABLE logs (
+            id BIGINT NOT NULL DEFAULT nextval('logs_id_seq'),
+            user_id BIGINT NOT NULL,
+            question TEXT,
+            user_answer TEXT,
+            correct_answer TEXT,
+            is_correct BOOLEAN NOT NULL,
+            answered_at DATE NOT NULL,
+            PRIMARY KEY (id, answered_at)
+        ) PARTITION BY RANGE (answered_at)
+    """)
+    c.execute("ALTER SEQUENCE logs_id_seq OWNED BY logs.id")
+    c.execute("CREATE INDEX logs_user_id_idx ON logs (user_id, answered_at)")
+
+    first = date.today()
+    if relkind == "r":
+        c.execute("SELECT MIN(answered_at) FROM logs_legacy")
+        first = min(c.fetchone()[0] or first, first)
+    _create_log_partitions(c, first, _add_months(date.today().replace(day=1), months_ahead))
+    if relkind == "r":
+        c.execute("""
+            INSERT INTO logs (id, user_id, question, user_answer, correct_answer, is_correct, answered_at)
+            SELECT id, user_id, question, user_answer, correct_answer, is_correct, answered_at
+            FROM logs_legacy
+        """)
+        c.execute("DROP TABLE logs_legacy")
+    c.execute("COMMIT")
+
+
+def ensure_log_partitions(c=None, months_ahead: int = 2) -> None:
+    """Make sure partitions exist for the current month and `months_ahead` months ahead."""
+    first = date.today().replace(day=1)
+    last = _add_months(first, months_ahead)
+    if c is not None:
+        _create_log_partitions(c, first, last)
+        return
+    with get_connection() as conn:
+        conn.autocommit = True
+        with conn.cursor() as c:
+            _create_log_partitions(c, first, last)
+
+
+def archive_log_partitions(keep_months: int, archive_dir: str) -> list[str]:
+    """
+    Moves partitions older than `keep_months` months to gzip CSV files in
+    `archive_dir` and drops them. The file is fully written before the drop.
+    Returns the list of written files.
+    """
+    cutoff = _add_months(date.today().replace(day=1), -keep_months)
+    os.makedirs(archive_dir, exist_ok=True)
+    written = []
+    with get_connection() as conn:
+        conn.autocommit = True
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT child.relname
+                FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = 'logs'::regclass
+                ORDER BY child.relname
+            """)
+            for (name,) in c.fetchall():
+                m = LOG_PARTITION_RE.match(name)
+                if not m or date(int(m.group(1)), int(m.group(2)), 1) >= cutoff:
+                    continue
+                path = os.path.join(archive_dir, f"{name}.csv.gz")
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as raw:
+                    with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                        c.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                os.replace(tmp_path, path)
+                c.execute("BEGIN")
+                c.execute(f"ALTER TABLE logs DETACH PARTITION {name}")
+                c.execute(f"DROP TABLE {name}")
+                c.execute("COMMIT")
+                written.append(path)
+    return written
+
 
 def blacklist_add(user_id: int, question: str) -> None:
     """Добавить вопрос в чёрный список пользователя (идемпотентно)."""
@@ -73,6 +652,23 @@ def blacklist_remove(user_id: int, question: str) -> None:
             """, (user_id, question))
 
 
+def blacklist_remove_many(user_id: int, questions) -> list[str]:
+    """Удалить несколько вопросов одним запросом и вернуть оставшийся чёрный список."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                DELETE FROM user_blocked_questions
+                WHERE user_id = %s AND question = ANY(%s)
+            """, (user_id, list(questions)))
+            c.execute("""
+                SELECT question
+                FROM user_blocked_questions
+                WHERE user_id = %s
+                ORDER BY question
+            """, (user_id,))
+            return [row[0] for row in c.fetchall()]
+
+
 def blacklist_is_blocked(user_id: int, question: str) -> bool:
     """Проверить, заблокирован ли вопрос пользователем."""
     with get_connection() as conn:
@@ -111,128 +707,503 @@ def blacklist_clear(user_id: int) -> None:
             """, (user_id,))
 
 
+LOG_COLUMNS = (
+    "event_id", "user_id", "question_id", "question", "user_option", "correct_option",
+    "user_answer", "correct_answer", "is_correct", "answered_at", "answered_ts", "seed",
+)
+
 
-def update_stats(user_id, question, correct):
+def _log_row(answer) -> dict:
+    """
+    logs row for an answer dict (see record_answer). Texts are stored only where
+    the question id or an ordinal is unknown (question not in the bank, old journal entries).
     """
-    We insert the recording, with a conflict in the (user_id, Question) we increase the counters.
+    question_id = answer.get("question_id")
+    user_option = answer.get("user_option") if question_id is not None else None
+    correct_option = answer.get("correct_option") if question_id is not None else None
+    return {
+        "event_id": answer.get("event_id") or str(uuid.uuid4()),
+        "user_id": answer["user_id"],
+        "question_id": question_id,
+        "question": answer["question"] if question_id is None else None,
+        "user_option": user_option,
+        "correct_option": correct_option,
+        "user_answer": answer.get("user_answer") if user_option is None else None,
+        "correct_answer": answer.get("correct_answer") if correct_option is None else None,
+        "is_correct": answer["correct"],
+        "answered_at": answer["date"],
+        "answered_ts": answer.get("answered_ts"),
+        "seed": answer.get("seed"),
+    }
+
+
+def record_answer(answer):
     """
+    Records the answer with one statement: stats, logs, user_totals and user_bank_totals.
+    `answer` is a dict with user_id, date, correct, question (text, the stats key),
+    question_id, user_option, correct_option, seed, answered_ts, event_id and the texts
+    user_answer / correct_answer as a fallback for options that have no ordinal.
+    Returns the fresh aggregates {"total", "correct", "seen", "banks": {bank: seen}}.
+    An answer whose event_id is already in logs is not counted again.
+    """
+    params = {
+        **_log_row(answer),
+        "stats_question": answer["question"],
+        "wrong": 0 if answer["correct"] else 1,
+        "correct_int": 1 if answer["correct"] else 0,
+    }
     with get_connection() as conn:
         conn.autocommit = True
-        with conn.cursor() as c:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
             c.execute("""
-                INSERT INTO stats (user_id, question, shown, wrong)
-                VALUES (%s, %s, 1, %s)
-                ON CONFLICT (user_id, question) DO UPDATE SET
-                    shown = stats.shown + 1,
-                    wrong = stats.wrong + EXCLUDED.wrong
-            """, (user_id, question, 0 if correct else 1))
+                WITH l AS (
+                    INSERT INTO logs (event_id, user_id, question_id, question, user_option, correct_option,
+                                      user_answer, correct_answer, is_correct, answered_at, answered_ts, seed)
+                    VALUES (%(event_id)s, %(user_id)s, %(question_id)s, %(question)s, %(user_option)s,
+                            %(correct_option)s, %(user_answer)s, %(correct_answer)s, %(is_correct)s,
+                            %(answered_at)s, %(answered_ts)s, %(seed)s)
+                    ON CONFLICT (event_id, answered_at) DO NOTHING
+                    RETURNING user_id
+                ), s AS (
+                    INSERT INTO stats (user_id, question, shown, wrong)
+                    SELECT user_id, %(stats_question)s, 1, %(wrong)s FROM l
+                    ON CONFLICT (user_id, question) DO UPDATE SET
+                        shown = stats.shown + 1,
+                        wrong = stats.wrong + EXCLUDED.wrong
+                    RETURNING (xmax = 0) AS inserted
+                ), b AS (
+                    INSERT INTO user_bank_totals (user_id, bank, seen)
+                    SELECT %(user_id)s, q.bank, 1
+                    FROM s
+                    JOIN questions q ON q.question = %(stats_question)s
+                    WHERE s.inserted
+                    ON CONFLICT (user_id, bank) DO UPDATE SET seen = user_bank_totals.seen + 1
+                    RETURNING bank, seen
+                )
+                INSERT INTO user_totals (user_id, total, correct, seen)
+                SELECT %(user_id)s, 1, %(correct_int)s, CASE WHEN s.inserted THEN 1 ELSE 0 END
+                FROM s
+                ON CONFLICT (user_id) DO UPDATE SET
+                    total = user_totals.total + 1,
+                    correct = user_totals.correct + EXCLUDED.correct,
+                    seen = user_totals.seen + EXCLUDED.seen
+                RETURNING total, correct, seen, (
+                    -- The statement does not see its own write to user_bank_totals: take it from b
+                    SELECT COALESCE(jsonb_object_agg(x.bank, x.seen), '{}')
+                    FROM (
+                        SELECT b.bank, b.seen FROM b
+                        UNION ALL
+                        SELECT t.bank, t.seen FROM user_bank_totals t
+                        WHERE t.user_id = %(user_id)s AND t.bank NOT IN (SELECT bank FROM b)
+                    ) x
+                ) AS banks
+            """, params)
+            row = c.fetchone()
+            if row is None:
+                # Duplicate event: nothing was written, report the current aggregates
+                return _user_totals(c, answer["user_id"])
+            return dict(row)
+
+def _record_answers_batch(c, answers):
+    """
+    Batched counterpart of record_answer for a list of answer dicts (same keys).
+    Three multi-row statements regardless of the number of answers; answers whose
+    event_id is already in logs are skipped.
+    Returns {user_id: {"total", "correct", "seen", "banks"}} for users with new answers.
+    """
+    answers = [{**a, "event_id": a.get("event_id") or str(uuid.uuid4())} for a in answers]
+    fresh = psycopg2.extras.execute_values(c, """
+        INSERT INTO logs (event_id, user_id, question_id, question, user_option, correct_option,
+                          user_answer, correct_answer, is_correct, answered_at, answered_ts, seed)
+        VALUES %s
+        ON CONFLICT (event_id, answered_at) DO NOTHING
+        RETURNING event_id
+    """, [tuple(_log_row(a)[column] for column in LOG_COLUMNS) for a in answers], fetch=True)
+    fresh = {event_id for (event_id,) in fresh}
+    answers = [a for a in answers if a["event_id"] in fresh]
+    if not answers:
+        return {}
+
+    per_question = {}
+    per_user = {}
+    for a in answers:
+        key = (a["user_id"], a["question"])
+        shown, wrong = per_question.get(key, (0, 0))
+        per_question[key] = (shown + 1, wrong + (0 if a["correct"] else 1))
+        total, correct = per_user.get(a["user_id"], (0, 0))
+        per_user[a["user_id"]] = (total + 1, correct + (1 if a["correct"] else 0))
+
+    inserted = psycopg2.extras.execute_values(c, """
+        INSERT INTO stats (user_id, question, shown, wrong)
+        VALUES %s
+        ON CONFLICT (user_id, question) DO UPDATE SET
+            shown = stats.shown + EXCLUDED.shown,
+            wrong = stats.wrong + EXCLUDED.wrong
+        RETURNING user_id, question, (xmax = 0)
+    """, [(u, q, shown, wrong) for (u, q), (shown, wrong) in per_question.items()], fetch=True)
+    new_seen = {}
+    first_seen = []
+    for user_id, question, is_new in inserted:
+        new_seen[user_id] = new_seen.get(user_id, 0) + (1 if is_new else 0)
+        if is_new:
+            first_seen.append((user_id, question))
+    if first_seen:
+        psycopg2.extras.execute_values(c, """
+            INSERT INTO user_bank_totals (user_id, bank, seen)
+            SELECT v.user_id, q.bank, COUNT(*)
+            FROM (VALUES %s) AS v (user_id, question)
+            JOIN questions q ON q.question = v.question
+            GROUP BY v.user_id, q.bank
+            ON CONFLICT (user_id, bank) DO UPDATE SET seen = user_bank_totals.seen + EXCLUDED.seen
+        """, first_seen)
 
-def log_user_answer(user_id, date, correct, question=None, user_answer=None, correct_answer=None):
+    totals = psycopg2.extras.execute_values(c, """
+        INSERT INTO user_totals (user_id, total, correct, seen)
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET
+            total = user_totals.total + EXCLUDED.total,
+            correct = user_totals.correct + EXCLUDED.correct,
+            seen = user_totals.seen + EXCLUDED.seen
+        RETURNING user_id, total, correct, seen, (
+            SELECT COALESCE(jsonb_object_agg(b.bank, b.seen), '{}')
+            FROM user_bank_totals b
+            WHERE b.user_id = user_totals.user_id
+        )
+    """, [(u, total, correct, new_seen.get(u, 0)) for u, (total, correct) in per_user.items()], fetch=True)
+    return {
+        u: {"total": total, "correct": correct, "seen": seen, "banks": banks}
+        for u, total, correct, seen, banks in totals
+    }
+
+def record_exam_attempt(user_id, started_at, finished_at, total, timed_out, answers):
+    """
+    Saves a finished exam in one transaction: the attempt summary plus all
+    its answers in batches. Returns the user's fresh aggregates.
+    """
+    correct = sum(1 for a in answers if a["correct"])
     with get_connection() as conn:
-        conn.autocommit = True
         with conn.cursor() as c:
             c.execute("""
-                INSERT INTO logs (user_id, question, user_answer, correct_answer, is_correct, answered_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (user_id, question, user_answer, correct_answer, correct, date))
+                INSERT INTO exam_attempts (user_id, started_at, finished_at, total, answered, correct, timed_out)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (user_id, started_at, finished_at, total, len(answers), correct, timed_out))
+            if not answers:
+                return None
+            return _record_answers_batch(c, answers).get(user_id)
 
-def get_question_stats(user_id, question):
+def replay_answers(answers) -> dict:
+    """
+    Idempotent batch write of answers (local journal replay, group quiz results):
+    events already in logs are skipped. Returns {user_id: fresh aggregates}.
+    """
     with get_connection() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
-            c.execute("""
-                SELECT shown, wrong
-                FROM stats
-                WHERE user_id = %s AND question = %s
-            """, (user_id, question))
-            row = c.fetchone()
-            return {"shown": row['shown'], "wrong": row['wrong']} if row else {"shown": 0, "wrong": 0}
+        with conn.cursor() as c:
+            return _record_answers_batch(c, answers)
+
+def _user_totals(c, user_id):
+    c.execute("""
+        SELECT total, correct, seen, (
+            SELECT COALESCE(jsonb_object_agg(b.bank, b.seen), '{}')
+            FROM user_bank_totals b
+            WHERE b.user_id = t.user_id
+        ) AS banks
+        FROM user_totals t
+        WHERE user_id = %s
+    """, (user_id,))
+    row = c.fetchone()
+    return dict(row) if row else {"total": 0, "correct": 0, "seen": 0, "banks": {}}
 
-def get_user_top_mistakes(user_id, limit=5):
+def get_user_totals(user_id):
+    """Aggregates of the user: {"total", "correct", "seen", "banks": {bank: seen}} (zeros if no answers)."""
     with get_connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
+            return _user_totals(c, user_id)
+
+def get_user_daily_stats(user_id, since):
+    """
+    Per-day totals since `since` in one query (prunes older partitions).
+    Returns {day: (total, correct)}.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as c:
             c.execute("""
                 SELECT
-                    question,
-                    wrong,
-                    shown,
-                    ROUND(wrong::numeric / NULLIF(shown, 0) * 100, 1) AS rate
-                FROM stats
-                WHERE user_id = %s AND shown > 0
-                ORDER BY rate DESC NULLS LAST, wrong DESC
-                LIMIT %s
-            """, (user_id, limit))
-            return c.fetchall()
+                    answered_at,
+                    COUNT(*) AS total,
+                    COUNT(*) FILTER (WHERE is_correct) AS correct
+                FROM logs
+                WHERE user_id = %s AND answered_at >= %s
+                GROUP BY answered_at
+            """, (user_id, since))
+            return {day: (total, correct) for day, total, correct in c.fetchall()}
 
-def get_all_user_shown_questions_count(user_id):
+def get_user_wrong_answers(user_id, since):
+    """Wrong answers since `since`, newest first, as stored in logs (texts are resolved via the bank)."""
     with get_connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
             c.execute("""
-                SELECT COUNT(*) AS cnt
-                FROM stats
-                WHERE user_id = %s AND shown > 0
-            """, (user_id,))
-            return c.fetchone()['cnt']
+                SELECT question_id, question, user_option, correct_option, user_answer, correct_answer,
+                       answered_at, answered_ts
+                FROM logs
+                WHERE user_id = %s AND is_correct = FALSE AND answered_at >= %s
+                ORDER BY answered_at DESC, id DESC
+            """, (user_id, since))
+            return c.fetchall()
 
-def get_daily_user_stats(user_id, day):
+def get_mistake_questions(user_id, since):
+    """
+    Questions answered wrong since `since`: [{"question_id", "question"}], where
+    question (text) is set only for rows that could not be compacted.
+    Options and the correct answer come from the in-memory bank.
+    """
     with get_connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
             c.execute("""
-                SELECT
-                    COUNT(*) AS total,
-                    SUM(CASE WHEN is_correct THEN 1 ELSE 0 END) AS correct
+                SELECT DISTINCT question_id, question
                 FROM logs
-                WHERE user_id = %s AND answered_at = %s
-            """, (user_id, day))
-            row = c.fetchone()
-            total = row['total'] or 0
-            correct = row['correct'] or 0
-            return total, correct
+                WHERE user_id = %s AND is_correct = FALSE AND answered_at >= %s
+            """, (user_id, since))
+            return c.fetchall()
+
+RESET_CHUNK_SIZE = 5000
 
-def get_user_wrong_answers(user_id):
+def reset_user_stats(user_id, chunk_size=RESET_CHUNK_SIZE):
+    """
+    Deletes the user's history in chunks, each chunk in its own transaction,
+    so a large reset never holds long locks. Blocking: call it from a thread.
+    """
     with get_connection() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
+        conn.autocommit = True
+        with conn.cursor() as c:
+            c.execute("DELETE FROM user_totals WHERE user_id = %s", (user_id,))
+            c.execute("DELETE FROM user_bank_totals WHERE user_id = %s", (user_id,))
+            # Обнуление, а не удаление: другие воркеры увидят его при синхронизации рейтинга
             c.execute("""
-                SELECT question, user_answer, correct_answer, answered_at
-                FROM logs
-                WHERE user_id = %s AND is_correct = FALSE
-                ORDER BY answered_at DESC
+                UPDATE leaderboard SET answered = 0, correct = 0, updated_at = now()
+                WHERE user_id = %s
             """, (user_id,))
+            while True:
+                c.execute("""
+                    DELETE FROM stats
+                    WHERE user_id = %s AND question IN (
+                        SELECT question FROM stats
+                        WHERE user_id = %s
+                        LIMIT %s
+                    )
+                """, (user_id, user_id, chunk_size))
+                if c.rowcount < chunk_size:
+                    break
+            while True:
+                c.execute("""
+                    DELETE FROM logs
+                    WHERE user_id = %s AND id IN (
+                        SELECT id FROM logs
+                        WHERE user_id = %s
+                        LIMIT %s
+                    )
+                """, (user_id, user_id, chunk_size))
+                if c.rowcount < chunk_size:
+                    break
+
+
+
+# ======= Сложность вопросов =======
+
+def question_totals_load() -> dict:
+    """Глобальные счётчики по вопросам: {question: (answered, correct)}."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT question, answered, correct FROM question_totals")
+            return {question: (answered, correct) for question, answered, correct in c.fetchall()}
+
+
+def question_totals_add(deltas) -> dict:
+    """
+    Adds {question: (answered, correct)} deltas in one multi-row upsert and
+    returns the resulting totals of those questions.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            rows = psycopg2.extras.execute_values(c, """
+                INSERT INTO question_totals (question, answered, correct)
+                VALUES %s
+                ON CONFLICT (question) DO UPDATE SET
+                    answered = question_totals.answered + EXCLUDED.answered,
+                    correct = question_totals.correct + EXCLUDED.correct
+                RETURNING question, answered, correct
+            """, [(q, answered, correct) for q, (answered, correct) in deltas.items()], fetch=True)
+            return {question: (answered, correct) for question, answered, correct in rows}
+
+
+def iter_question_difficulty(min_answered: int = 1, batch_size: int = 1000):
+    """Строки (question, answered, correct, rate) от самых сложных к простым — через серверный курсор."""
+    with get_connection() as conn:
+        with conn.cursor(name="question_difficulty") as c:
+            c.itersize = batch_size
+            c.execute("""
+                SELECT question, answered, correct,
+                       ROUND(correct::numeric / answered * 100, 1) AS rate
+                FROM question_totals
+                WHERE answered >= %s
+                ORDER BY correct::float / answered, answered DESC
+            """, (min_answered,))
+            yield from c
+
+
+# ======= Рейтинг недели =======
+
+def leaderboard_add(week: date, deltas) -> None:
+    """Adds {user_id: (answered, correct, name)} deltas for the week in one multi-row upsert."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            psycopg2.extras.execute_values(c, """
+                INSERT INTO leaderboard (week, user_id, answered, correct, name)
+                VALUES %s
+                ON CONFLICT (week, user_id) DO UPDATE SET
+                    answered = leaderboard.answered + EXCLUDED.answered,
+                    correct = leaderboard.correct + EXCLUDED.correct,
+                    name = COALESCE(EXCLUDED.name, leaderboard.name),
+                    updated_at = now()
+            """, [(week, user_id, answered, correct, name) for user_id, (answered, correct, name) in deltas.items()])
+
+
+def leaderboard_load(week: date, since=None):
+    """Строки недели (user_id, answered, correct, name, updated_at); с since — только изменённые после него."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT user_id, answered, correct, name, updated_at
+                FROM leaderboard
+                WHERE week = %s AND (%s::timestamptz IS NULL OR updated_at > %s)
+            """, (week, since, since))
             return c.fetchall()
 
-def get_mistake_questions(user_id):
+
+def leaderboard_prune(before: date) -> int:
+    """Удаляет недели раньше before; возвращает число строк."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("DELETE FROM leaderboard WHERE week < %s", (before,))
+            return c.rowcount
+
+
+# ======= Рассылки =======
+
+def users_add(user_ids) -> None:
+    """Запомнить пользователей (получателей рассылок); уже известные пропускаются."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            psycopg2.extras.execute_values(c, """
+                INSERT INTO users (user_id)
+                VALUES %s
+                ON CONFLICT (user_id) DO NOTHING
+            """, [(user_id,) for user_id in user_ids])
+
+
+def broadcast_create(text: str, created_by: int) -> int:
+    """Создать рассылку по всем пользователям; возвращает её id."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                INSERT INTO broadcasts (text, created_by, total)
+                SELECT %s, %s, COUNT(*) FROM users
+                RETURNING id
+            """, (text, created_by))
+            return c.fetchone()[0]
+
+
+def broadcast_get(broadcast_id: int):
+    with get_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
+            c.execute("SELECT * FROM broadcasts WHERE id = %s", (broadcast_id,))
+            return c.fetchone()
+
+
+def broadcast_list(status=None, limit=5):
+    """Последние рассылки (все или с указанным статусом)."""
     with get_connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
             c.execute("""
-                SELECT DISTINCT question, correct_answer
-                FROM logs
-                WHERE user_id = %s AND is_correct = FALSE
-            """, (user_id,))
-            results = c.fetchall()
+                SELECT *
+                FROM broadcasts
+                WHERE %(status)s IS NULL OR status = %(status)s
+                ORDER BY id DESC
+                LIMIT %(limit)s
+            """, {"status": status, "limit": limit})
+            return c.fetchall()
 
-            questions = []
-            for row in results:
-                q_text = row['question']
-                c.execute("""
-                    SELECT option_a, option_b, option_c, option_d, option_e
-                    FROM questions
-                    WHERE question = %s
-                """, (q_text,))
-                opt = c.fetchone()
-                if not opt:
-                    continue
 
-                options = [opt[k] for k in ('option_a', 'option_b', 'option_c', 'option_d', 'option_e') if opt.get(k)]
-                questions.append({
-                    'question': q_text,
-                    'options': options,
-                    'correct': row['correct_answer']
-                })
-            return questions
+def broadcast_open_recipients(broadcast_id: int, after_user_id: int):
+    """
+    Opens a server-side cursor over the recipient ids. The cursor is WITH HOLD,
+    so no transaction stays open while messages are being sent. Users already
+    recorded for this broadcast are skipped. The handle is for
+    broadcast_fetch_recipients / broadcast_close_recipients, all called from one thread.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(name=f"broadcast_{broadcast_id}", withhold=True)
+        c.execute("""
+            SELECT u.user_id
+            FROM users u
+            WHERE u.user_id > %s
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_recipients r
+                  WHERE r.broadcast_id = %s AND r.user_id = u.user_id
+              )
+            ORDER BY u.user_id
+        """, (after_user_id, broadcast_id))
+        conn.commit()
+    except Exception:
+        conn.close()
+        raise
+    return conn, c
+
+
+def broadcast_fetch_recipients(handle, batch_size: int = 100) -> list[int]:
+    """Next batch of recipient ids; empty when the cursor is exhausted."""
+    _conn, c = handle
+    return [row[0] for row in c.fetchmany(batch_size)]
+
+
+def broadcast_close_recipients(handle) -> None:
+    conn, c = handle
+    try:
+        c.close()
+    finally:
+        conn.close()
 
-def reset_user_stats(user_id):
+
+def broadcast_save_progress(broadcast_id: int, results, last_user_id: int) -> str:
+    """
+    Saves delivery results [(user_id, status, error)] and the resume checkpoint
+    in one transaction. Returns the current status of the broadcast.
+    """
+    sent = sum(1 for _, status, _ in results if status == "sent")
     with get_connection() as conn:
-        conn.autocommit = True
         with conn.cursor() as c:
-            c.execute("DELETE FROM stats WHERE user_id = %s", (user_id,))
-            c.execute("DELETE FROM logs WHERE user_id = %s", (user_id,))
+            psycopg2.extras.execute_values(c, """
+                INSERT INTO broadcast_recipients (broadcast_id, user_id, status, error)
+                VALUES %s
+                ON CONFLICT (broadcast_id, user_id) DO NOTHING
+            """, [(broadcast_id, user_id, status, error) for user_id, status, error in results])
+            c.execute("""
+                UPDATE broadcasts SET
+                    sent = sent + %s,
+                    failed = failed + %s,
+                    last_user_id = GREATEST(last_user_id, %s)
+                WHERE id = %s
+                RETURNING status
+            """, (sent, len(results) - sent, last_user_id, broadcast_id))
+            return c.fetchone()[0]
 
+
+def broadcast_finish(broadcast_id: int, status: str) -> bool:
+    """Завершить рассылку (done / cancelled); False, если она уже не выполняется."""
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                UPDATE broadcasts SET status = %s, finished_at = now()
+                WHERE id = %s AND status = 'running'
+            """, (status, broadcast_id))
+            return c.rowcount > 0
@@ -0,0 +1,1020 @@
+"""
+Встроенное хранилище на SQLite для одиночных установок и локальных замеров (DB_BACKEND=sqlite).
+
+Тот же набор функций, что и в database.py. База в режиме WAL: чтение не ждёт записи.
+Каждый поток читает через своё соединение — sqlite3 кэширует подготовленные выражения
+на соединении, поэтому весь SQL здесь — константные строки (списки передаются через json_each).
+Все записи идут через один поток-писатель: подряд стоящие в очереди задания выполняются
+в одной транзакции (каждое в своём SAVEPOINT), так что пачка ответов стоит одного fsync.
+
+Банк вопросов загружается так же, как и в Postgres: python dedupe.py import questions.csv
+"""
+import csv
+import gzip
+import json
+import os
+import queue
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import Future
+from datetime import date, datetime, timezone
+
+import config
+
+__all__ = [
+    "Error", "CONNECTION_ERRORS",
+    "ping", "init_db", "load_questions", "insert_questions", "get_question_history_counts", "merge_duplicate_question",
+    "update_correct_answers",
+    "get_bank_sizes", "get_user_bank", "set_user_bank",
+    "ensure_log_partitions", "archive_log_partitions",
+    "blacklist_add", "blacklist_remove", "blacklist_remove_many", "blacklist_is_blocked", "blacklist_list",
+    "blacklist_clear",
+    "record_answer", "record_exam_attempt", "replay_answers", "get_user_totals",
+    "get_user_daily_stats", "get_user_wrong_answers", "get_mistake_questions", "reset_user_stats",
+    "question_totals_load", "question_totals_add", "iter_question_difficulty",
+    "leaderboard_add", "leaderboard_load", "leaderboard_prune",
+    "users_add", "broadcast_create", "broadcast_get", "broadcast_list", "broadcast_open_recipients",
+    "broadcast_fetch_recipients", "broadcast_close_recipients", "broadcast_save_progress", "broadcast_finish",
+]
+
+Error = sqlite3.Error
+# "database is locked", ошибки ввода-вывода — то, что для Postgres было бы обрывом связи
+CONNECTION_ERRORS = (sqlite3.OperationalError,)
+
+WRITE_BATCH = 256  # заданий писателя в одной транзакции
+BUSY_TIMEOUT_MS = 5000
+
+QUESTION_OPTION_COLUMNS = ('option_a', 'option_b', 'option_c', 'option_d', 'option_e')
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, datetime.isoformat)
+sqlite3.register_converter("DATE", lambda b: date.fromisoformat(b.decode()))
+sqlite3.register_converter("TIMESTAMP", lambda b: datetime.fromisoformat(b.decode()))
+
+
+def get_connection():
+    os.makedirs(os.path.dirname(config.SQLITE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(
+        config.SQLITE_PATH,
+        isolation_level=None,  # транзакции открываем явно
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+        cached_statements=256,
+    )
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+_local = threading.local()
+
+
+def _reader():
+    """Соединение текущего потока для чтения."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = get_connection()
+    return conn
+
+
+def ping() -> None:
+    """Проверка связи с БД (для /readyz)."""
+    _reader().execute("SELECT 1").fetchone()
+
+
+def _dicts(cursor):
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+# ======= Поток-писатель =======
+
+_queue = queue.SimpleQueue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _writer_loop():
+    conn = get_connection()
+    while True:
+        jobs = [_queue.get()]
+        while len(jobs) < WRITE_BATCH:
+            try:
+                jobs.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, func, args in jobs:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = func(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+                conn.execute("RELEASE job")
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, _, _ in jobs:
+                future.set_exception(e)
+            continue
+        # Результаты отдаём только после COMMIT: запись уже на диске
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _write(func, *args):
+    """Выполнить func(conn, *args) в потоке-писателе и дождаться результата."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="sqlite-writer", daemon=True)
+                _writer.start()
+    future = Future()
+    _queue.put((future, func, args))
+    return future.result()
+
+
+# ======= Схема =======
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    question TEXT PRIMARY KEY,
+    id INTEGER,
+    option_a TEXT,
+    option_b TEXT,
+    option_c TEXT,
+    option_d TEXT,
+    option_e TEXT,
+    correct_answer TEXT,
+    bank TEXT NOT NULL DEFAULT 'main'
+);
+CREATE INDEX IF NOT EXISTS questions_bank_idx ON questions (bank);
+CREATE UNIQUE INDEX IF NOT EXISTS questions_id_idx ON questions (id);
+CREATE TABLE IF NOT EXISTS user_banks (
+    user_id INTEGER PRIMARY KEY,
+    bank TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    user_id INTEGER NOT NULL,
+    question TEXT NOT NULL,
+    shown INTEGER NOT NULL DEFAULT 0,
+    wrong INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, question)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    event_id TEXT,
+    user_id INTEGER NOT NULL,
+    question_id INTEGER,
+    question TEXT,
+    user_option SMALLINT,
+    correct_option SMALLINT,
+    user_answer TEXT,
+    correct_answer TEXT,
+    is_correct BOOLEAN NOT NULL,
+    answered_at DATE NOT NULL,
+    answered_ts TIMESTAMP,
+    seed INTEGER
+);
+CREATE INDEX IF NOT EXISTS logs_user_id_idx ON logs (user_id, answered_at);
+CREATE UNIQUE INDEX IF NOT EXISTS logs_event_id_idx ON logs (event_id);
+CREATE TABLE IF NOT EXISTS user_totals (
+    user_id INTEGER PRIMARY KEY,
+    total INTEGER NOT NULL DEFAULT 0,
+    correct INTEGER NOT NULL DEFAULT 0,
+    seen INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS user_bank_totals (
+    user_id INTEGER NOT NULL,
+    bank TEXT NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, bank)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    first_seen TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS user_blocked_questions (
+    user_id INTEGER NOT NULL,
+    question TEXT NOT NULL,
+    PRIMARY KEY (user_id, question)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS question_totals (
+    question TEXT PRIMARY KEY,
+    answered INTEGER NOT NULL DEFAULT 0,
+    correct INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS leaderboard (
+    week DATE NOT NULL,
+    user_id INTEGER NOT NULL,
+    answered INTEGER NOT NULL DEFAULT 0,
+    correct INTEGER NOT NULL DEFAULT 0,
+    name TEXT,
+    updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (week, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS leaderboard_updated_idx ON leaderboard (week, updated_at);
+CREATE TABLE IF NOT EXISTS exam_attempts (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL,
+    total INTEGER NOT NULL,
+    answered INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    timed_out BOOLEAN NOT NULL DEFAULT FALSE
+);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    created_by INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    last_user_id INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (broadcast_id, user_id)
+) WITHOUT ROWID;
+"""
+
+
+def _option_ordinal_sql(column: str) -> str:
+    """Порядковый номер текста из logs.<column> среди непустых вариантов вопроса q (см. database.py)."""
+    whens = []
+    for i, option in enumerate(QUESTION_OPTION_COLUMNS):
+        before = " + ".join(
+            f"(CASE WHEN q.{prev} <> '' THEN 1 ELSE 0 END)" for prev in QUESTION_OPTION_COLUMNS[:i]
+        ) or "0"
+        whens.append(f"WHEN q.{option} <> '' AND trim(q.{option}) = trim(l.{column}) THEN {before}")
+    return "CASE " + " ".join(whens) + " END"
+
+
+def _option_text_sql(column: str) -> str:
+    """Текст варианта с номером logs.<column> (обратное к _option_ordinal_sql)."""
+    whens = []
+    for i, option in enumerate(QUESTION_OPTION_COLUMNS):
+        before = " + ".join(
+            f"(CASE WHEN q.{prev} <> '' THEN 1 ELSE 0 END)" for prev in QUESTION_OPTION_COLUMNS[:i]
+        ) or "0"
+        whens.append(f"WHEN q.{option} <> '' AND l.{column} = {before} THEN q.{option}")
+    return "CASE " + " ".join(whens) + " END"
+
+
+COMPACT_LOGS = f"""
+    UPDATE logs AS l SET
+        question_id = q.id,
+        question = NULL,
+        user_option = {_option_ordinal_sql("user_answer")},
+        correct_option = {_option_ordinal_sql("correct_answer")},
+        user_answer = CASE WHEN {_option_ordinal_sql("user_answer")} IS NULL THEN l.user_answer END,
+        correct_answer = CASE WHEN {_option_ordinal_sql("correct_answer")} IS NULL THEN l.correct_answer END
+    FROM questions AS q
+    WHERE q.question = l.question AND l.question_id IS NULL
+"""
+
+EXPAND_LOGS = f"""
+    UPDATE logs AS l SET
+        question_id = NULL,
+        question = q.question,
+        user_answer = COALESCE(l.user_answer, {_option_text_sql("user_option")}),
+        correct_answer = COALESCE(l.correct_answer, {_option_text_sql("correct_option")}),
+        user_option = NULL,
+        correct_option = NULL,
+        seed = NULL
+    FROM questions AS q
+    WHERE q.id = l.question_id
+"""
+
+LOG_COMPACT_COLUMNS = (
+    "question_id INTEGER", "user_option SMALLINT", "correct_option SMALLINT",
+    "answered_ts TIMESTAMP", "seed INTEGER",
+)
+
+
+def init_db():
+    conn = get_connection()
+    try:
+        # Базы, созданные до появления банков: колонку bank нужно добавить до индекса по ней
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(questions)")]
+        if columns and "bank" not in columns:
+            conn.execute("ALTER TABLE questions ADD COLUMN bank TEXT NOT NULL DEFAULT 'main'")
+        if columns and "id" not in columns:
+            conn.execute("ALTER TABLE questions ADD COLUMN id INTEGER")
+            conn.execute("UPDATE questions SET id = rowid")
+        # Компактная запись ответов (см. database._compact_logs): старые строки переводятся
+        # в номера вариантов одной транзакцией
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(logs)")]
+        if columns and "question_id" not in columns:
+            conn.execute("BEGIN IMMEDIATE")
+            for column in LOG_COMPACT_COLUMNS:
+                conn.execute(f"ALTER TABLE logs ADD COLUMN {column}")
+            conn.execute(COMPACT_LOGS)
+            conn.execute("COMMIT")
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        conn.executescript(SCHEMA)
+        if "user_bank_totals" not in existing:
+            # Счётчики просмотренных по банкам: для существующей истории — одним запросом из stats
+            with conn:
+                conn.execute("""
+                    INSERT INTO user_bank_totals (user_id, bank, seen)
+                    SELECT s.user_id, q.bank, COUNT(*)
+                    FROM stats s
+                    JOIN questions q ON q.question = s.question
+                    WHERE s.shown > 0
+                    GROUP BY s.user_id, q.bank
+                """)
+        if "users" not in existing:
+            # Получатели рассылок: все, у кого уже есть история (/reset эту таблицу не трогает)
+            with conn:
+                conn.execute("""
+                    INSERT INTO users (user_id)
+                    SELECT user_id FROM user_totals
+                    UNION SELECT user_id FROM user_banks
+                    UNION SELECT user_id FROM user_blocked_questions
+                    UNION SELECT user_id FROM stats
+                """)
+    finally:
+        conn.close()
+
+
+# ======= Банк вопросов =======
+
+def load_questions(bank=None):
+    """Вопросы одного банка (или всех, если bank не указан)."""
+    c = _reader().execute("""
+        SELECT id, question, option_a, option_b, option_c, option_d, option_e, correct_answer, bank
+        FROM questions
+        WHERE :bank IS NULL OR bank = :bank
+    """, {"bank": bank})
+    return [
+        {"id": row[0], "question": row[1], "options": [o for o in row[2:7] if o], "correct": row[7], "bank": row[8]}
+        for row in c.fetchall()
+    ]
+
+
+def _insert_questions(conn, rows):
+    added = 0
+    for row in rows:
+        added += conn.execute("""
+            INSERT INTO questions (id, question, option_a, option_b, option_c, option_d, option_e, correct_answer, bank)
+            VALUES ((SELECT COALESCE(MAX(id), 0) + 1 FROM questions), ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (question) DO NOTHING
+        """, row).rowcount
+    return added
+
+
+def insert_questions(items) -> int:
+    """Добавить вопросы в банк (существующие тексты пропускаются); возвращает число добавленных."""
+    rows = []
+    for q in items:
+        options = (list(q["options"]) + [None] * len(QUESTION_OPTION_COLUMNS))[:len(QUESTION_OPTION_COLUMNS)]
+        rows.append((q["question"], *options, q["correct"], q.get("bank") or config.DEFAULT_BANK))
+    return _write(_insert_questions, rows)
+
+
+def _update_correct_answers(conn, fixes):
+    conn.executemany("UPDATE questions SET correct_answer = ? WHERE id = ?", [(text, id_) for id_, text, _ in fixes])
+    rows = 0
+    for id_, _, ordinal in fixes:
+        rows += conn.execute("""
+            UPDATE logs SET correct_option = ?, correct_answer = NULL
+            WHERE question_id = ? AND correct_option IS NULL
+        """, (ordinal, id_)).rowcount
+    return rows
+
+
+def update_correct_answers(fixes) -> int:
+    """Исправить правильные ответы [(question_id, текст варианта, номер варианта)] (см. database.update_correct_answers)."""
+    return _write(_update_correct_answers, fixes)
+
+
+def get_question_history_counts(questions) -> dict:
+    """Число пользователей с историей (stats) по каждому из вопросов."""
+    c = _reader().execute("""
+        SELECT question, COUNT(*)
+        FROM stats
+        WHERE question IN (SELECT value FROM json_each(?))
+        GROUP BY question
+    """, (json.dumps(list(questions)),))
+    return dict(c.fetchall())
+
+
+def _merge_duplicate_question(conn, params):
+    conn.execute("""
+        UPDATE user_totals SET seen = seen - 1
+        WHERE user_id IN (
+            SELECT a.user_id
+            FROM stats a
+            JOIN stats b ON b.user_id = a.user_id AND b.question = :s
+            WHERE a.question = :d
+        )
+    """, params)
+    conn.execute("""
+        UPDATE user_bank_totals SET seen = seen - 1
+        WHERE bank = (SELECT bank FROM questions WHERE question = :d)
+          AND user_id IN (SELECT user_id FROM stats WHERE question = :d)
+    """, params)
+    conn.execute("""
+        INSERT INTO user_bank_totals (user_id, bank, seen)
+        SELECT a.user_id, q.bank, 1
+        FROM stats a
+        JOIN questions q ON q.question = :s
+        WHERE a.question = :d
+          AND NOT EXISTS (SELECT 1 FROM stats b WHERE b.user_id = a.user_id AND b.question = :s)
+        ON CONFLICT (user_id, bank) DO UPDATE SET seen = user_bank_totals.seen + 1
+    """, params)
+    conn.execute("""
+        INSERT INTO stats (user_id, question, shown, wrong)
+        SELECT user_id, :s, shown, wrong
+        FROM stats
+        WHERE question = :d
+        ON CONFLICT (user_id, question) DO UPDATE SET
+            shown = stats.shown + excluded.shown,
+            wrong = stats.wrong + excluded.wrong
+    """, params)
+    conn.execute("DELETE FROM stats WHERE question = :d", params)
+    conn.execute(EXPAND_LOGS + " AND q.question = :d", params)
+    conn.execute("UPDATE logs SET question = :s WHERE question = :d", params)
+    conn.execute(COMPACT_LOGS + " AND l.question = :s", params)
+    conn.execute("""
+        INSERT INTO user_blocked_questions (user_id, question)
+        SELECT user_id, :s
+        FROM user_blocked_questions
+        WHERE question = :d
+        ON CONFLICT (user_id, question) DO NOTHING
+    """, params)
+    conn.execute("DELETE FROM user_blocked_questions WHERE question = :d", params)
+    conn.execute("""
+        INSERT INTO question_totals (question, answered, correct)
+        SELECT :s, answered, correct
+        FROM question_totals
+        WHERE question = :d
+        ON CONFLICT (question) DO UPDATE SET
+            answered = question_totals.answered + excluded.answered,
+            correct = question_totals.correct + excluded.correct
+    """, params)
+    conn.execute("DELETE FROM question_totals WHERE question = :d", params)
+    conn.execute("DELETE FROM questions WHERE question = :d", params)
+
+
+def merge_duplicate_question(survivor: str, duplicate: str) -> None:
+    """Перенести историю дубликата на выживший вопрос (см. database.merge_duplicate_question)."""
+    _write(_merge_duplicate_question, {"s": survivor, "d": duplicate})
+
+
+# ======= Банки вопросов =======
+
+def get_bank_sizes() -> dict:
+    """Банки и число вопросов в них: {bank: count}."""
+    return dict(_reader().execute("SELECT bank, COUNT(*) FROM questions GROUP BY bank").fetchall())
+
+
+def get_user_bank(user_id: int):
+    """Выбранный пользователем банк или None."""
+    row = _reader().execute("SELECT bank FROM user_banks WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_user_bank(conn, user_id, bank):
+    conn.execute("""
+        INSERT INTO user_banks (user_id, bank)
+        VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET bank = excluded.bank
+    """, (user_id, bank))
+
+
+def set_user_bank(user_id: int, bank: str) -> None:
+    _write(_set_user_bank, user_id, bank)
+
+
+# ======= Журнал ответов =======
+
+def _add_months(month: date, n: int) -> date:
+    y, m = divmod(month.month - 1 + n, 12)
+    return date(month.year + y, m + 1, 1)
+
+
+def ensure_log_partitions(c=None, months_ahead: int = 2) -> None:
+    """Партиций в SQLite нет — logs обычная таблица."""
+
+
+def _delete_logs_before(conn, month_start, month_end):
+    conn.execute("DELETE FROM logs WHERE answered_at >= ? AND answered_at < ?", (month_start, month_end))
+
+
+def archive_log_partitions(keep_months: int, archive_dir: str) -> list[str]:
+    """
+    Выгружает месяцы старше `keep_months` в gzip CSV (по файлу на месяц, имена как у партиций
+    в Postgres) и удаляет их из logs. Файл полностью записывается до удаления.
+    """
+    cutoff = _add_months(date.today().replace(day=1), -keep_months)
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = _reader()
+    months = [
+        date.fromisoformat(m + "-01")
+        for (m,) in conn.execute(
+            "SELECT DISTINCT substr(answered_at, 1, 7) FROM logs WHERE answered_at < ? ORDER BY 1", (cutoff,)
+        )
+    ]
+    written = []
+    for month in months:
+        next_month = _add_months(month, 1)
+        path = os.path.join(archive_dir, f"logs_y{month.year}m{month.month:02d}.csv.gz")
+        tmp_path = path + ".tmp"
+        c = conn.execute("""
+            SELECT id, user_id, question_id, question, user_option, correct_option, user_answer, correct_answer,
+                   is_correct, answered_at, answered_ts, seed, event_id
+            FROM logs
+            WHERE answered_at >= ? AND answered_at < ?
+            ORDER BY id
+        """, (month, next_month))
+        with open(tmp_path, "wb") as raw:
+            with gzip.open(raw, "wt", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow([d[0] for d in c.description])
+                writer.writerows(c)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+        _write(_delete_logs_before, month, next_month)
+        written.append(path)
+    return written
+
+
+# ======= Чёрный список =======
+
+def _blacklist_add(conn, user_id, question):
+    conn.execute("""
+        INSERT INTO user_blocked_questions (user_id, question)
+        VALUES (?, ?)
+        ON CONFLICT (user_id, question) DO NOTHING
+    """, (user_id, question))
+
+
+def blacklist_add(user_id: int, question: str) -> None:
+    """Добавить вопрос в чёрный список пользователя."""
+    _write(_blacklist_add, user_id, question)
+
+
+def _blacklist_remove(conn, user_id, question):
+    conn.execute("DELETE FROM user_blocked_questions WHERE user_id = ? AND question = ?", (user_id, question))
+
+
+def blacklist_remove(user_id: int, question: str) -> None:
+    """Удалить вопрос из чёрного списка пользователя."""
+    _write(_blacklist_remove, user_id, question)
+
+
+def _blacklist_remove_many(conn, user_id, questions):
+    conn.execute("""
+        DELETE FROM user_blocked_questions
+        WHERE user_id = ? AND question IN (SELECT value FROM json_each(?))
+    """, (user_id, json.dumps(list(questions))))
+    return _blacklist_list(conn, user_id)
+
+
+def blacklist_remove_many(user_id: int, questions) -> list[str]:
+    """Удалить несколько вопросов и вернуть оставшийся чёрный список."""
+    return _write(_blacklist_remove_many, user_id, questions)
+
+
+def blacklist_is_blocked(user_id: int, question: str) -> bool:
+    """Проверить, заблокирован ли вопрос пользователем."""
+    c = _reader().execute("""
+        SELECT 1 FROM user_blocked_questions
+        WHERE user_id = ? AND question = ?
+    """, (user_id, question))
+    return c.fetchone() is not None
+
+
+def _blacklist_list(conn, user_id):
+    c = conn.execute("""
+        SELECT question
+        FROM user_blocked_questions
+        WHERE user_id = ?
+        ORDER BY question
+    """, (user_id,))
+    return [row[0] for row in c.fetchall()]
+
+
+def blacklist_list(user_id: int):
+    """Return the list of user blocked questions (list of lines)."""
+    return _blacklist_list(_reader(), user_id)
+
+
+def _blacklist_clear(conn, user_id):
+    conn.execute("DELETE FROM user_blocked_questions WHERE user_id = ?", (user_id,))
+
+
+def blacklist_clear(user_id: int) -> None:
+    """Clean the entire black list of the user."""
+    _write(_blacklist_clear, user_id)
+
+
+# ======= Ответы =======
+
+def _user_totals(conn, user_id):
+    row = conn.execute("SELECT total, correct, seen FROM user_totals WHERE user_id = ?", (user_id,)).fetchone()
+    if not row:
+        return {"total": 0, "correct": 0, "seen": 0, "banks": {}}
+    banks = conn.execute("SELECT bank, seen FROM user_bank_totals WHERE user_id = ?", (user_id,)).fetchall()
+    return {"total": row[0], "correct": row[1], "seen": row[2], "banks": dict(banks)}
+
+
+def _log_row(answer) -> dict:
+    """Строка logs для ответа: тексты — только там, где нет id вопроса или номера варианта."""
+    question_id = answer.get("question_id")
+    user_option = answer.get("user_option") if question_id is not None else None
+    correct_option = answer.get("correct_option") if question_id is not None else None
+    return {
+        "event_id": answer.get("event_id") or str(uuid.uuid4()),
+        "user_id": answer["user_id"],
+        "question_id": question_id,
+        "question": answer["question"] if question_id is None else None,
+        "user_option": user_option,
+        "correct_option": correct_option,
+        "user_answer": answer.get("user_answer") if user_option is None else None,
+        "correct_answer": answer.get("correct_answer") if correct_option is None else None,
+        "is_correct": answer["correct"],
+        "answered_at": answer["date"],
+        "answered_ts": answer.get("answered_ts"),
+        "seed": answer.get("seed"),
+    }
+
+
+def _record_answers_batch(conn, answers):
+    """
+    Как database._record_answers_batch: ответы с уже записанным event_id пропускаются.
+    Новая строка stats узнаётся по shown == приращению (у существующей shown больше).
+    Returns {user_id: {"total", "correct", "seen", "banks"}} for users with new answers.
+    """
+    fresh = []
+    for a in answers:
+        if conn.execute("""
+            INSERT INTO logs (event_id, user_id, question_id, question, user_option, correct_option,
+                              user_answer, correct_answer, is_correct, answered_at, answered_ts, seed)
+            VALUES (:event_id, :user_id, :question_id, :question, :user_option, :correct_option,
+                    :user_answer, :correct_answer, :is_correct, :answered_at, :answered_ts, :seed)
+            ON CONFLICT (event_id) DO NOTHING
+        """, _log_row(a)).rowcount:
+            fresh.append(a)
+    if not fresh:
+        return {}
+
+    per_question = {}
+    per_user = {}
+    for a in fresh:
+        key = (a["user_id"], a["question"])
+        shown, wrong = per_question.get(key, (0, 0))
+        per_question[key] = (shown + 1, wrong + (0 if a["correct"] else 1))
+        total, correct = per_user.get(a["user_id"], (0, 0))
+        per_user[a["user_id"]] = (total + 1, correct + (1 if a["correct"] else 0))
+
+    new_seen = {}
+    for (user_id, question), (shown, wrong) in per_question.items():
+        (now_shown,) = conn.execute("""
+            INSERT INTO stats (user_id, question, shown, wrong)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, question) DO UPDATE SET
+                shown = stats.shown + excluded.shown,
+                wrong = stats.wrong + excluded.wrong
+            RETURNING shown
+        """, (user_id, question, shown, wrong)).fetchone()
+        if now_shown == shown:
+            new_seen[user_id] = new_seen.get(user_id, 0) + 1
+            conn.execute("""
+                INSERT INTO user_bank_totals (user_id, bank, seen)
+                SELECT ?, bank, 1 FROM questions WHERE question = ?
+                ON CONFLICT (user_id, bank) DO UPDATE SET seen = user_bank_totals.seen + 1
+            """, (user_id, question))
+
+    totals = {}
+    for user_id, (total, correct) in per_user.items():
+        conn.execute("""
+            INSERT INTO user_totals (user_id, total, correct, seen)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                total = user_totals.total + excluded.total,
+                correct = user_totals.correct + excluded.correct,
+                seen = user_totals.seen + excluded.seen
+        """, (user_id, total, correct, new_seen.get(user_id, 0)))
+        totals[user_id] = _user_totals(conn, user_id)
+    return totals
+
+
+def _record_answer(conn, answer):
+    totals = _record_answers_batch(conn, [answer])
+    return totals.get(answer["user_id"]) or _user_totals(conn, answer["user_id"])
+
+
+def record_answer(answer):
+    """
+    Records the answer (dict, see database.record_answer): stats, logs, user_totals and
+    user_bank_totals in one transaction. Returns the fresh aggregates {"total", "correct", "seen", "banks"}.
+    An answer whose event_id is already in logs is not counted again.
+    """
+    return _write(_record_answer, answer)
+
+
+def _record_exam_attempt(conn, user_id, started_at, finished_at, total, timed_out, answers):
+    correct = sum(1 for a in answers if a["correct"])
+    conn.execute("""
+        INSERT INTO exam_attempts (user_id, started_at, finished_at, total, answered, correct, timed_out)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, started_at, finished_at, total, len(answers), correct, timed_out))
+    if not answers:
+        return None
+    return _record_answers_batch(conn, answers).get(user_id)
+
+
+def record_exam_attempt(user_id, started_at, finished_at, total, timed_out, answers):
+    """Saves a finished exam and its answers in one transaction. Returns the user's fresh aggregates."""
+    return _write(_record_exam_attempt, user_id, started_at, finished_at, total, timed_out, answers)
+
+
+def replay_answers(answers) -> dict:
+    """Idempotent batch write of answers (local journal replay, group quiz results)."""
+    return _write(_record_answers_batch, answers)
+
+
+def get_user_totals(user_id):
+    """Aggregates of the user: {"total", "correct", "seen", "banks": {bank: seen}} (zeros if no answers)."""
+    return _user_totals(_reader(), user_id)
+
+
+# ======= Статистика =======
+
+def get_user_daily_stats(user_id, since):
+    """Per-day totals since `since` in one query. Returns {day: (total, correct)}."""
+    c = _reader().execute("""
+        SELECT answered_at, COUNT(*), SUM(is_correct)
+        FROM logs
+        WHERE user_id = ? AND answered_at >= ?
+        GROUP BY answered_at
+    """, (user_id, since))
+    return {day: (total, correct) for day, total, correct in c.fetchall()}
+
+
+def get_user_wrong_answers(user_id, since):
+    """Wrong answers since `since`, newest first, as stored in logs (texts are resolved via the bank)."""
+    return _dicts(_reader().execute("""
+        SELECT question_id, question, user_option, correct_option, user_answer, correct_answer,
+               answered_at, answered_ts
+        FROM logs
+        WHERE user_id = ? AND is_correct = 0 AND answered_at >= ?
+        ORDER BY answered_at DESC, id DESC
+    """, (user_id, since)))
+
+
+def get_mistake_questions(user_id, since):
+    """Questions answered wrong since `since`: [{"question_id", "question"}] (see database.py)."""
+    return _dicts(_reader().execute("""
+        SELECT DISTINCT question_id, question
+        FROM logs
+        WHERE user_id = ? AND is_correct = 0 AND answered_at >= ?
+    """, (user_id, since)))
+
+
+RESET_CHUNK_SIZE = 5000
+
+
+def _reset_totals(conn, user_id):
+    conn.execute("DELETE FROM user_totals WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM user_bank_totals WHERE user_id = ?", (user_id,))
+    conn.execute("""
+        UPDATE leaderboard SET answered = 0, correct = 0, updated_at = ?
+        WHERE user_id = ?
+    """, (datetime.now(timezone.utc), user_id))
+
+
+def _reset_chunk(conn, user_id, chunk_size):
+    deleted = conn.execute("""
+        DELETE FROM stats
+        WHERE user_id = ? AND question IN (
+            SELECT question FROM stats WHERE user_id = ? LIMIT ?
+        )
+    """, (user_id, user_id, chunk_size)).rowcount
+    deleted += conn.execute("""
+        DELETE FROM logs
+        WHERE id IN (SELECT id FROM logs WHERE user_id = ? LIMIT ?)
+    """, (user_id, chunk_size)).rowcount
+    return deleted
+
+
+def reset_user_stats(user_id, chunk_size=RESET_CHUNK_SIZE):
+    """
+    Deletes the user's history in chunks; each chunk is a separate writer job,
+    so other users' answers are not queued behind a large reset.
+    """
+    _write(_reset_totals, user_id)
+    while _write(_reset_chunk, user_id, chunk_size):
+        pass
+
+
+# ======= Сложность вопросов =======
+
+def question_totals_load() -> dict:
+    """Глобальные счётчики по вопросам: {question: (answered, correct)}."""
+    c = _reader().execute("SELECT question, answered, correct FROM question_totals")
+    return {question: (answered, correct) for question, answered, correct in c.fetchall()}
+
+
+def _question_totals_add(conn, deltas):
+    fresh = {}
+    for question, (answered, correct) in deltas.items():
+        fresh[question] = conn.execute("""
+            INSERT INTO question_totals (question, answered, correct)
+            VALUES (?, ?, ?)
+            ON CONFLICT (question) DO UPDATE SET
+                answered = question_totals.answered + excluded.answered,
+                correct = question_totals.correct + excluded.correct
+            RETURNING answered, correct
+        """, (question, answered, correct)).fetchone()
+    return fresh
+
+
+def question_totals_add(deltas) -> dict:
+    """Adds {question: (answered, correct)} deltas and returns the resulting totals of those questions."""
+    return _write(_question_totals_add, deltas)
+
+
+def iter_question_difficulty(min_answered: int = 1, batch_size: int = 1000):
+    """Строки (question, answered, correct, rate) от самых сложных к простым."""
+    c = _reader().execute("""
+        SELECT question, answered, correct,
+               ROUND(correct * 100.0 / answered, 1) AS rate
+        FROM question_totals
+        WHERE answered >= ?
+        ORDER BY correct * 1.0 / answered, answered DESC
+    """, (min_answered,))
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+# ======= Рейтинг недели =======
+
+def _leaderboard_add(conn, week, deltas):
+    now = datetime.now(timezone.utc)
+    conn.executemany("""
+        INSERT INTO leaderboard (week, user_id, answered, correct, name, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (week, user_id) DO UPDATE SET
+            answered = leaderboard.answered + excluded.answered,
+            correct = leaderboard.correct + excluded.correct,
+            name = COALESCE(excluded.name, leaderboard.name),
+            updated_at = excluded.updated_at
+    """, [(week, user_id, answered, correct, name, now) for user_id, (answered, correct, name) in deltas.items()])
+
+
+def leaderboard_add(week: date, deltas) -> None:
+    """Adds {user_id: (answered, correct, name)} deltas for the week."""
+    _write(_leaderboard_add, week, deltas)
+
+
+def leaderboard_load(week: date, since=None):
+    """Строки недели (user_id, answered, correct, name, updated_at); с since — только изменённые после него."""
+    c = _reader().execute("""
+        SELECT user_id, answered, correct, name, updated_at
+        FROM leaderboard
+        WHERE week = ? AND (? IS NULL OR updated_at > ?)
+    """, (week, since, since))
+    return c.fetchall()
+
+
+def _leaderboard_prune(conn, before):
+    return conn.execute("DELETE FROM leaderboard WHERE week < ?", (before,)).rowcount
+
+
+def leaderboard_prune(before: date) -> int:
+    """Удаляет недели раньше before; возвращает число строк."""
+    return _write(_leaderboard_prune, before)
+
+
+# ======= Рассылки =======
+
+def _users_add(conn, user_ids):
+    conn.executemany("INSERT INTO users (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING", [(u,) for u in user_ids])
+
+
+def users_add(user_ids) -> None:
+    """Запомнить пользователей (получателей рассылок); уже известные пропускаются."""
+    _write(_users_add, list(user_ids))
+
+
+def _broadcast_create(conn, text, created_by):
+    return conn.execute("""
+        INSERT INTO broadcasts (text, created_by, total)
+        SELECT ?, ?, COUNT(*) FROM users
+        RETURNING id
+    """, (text, created_by)).fetchone()[0]
+
+
+def broadcast_create(text: str, created_by: int) -> int:
+    """Создать рассылку по всем пользователям; возвращает её id."""
+    return _write(_broadcast_create, text, created_by)
+
+
+def broadcast_get(broadcast_id: int):
+    rows = _dicts(_reader().execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)))
+    return rows[0] if rows else None
+
+
+def broadcast_list(status=None, limit=5):
+    """Последние рассылки (все или с указанным статусом)."""
+    return _dicts(_reader().execute("""
+        SELECT *
+        FROM broadcasts
+        WHERE :status IS NULL OR status = :status
+        ORDER BY id DESC
+        LIMIT :limit
+    """, {"status": status, "limit": limit}))
+
+
+def broadcast_open_recipients(broadcast_id: int, after_user_id: int):
+    """
+    Recipient ids by keyset pagination on user_id: each batch is a separate
+    short query, no read transaction stays open between batches. Users already
+    recorded for this broadcast are skipped. The handle only keeps the position.
+    """
+    return [broadcast_id, after_user_id]
+
+
+def broadcast_fetch_recipients(handle, batch_size: int = 100) -> list[int]:
+    """Next batch of recipient ids; empty when there are no more."""
+    broadcast_id, after_user_id = handle
+    rows = _reader().execute("""
+        SELECT u.user_id
+        FROM users u
+        WHERE u.user_id > ?
+          AND NOT EXISTS (
+              SELECT 1 FROM broadcast_recipients r
+              WHERE r.broadcast_id = ? AND r.user_id = u.user_id
+          )
+        ORDER BY u.user_id
+        LIMIT ?
+    """, (after_user_id, broadcast_id, batch_size)).fetchall()
+    if rows:
+        handle[1] = rows[-1][0]
+    return [row[0] for row in rows]
+
+
+def broadcast_close_recipients(handle) -> None:
+    """Nothing to release: no cursor stays open between batches."""
+
+
+def _broadcast_save_progress(conn, broadcast_id, results, last_user_id):
+    conn.executemany("""
+        INSERT INTO broadcast_recipients (broadcast_id, user_id, status, error)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (broadcast_id, user_id) DO NOTHING
+    """, [(broadcast_id, user_id, status, error) for user_id, status, error in results])
+    sent = sum(1 for _, status, _ in results if status == "sent")
+    return conn.execute("""
+        UPDATE broadcasts SET
+            sent = sent + ?,
+            failed = failed + ?,
+            last_user_id = MAX(last_user_id, ?)
+        WHERE id = ?
+        RETURNING status
+    """, (sent, len(results) - sent, last_user_id, broadcast_id)).fetchone()[0]
+
+
+def broadcast_save_progress(broadcast_id: int, results, last_user_id: int) -> str:
+    """Saves delivery results [(user_id, status, error)] and the resume checkpoint; returns the status."""
+    return _write(_broadcast_save_progress, broadcast_id, results, last_user_id)
+
+
+def _broadcast_finish(conn, broadcast_id, status):
+    return conn.execute("""
+        UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'running'
+    """, (status, broadcast_id)).rowcount > 0
+
+
+def broadcast_finish(broadcast_id: int, status: str) -> bool:
+    """Завершить рассылку (done / cancelled); False, если она уже не выполняется."""
+    return _write(_broadcast_finish, broadcast_id, status)
@@ -0,0 +1,314 @@
+"""
+Поиск почти-дубликатов в банке вопросов: шинглы + MinHash + LSH.
+
+Каждый вопрос (текст + отсортированные варианты) разбивается на символьные шинглы,
+по ним считается MinHash-сигнатура; сигнатуры раскладываются по LSH-корзинам (полосам),
+и сравниваются только вопросы, попавшие в общую корзину. Это почти линейно по размеру
+банка вместо попарного O(n²). Кандидаты проверяются по оценке сходства Жаккара
+и собираются в кластеры (union-find).
+
+    python dedupe.py check questions.csv questions_v2.csv [--out clusters.csv]
+    python dedupe.py check --db
+    python dedupe.py merge [--threshold 0.8]             # показать, что будет слито
+    python dedupe.py merge --apply                        # слить историю на выжившие вопросы
+    python dedupe.py import questions_v2.csv --bank v2    # добавить в банк v2 без дубликатов
+    python dedupe.py repair [--apply]                     # починить правильные ответы в БД
+
+Отдельно выводятся строки, где правильный ответ не совпадает ни с одним вариантом.
+Чаще всего ответ обрезан или отличается пробелами и значками из PDF (\uf00c) — такой
+ответ однозначно сводится к варианту (match_correct), import записывает его уже
+исправленным, а repair исправляет банк в БД. Остальное — обычно вариант, разрезанный
+по двум колонкам CSV; такие строки только перечисляются.
+"""
+import argparse
+import csv
+import random
+import re
+import sys
+import unicodedata
+from hashlib import blake2b
+
+from search import normalize
+
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+DEFAULT_THRESHOLD = 0.8
+
+# Перестановки — XOR 32-битного хеша шингла со случайной маской: min(map(mask.__xor__, ...))
+# считается на уровне C и на порядок быстрее арифметики (a*x + b) mod p в цикле Python
+_perm_rng = random.Random(42)
+PERMUTATION_MASKS = [_perm_rng.getrandbits(32) for _ in range(NUM_PERM)]
+
+NON_WORD_RE = re.compile(r"[\W_]+")
+
+
+# ======= MinHash / LSH =======
+
+def _hash32(shingle: str) -> int:
+    return int.from_bytes(blake2b(shingle.encode(), digest_size=4).digest(), "little")
+
+
+def shingles(q) -> set[int]:
+    text = " | ".join([q["question"]] + sorted(q["options"]))
+    text = NON_WORD_RE.sub(" ", normalize(text)).strip()
+    if len(text) <= SHINGLE_SIZE:
+        return {_hash32(text)}
+    return {_hash32(text[i:i + SHINGLE_SIZE]) for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(hashes: set[int]) -> tuple[int, ...]:
+    return tuple(min(map(mask.__xor__, hashes)) for mask in PERMUTATION_MASKS)
+
+
+def similarity(sig_a, sig_b) -> float:
+    """Оценка сходства Жаккара по сигнатурам."""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_PERM
+
+
+def lsh_params(threshold: float) -> tuple[int, int]:
+    """
+    (полос, строк в полосе) с порогом (1/b)^(1/r) не выше threshold,
+    чтобы не терять кандидатов; точный отбор — уже по similarity().
+    """
+    best = None
+    for rows in range(1, NUM_PERM + 1):
+        if NUM_PERM % rows:
+            continue
+        bands = NUM_PERM // rows
+        t = (1 / bands) ** (1 / rows)
+        if t <= threshold and (best is None or t > best[0]):
+            best = (t, bands, rows)
+    return best[1], best[2]
+
+
+def find_clusters(items, threshold=DEFAULT_THRESHOLD):
+    """
+    Кластеры почти-дубликатов: список списков индексов в items (кластеры из 2+ элементов),
+    плюс сигнатуры для оценки сходства.
+    """
+    bands, rows = lsh_params(threshold)
+    signatures = [minhash(shingles(q)) for q in items]
+
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    checked = set()
+    for band in range(bands):
+        buckets = {}
+        for i, sig in enumerate(signatures):
+            buckets.setdefault(sig[band * rows:(band + 1) * rows], []).append(i)
+        for members in buckets.values():
+            for j in range(1, len(members)):
+                for i in members[:j]:
+                    pair = (i, members[j])
+                    if pair in checked:
+                        continue
+                    checked.add(pair)
+                    if similarity(signatures[i], signatures[members[j]]) >= threshold:
+                        parent[find(members[j])] = find(i)
+
+    clusters = {}
+    for i in range(len(items)):
+        clusters.setdefault(find(i), []).append(i)
+    return [c for c in clusters.values() if len(c) > 1], signatures
+
+
+def _squash(text: str) -> str:
+    """Текст без пробелов и символов области частного использования (значки из PDF)."""
+    return "".join(ch for ch in normalize(text or "") if not ch.isspace() and unicodedata.category(ch) != "Co")
+
+
+def match_correct(q):
+    """
+    Вариант, которым на самом деле записан правильный ответ, или None. Кроме точного
+    совпадения — совпадение без пробелов и значков, обрезанный ответ (начало ровно одного
+    варианта) и обрезанный вариант (не короче половины ответа: хвост ушёл в соседнюю колонку).
+    """
+    correct = (q["correct"] or "").strip()
+    for option in q["options"]:
+        if option.strip() == correct:
+            return option
+    squashed = _squash(correct)
+    if not squashed:
+        return None
+    prefix = lambda s: s.startswith(squashed) or (squashed.startswith(s) and 2 * len(s) >= len(squashed))
+    for same in (lambda s: s == squashed, prefix):
+        hits = [o for o in q["options"] if same(_squash(o))]
+        if hits:
+            return hits[0] if len(hits) == 1 else None
+    return None
+
+
+def broken_rows(items):
+    """Строки, где правильного ответа нет среди вариантов (часто — вариант разрезан по колонкам)."""
+    return [
+        i for i, q in enumerate(items)
+        if (q["correct"] or "").strip() not in {o.strip() for o in q["options"]}
+    ]
+
+
+def _report_broken(items, broken):
+    unmatched = [i for i in broken if match_correct(items[i]) is None]
+    print(f"{len(broken)} rows with the correct answer not among options, "
+          f"{len(broken) - len(unmatched)} of them fixable (truncated or spacing):", file=sys.stderr)
+    for i in unmatched:
+        print(f"  {items[i]['source']}: {items[i]['question'][:80]}", file=sys.stderr)
+
+
+# ======= Источники =======
+
+def read_csv(path, bank=None):
+    items = []
+    with open(path, encoding="utf-8", newline="") as f:
+        for line_no, row in enumerate(csv.DictReader(f), start=2):
+            options = [row.get(k) for k in ("option_a", "option_b", "option_c", "option_d", "option_e")]
+            items.append({
+                "question": row["question"],
+                "options": [o for o in options if o],
+                "correct": row["correct_answer"],
+                "bank": row.get("bank") or bank,
+                "source": f"{path}:{line_no}",
+            })
+    return items
+
+
+def read_db():
+    from storage import load_questions
+    items = load_questions()
+    for q in items:
+        q["source"] = "db"
+    return items
+
+
+# ======= Команды =======
+
+def _print_clusters(items, clusters, signatures, out=None):
+    writer = csv.writer(out or sys.stdout)
+    writer.writerow(["cluster", "similarity", "source", "question", "correct_answer"])
+    for n, cluster in enumerate(clusters, 1):
+        head = cluster[0]
+        for i in cluster:
+            writer.writerow([
+                n, f"{similarity(signatures[head], signatures[i]):.2f}",
+                items[i]["source"], items[i]["question"], items[i]["correct"],
+            ])
+
+
+def cmd_check(args):
+    items = read_db() if args.db else [q for path in args.files for q in read_csv(path)]
+    clusters, signatures = find_clusters(items, args.threshold)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8", newline="") as f:
+            _print_clusters(items, clusters, signatures, f)
+    else:
+        _print_clusters(items, clusters, signatures)
+
+    broken = broken_rows(items)
+    print(f"\n{len(items)} questions, {len(clusters)} clusters of near-duplicates, "
+          f"{sum(len(c) - 1 for c in clusters)} redundant", file=sys.stderr)
+    if broken:
+        _report_broken(items, broken)
+
+
+def cmd_merge(args):
+    from storage import get_question_history_counts, merge_duplicate_question
+
+    items = read_db()
+    clusters, _ = find_clusters(items, args.threshold)
+    for cluster in clusters:
+        texts = [items[i]["question"] for i in cluster]
+        history = get_question_history_counts(texts)
+        # Выживает вопрос с самой большой историей ответов
+        survivor = max(texts, key=lambda t: (history.get(t, 0), -texts.index(t)))
+        print(f"KEEP  {survivor[:100]}")
+        for text in texts:
+            if text == survivor:
+                continue
+            print(f"  MERGE {text[:100]} ({history.get(text, 0)} users)")
+            if args.apply:
+                merge_duplicate_question(survivor, text)
+    if not args.apply and clusters:
+        print("\nDry run: add --apply to merge.", file=sys.stderr)
+
+
+def cmd_import(args):
+    from storage import insert_questions
+
+    existing = read_db()
+    new = [q for path in args.files for q in read_csv(path, args.bank)]
+    items = existing + new
+    clusters, _ = find_clusters(items, args.threshold)
+
+    # Из каждого кластера берём первый элемент (банк идёт раньше файлов), остальные пропускаем
+    skip = {i for cluster in clusters for i in sorted(cluster)[1:]}
+    to_insert = [q for i, q in enumerate(new, start=len(existing)) if i not in skip]
+    for i in sorted(skip):
+        if i >= len(existing):
+            print(f"SKIP  {items[i]['source']}: {items[i]['question'][:80]}", file=sys.stderr)
+    # Правильный ответ пишем текстом варианта: иначе ответы на вопрос не сводятся
+    # к номерам вариантов (в logs остаётся текст), а верный выбор засчитывается как ошибка
+    broken = broken_rows(to_insert)
+    for i in broken:
+        option = match_correct(to_insert[i])
+        if option is not None:
+            to_insert[i]["correct"] = option
+    if broken:
+        _report_broken(to_insert, broken)
+    added = insert_questions(to_insert)
+    print(f"Imported {added} of {len(new)} questions", file=sys.stderr)
+
+
+def cmd_repair(args):
+    from storage import update_correct_answers
+
+    items = read_db()
+    fixes = []
+    for i in broken_rows(items):
+        q = items[i]
+        option = match_correct(q)
+        if option is None:
+            continue
+        print(f"FIX   {q['question'][:60]}\n      {q['correct'][:60]!r} -> {option[:60]!r}")
+        fixes.append((q["id"], option, q["options"].index(option)))
+    print(f"\n{len(fixes)} correct answers to fix", file=sys.stderr)
+    if args.apply and fixes:
+        print(f"Re-encoded {update_correct_answers(fixes)} answer log rows", file=sys.stderr)
+    elif fixes:
+        print("Dry run: add --apply to fix.", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate detection for the question bank")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    check = sub.add_parser("check", help="report clusters of near-duplicates")
+    check.add_argument("files", nargs="*")
+    check.add_argument("--db", action="store_true", help="check the questions table")
+    check.add_argument("--out", help="write clusters to a CSV file")
+
+    merge = sub.add_parser("merge", help="merge user history of duplicates in the database")
+    merge.add_argument("--apply", action="store_true")
+
+    imp = sub.add_parser("import", help="import CSV files skipping near-duplicates")
+    imp.add_argument("files", nargs="+")
+    imp.add_argument("--bank", help="bank (topic) for rows without a bank column; default DEFAULT_BANK")
+
+    repair = sub.add_parser("repair", help="fix correct answers that match an option only after normalization")
+    repair.add_argument("--apply", action="store_true")
+
+    for p in (check, merge, imp):
+        p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == "check" and not (args.db or args.files):
+        parser.error("check: pass CSV files or --db")
+    {"check": cmd_check, "merge": cmd_merge, "import": cmd_import, "repair": cmd_repair}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Глобальная сложность вопросов: доля верных ответов по всем пользователям.
+
+Счётчики живут в памяти (O(1) на ответ и на чтение при показе результата),
+приращения копятся в pending и раз в FLUSH_INTERVAL секунд пишутся одним
+многострочным upsert в question_totals. Upsert возвращает итоговые значения,
+так что в многопроцессном режиме каждый воркер заодно подтягивает чужие ответы.
+
+    python difficulty.py export [difficulty.csv]   # отчёт для редакторов, от сложных к простым
+"""
+import asyncio
+import csv
+import logging
+import sys
+
+import storage
+from storage import question_totals_load, question_totals_add, iter_question_difficulty
+
+FLUSH_INTERVAL = 30
+MIN_ANSWERS = 20  # меньше ответов — процент не показываем
+
+log = logging.getLogger("difficulty")
+
+counts = {}   # question -> (answered, correct), включая ещё не записанные приращения
+pending = {}  # question -> (answered, correct), приращения с последнего flush
+
+
+def load() -> None:
+    counts.clear()
+    counts.update(question_totals_load())
+    for question, (answered, correct) in pending.items():
+        base_answered, base_correct = counts.get(question, (0, 0))
+        counts[question] = (base_answered + answered, base_correct + correct)
+
+
+def record(question: str, is_correct: bool) -> None:
+    inc = 1 if is_correct else 0
+    answered, correct = counts.get(question, (0, 0))
+    counts[question] = (answered + 1, correct + inc)
+    answered, correct = pending.get(question, (0, 0))
+    pending[question] = (answered + 1, correct + inc)
+
+
+def correct_rate(question: str):
+    """Процент верных ответов или None, если статистики пока мало."""
+    answered, correct = counts.get(question, (0, 0))
+    if answered < MIN_ANSWERS:
+        return None
+    return round(correct / answered * 100)
+
+
+async def flush() -> None:
+    if not pending:
+        return
+    batch = dict(pending)
+    pending.clear()
+    try:
+        fresh = await asyncio.to_thread(question_totals_add, batch)
+    except storage.Error:
+        # Вернём приращения, чтобы записать их в следующий раз
+        for question, (answered, correct) in batch.items():
+            a, c = pending.get(question, (0, 0))
+            pending[question] = (a + answered, c + correct)
+        raise
+    for question, (answered, correct) in fresh.items():
+        extra_answered, extra_correct = pending.get(question, (0, 0))
+        counts[question] = (answered + extra_answered, correct + extra_correct)
+
+
+async def flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except storage.Error as e:
+            log.warning("Difficulty flush failed: %s", e)
+
+
+def export_csv(out, min_answered: int = 1) -> int:
+    """Потоковая выгрузка отчёта о сложности в CSV; возвращает число строк."""
+    writer = csv.writer(out)
+    writer.writerow(["question", "answered", "correct", "correct_rate"])
+    n = 0
+    for row in iter_question_difficulty(min_answered):
+        writer.writerow(row)
+        n += 1
+    return n
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        sys.exit("usage: python difficulty.py export [file.csv]")
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w", encoding="utf-8", newline="") as f:
+            print(f"{export_csv(f)} questions exported", file=sys.stderr)
+    else:
+        export_csv(sys.stdout)
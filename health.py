@@ -0,0 +1,182 @@
+"""
+HTTP-проверки живости и готовности для Docker HEALTHCHECK и status.sh.
+
+    GET /healthz — процесс отвечает и задержка цикла событий не больше HEALTH_MAX_LAG
+    GET /readyz  — старт завершён, банк по умолчанию загружен и цикл событий не завис (иначе 503)
+
+Ответ — JSON: время работы, задержка цикла событий, размеры загруженных банков,
+состояние БД (ok / degraded — бот в автономном режиме, ответы идут в журнал / down)
+и длительность фаз старта. Сервер слушает HEALTH_HOST:HEALTH_PORT (0 — выключен),
+в многопроцессном режиме воркер N — порт HEALTH_PORT + N. aiohttp.web импортируется,
+только когда сервер включён.
+
+Синхронная часть старта (схема и банк по умолчанию в main()) идёт до цикла событий бота:
+на это время сервер поднимается в отдельном потоке (start_early) и /readyz отвечает 503
+с уже записанными фазами.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import banks
+import config
+import journal
+import storage
+
+LAG_INTERVAL = 1.0
+LAG_WINDOW = 30    # замеров: задержка — худшая за последние ~30 с, чтобы проверка раз в 30 с её видела
+
+log = logging.getLogger("health")
+
+started = time.perf_counter()  # модуль импортируется одним из первых: отсчёт времени старта
+phases = {}                    # фаза старта -> мс
+ready = False
+lags = deque(maxlen=LAG_WINDOW)  # задержки цикла событий за окно, секунд
+_runner = None
+_lag_task = None
+_early = None                  # (цикл, поток) сервера на время синхронного старта
+
+
+def elapsed_ms() -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def record(name: str, ms: float) -> None:
+    phases[name] = ms
+
+
+def timed_call(name: str, func, *args):
+    """func(*args) с записью длительности в phases (для потоков и синхронного кода)."""
+    t = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        record(name, round((time.perf_counter() - t) * 1000, 1))
+
+
+async def timed(name: str, awaitable):
+    t = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        record(name, round((time.perf_counter() - t) * 1000, 1))
+
+
+def set_ready() -> None:
+    global ready
+    ready = True
+    record("total", elapsed_ms())
+    log.info("Ready: %s", ", ".join(f"{name} {ms:.0f} ms" for name, ms in phases.items()))
+
+
+def loop_lag() -> float:
+    return max(lags, default=0.0)
+
+
+async def _measure_lag() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(loop.time() - t - LAG_INTERVAL, 0.0))
+
+
+async def _database_state() -> str:
+    try:
+        await journal.call(storage.ping)
+        return "ok"
+    except journal.DatabaseUnavailable:
+        return "degraded" if journal.breaker.is_open else "down"
+    except storage.Error:
+        return "down"
+
+
+def _status():
+    return {
+        "worker": config.WORKER_INDEX,
+        "uptime": round(time.perf_counter() - started, 1),
+        "loop_lag_ms": round(loop_lag() * 1000, 1),
+    }
+
+
+async def _healthz(request):
+    from aiohttp import web
+    body = _status()
+    alive = loop_lag() <= config.HEALTH_MAX_LAG
+    body["status"] = "ok" if alive else "lagging"
+    return web.json_response(body, status=200 if alive else 503)
+
+
+async def _readyz(request):
+    from aiohttp import web
+    default = banks.loaded.get(config.DEFAULT_BANK)
+    body = _status()
+    body.update({
+        "ready": ready,
+        "bank": len(default.questions) if default else 0,
+        "banks": {name: len(bank.questions) for name, bank in banks.loaded.items()},
+        "db": await _database_state(),
+        "startup_ms": phases,
+    })
+    ok = ready and bool(body["bank"]) and loop_lag() <= config.HEALTH_MAX_LAG
+    return web.json_response(body, status=200 if ok else 503)
+
+
+async def start() -> None:
+    global _runner, _lag_task
+    if not config.HEALTH_PORT or _runner is not None:
+        return
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/healthz", _healthz)
+    app.router.add_get("/readyz", _readyz)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = config.HEALTH_PORT + config.WORKER_INDEX
+    try:
+        await web.TCPSite(runner, config.HEALTH_HOST, port).start()
+    except OSError as e:
+        log.warning("Health endpoint disabled, cannot listen on %s:%s: %s", config.HEALTH_HOST, port, e)
+        await runner.cleanup()
+        return
+    _runner = runner
+    _lag_task = asyncio.create_task(_measure_lag())
+
+
+async def stop() -> None:
+    global _runner, _lag_task, ready
+    ready = False
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+        lags.clear()
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+def start_early() -> None:
+    """Сервер в своём потоке, пока main() грузит схему и банк; до start() его останавливает stop_early()."""
+    global _early
+    if not config.HEALTH_PORT or _early is not None:
+        return
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="health", daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(start(), loop).result()
+    _early = loop, thread
+
+
+def stop_early() -> None:
+    """Освобождает порт для сервера в цикле событий бота (или воркера 0 в многопроцессном режиме)."""
+    global _early
+    if _early is None:
+        return
+    loop, thread = _early
+    _early = None
+    asyncio.run_coroutine_threadsafe(stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
@@ -0,0 +1,225 @@
+"""
+Автономный режим на время, когда база данных недоступна или тормозит.
+
+Запросы горячего пути (выбор вопроса, запись ответа) идут через call(): с таймаутом
+DB_TIMEOUT и через предохранитель (circuit breaker). После DB_BREAKER_THRESHOLD сбоев
+подряд предохранитель размыкается, и DB_BREAKER_RESET секунд в БД никто не ходит —
+вопросы выдаются из банка в памяти, а ответы пишутся в локальный журнал (JSON Lines).
+Затем один пробный запрос: удался — работаем как обычно, нет — ждём ещё.
+
+Запись в журнал пакетная: строки копятся в памяти и раз в FSYNC_INTERVAL ложатся
+на диск одним write + fsync. Когда БД снова отвечает, журнал доигрывается пачками.
+У каждого ответа свой event_id (уникален в logs), поэтому повторная доигровка после
+сбоя и ответы, которые на самом деле успели записаться до таймаута, не задваиваются.
+"""
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+from datetime import date, datetime
+
+import config
+import storage
+from storage import replay_answers
+
+FSYNC_INTERVAL = 0.2
+REPLAY_INTERVAL = 5
+REPLAY_BATCH = 500
+REPLAY_TIMEOUT = 30
+
+log = logging.getLogger("journal")
+
+# Сбои связи и таймауты; ошибки в самих запросах (IntegrityError и т. п.) — не повод
+# уходить в автономный режим, а в журнале такой ответ доигрывался бы вечно
+DB_DOWN_ERRORS = (*storage.CONNECTION_ERRORS, asyncio.TimeoutError)
+
+
+class DatabaseUnavailable(Exception):
+    """Предохранитель разомкнут, либо запрос упал по связи или не уложился в таймаут."""
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.probing = True  # пропускаем один пробный запрос
+        return True
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            log.info("Database is back, leaving degraded mode")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.warning("Database unavailable, switching to degraded mode")
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(config.DB_BREAKER_THRESHOLD, config.DB_BREAKER_RESET)
+
+
+async def call(func, *args, timeout=None):
+    """func(*args) в потоке, с таймаутом и через предохранитель."""
+    if not breaker.allow():
+        raise DatabaseUnavailable(func.__name__)
+    probe = breaker.probing
+    try:
+        result = await asyncio.wait_for(asyncio.to_thread(func, *args), timeout or config.DB_TIMEOUT)
+    except DB_DOWN_ERRORS as e:
+        breaker.failure()
+        raise DatabaseUnavailable(func.__name__) from e
+    except Exception:
+        breaker.success()  # БД ответила, пусть и ошибкой в самом запросе
+        raise
+    finally:
+        # Пробный запрос завершён любым исходом (в том числе отменой) — иначе
+        # предохранитель так и остался бы разомкнутым без новых проб
+        if probe:
+            breaker.probing = False
+    breaker.success()
+    return result
+
+
+# ======= Журнал =======
+
+_buffer = []               # строки, ещё не записанные на диск
+_file_lock = asyncio.Lock()
+
+
+def path(index=None) -> str:
+    name = f"journal-{config.WORKER_INDEX if index is None else index}.jsonl"
+    return os.path.join(config.JOURNAL_DIR, name)
+
+
+def _dump(answer: dict) -> str:
+    line = {**answer, "date": answer["date"].isoformat()}
+    if answer.get("answered_ts"):
+        line["answered_ts"] = answer["answered_ts"].isoformat()
+    return json.dumps(line, ensure_ascii=False)
+
+
+def append(answer: dict) -> None:
+    """Ответ в формате _record_answers_batch (с event_id); на диск попадёт при ближайшем flush."""
+    _buffer.append(_dump(answer))
+
+
+def _write(lines, file_path=None) -> None:
+    os.makedirs(config.JOURNAL_DIR, exist_ok=True)
+    with open(file_path or path(), "a", encoding="utf-8") as f:
+        f.write("".join(line + "\n" for line in lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def _flush_locked() -> None:
+    if not _buffer:
+        return
+    lines = _buffer[:]
+    _buffer.clear()
+    await asyncio.to_thread(_write, lines)
+
+
+async def flush() -> None:
+    async with _file_lock:
+        await _flush_locked()
+
+
+async def flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FSYNC_INTERVAL)
+        try:
+            await flush()
+        except OSError as e:
+            log.error("Journal write failed: %s", e)
+
+
+def _read(file_path) -> list[dict]:
+    answers = []
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                answer = json.loads(line)
+            except ValueError:
+                continue  # недописанная строка при аварийной остановке
+            answer["date"] = date.fromisoformat(answer["date"])
+            if answer.get("answered_ts"):
+                answer["answered_ts"] = datetime.fromisoformat(answer["answered_ts"])
+            answers.append(answer)
+    return answers
+
+
+def _orphans() -> list[int]:
+    """
+    Номера журналов воркеров, которых больше нет (WORKERS уменьшили): их доигрывает воркер 0,
+    иначе ответы из них не попали бы в БД никогда.
+    """
+    if config.WORKER_INDEX != 0:
+        return []
+    indexes = set()
+    for file_path in glob.glob(os.path.join(config.JOURNAL_DIR, "journal-*.jsonl*")):
+        try:
+            index = int(os.path.basename(file_path)[len("journal-"):].split(".", 1)[0])
+        except ValueError:
+            continue
+        if index >= config.WORKERS:
+            indexes.add(index)
+    return sorted(indexes)
+
+
+async def replay() -> dict:
+    """Доигрывает свой журнал и осиротевшие (см. _orphans). Возвращает {user_id: свежие агрегаты}."""
+    totals = {}
+    for index in (config.WORKER_INDEX, *_orphans()):
+        totals.update(await _replay_file(index))
+    return totals
+
+
+async def _replay_file(index) -> dict:
+    """
+    Журнал сначала переименовывается, новые ответы идут в свежий файл; переименованный
+    удаляется только после записи всех пачек, а при сбое связи доигрывается заново.
+    Пачка, на которой упал сам запрос, откладывается в .rejected: повтор её не исправит,
+    а незавершённый .replay не давал бы ротировать живой журнал.
+    """
+    live = path(index)
+    replaying = live + ".replay"
+    async with _file_lock:
+        await _flush_locked()
+        if not os.path.exists(replaying):
+            if not os.path.exists(live):
+                return {}
+            os.replace(live, replaying)
+
+    answers = await asyncio.to_thread(_read, replaying)
+    totals = {}
+    for i in range(0, len(answers), REPLAY_BATCH):
+        batch = answers[i:i + REPLAY_BATCH]
+        try:
+            totals.update(await call(replay_answers, batch, timeout=REPLAY_TIMEOUT))
+        except (storage.Error, KeyError, TypeError, ValueError) as e:
+            await asyncio.to_thread(_write, [_dump(a) for a in batch], live + ".rejected")
+            log.error("Journal batch rejected (%d answers moved to %s): %s", len(batch), live + ".rejected", e)
+    os.remove(replaying)
+    log.info("Journal replayed: %d answers", len(answers))
+    return totals
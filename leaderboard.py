@@ -0,0 +1,263 @@
+"""
+Рейтинг недели (/top): больше всего верных ответов и лучшая точность.
+
+Счётчики пользователей за текущую неделю живут в памяти, поверх них — два индекса
+RankIndex (дерево Фенвика по значению счёта), так что ответ, место пользователя
+("153 из 4 210") и первые N мест стоят O(log M), без ORDER BY по всем пользователям.
+Приращения копятся в pending и раз в FLUSH_INTERVAL секунд пишутся одним upsert
+в leaderboard (неделя, пользователь, ответов, верных); следом читаются строки,
+изменённые с прошлой синхронизации, — в многопроцессном режиме так подтягиваются
+ответы с других воркеров. При старте текущая неделя загружается из таблицы.
+
+Неделя начинается в понедельник (UTC). С её сменой индексы строятся заново,
+недели старше прошлой удаляются из таблицы (в воркере 0).
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import config
+import storage
+from storage import leaderboard_add, leaderboard_load, leaderboard_prune
+
+FLUSH_INTERVAL = 30
+MIN_ANSWERS = 20       # меньше ответов за неделю — в рейтинг точности не попадает
+SYNC_OVERLAP = timedelta(seconds=60)  # запас на транзакции, закоммиченные позже своего updated_at
+
+log = logging.getLogger("leaderboard")
+
+
+class RankIndex:
+    """
+    Пользователи, упорядоченные по целому неотрицательному счёту.
+    Дерево Фенвика хранит, сколько пользователей имеют каждый счёт: место — это
+    1 + число пользователей с большим счётом (равные делят место), k-й по счёту
+    находится спуском по дереву. Дерево удваивается, когда счёт выходит за размер.
+    """
+
+    def __init__(self, size: int = 1024):
+        self._tree = [0] * (size + 1)
+        self._users = {}   # счёт -> set(user_id)
+        self.scores = {}   # user_id -> счёт
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _add(self, score, delta):
+        i = score + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _count_upto(self, score) -> int:
+        """Сколько пользователей со счётом <= score."""
+        i = min(score + 1, len(self._tree) - 1)
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _grow(self, score):
+        size = len(self._tree) - 1
+        while size <= score:
+            size *= 2
+        self._tree = [0] * (size + 1)
+        for s, users in self._users.items():
+            self._add(s, len(users))
+
+    def set(self, user_id, score: int) -> None:
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self.discard(user_id)
+        if score >= len(self._tree) - 1:
+            self._grow(score)
+        self.scores[user_id] = score
+        self._users.setdefault(score, set()).add(user_id)
+        self._add(score, 1)
+
+    def discard(self, user_id) -> None:
+        score = self.scores.pop(user_id, None)
+        if score is None:
+            return
+        users = self._users[score]
+        users.discard(user_id)
+        if not users:
+            del self._users[score]
+        self._add(score, -1)
+
+    def rank(self, user_id):
+        """Место пользователя (1 — лучший) или None, если его нет в индексе."""
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return len(self.scores) - self._count_upto(score) + 1
+
+    def _kth_smallest(self, k: int) -> int:
+        """Счёт k-го (с 1) пользователя по возрастанию."""
+        pos, step = 0, 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] < k:
+                pos = nxt
+                k -= self._tree[nxt]
+            step >>= 1
+        return pos  # индекс в дереве pos + 1 соответствует счёту pos
+
+    def top(self, n: int):
+        """Первые места: [(место, счёт, set(user_id))] группами равного счёта, пока не наберётся n."""
+        groups, taken = [], 0
+        while taken < n and taken < len(self.scores):
+            score = self._kth_smallest(len(self.scores) - taken)
+            users = self._users[score]
+            groups.append((taken + 1, score, users))
+            taken += len(users)
+        return groups
+
+
+def week_start(day=None):
+    day = day or datetime.now(timezone.utc).date()
+    return day - timedelta(days=day.weekday())
+
+
+week = week_start()
+counts = {}        # user_id -> (answered, correct) за неделю, включая ещё не записанные приращения
+names = {}         # user_id -> имя для таблицы
+pending = {}       # неделя -> {user_id: (answered, correct)}, приращения с последнего flush
+synced_at = None   # updated_at последней прочитанной строки
+pruned_for = None  # неделя, для которой старые недели уже удалены
+boards = {"solved": RankIndex(), "accuracy": RankIndex()}
+
+
+def _index(user_id) -> None:
+    answered, correct = counts.get(user_id, (0, 0))
+    if answered <= 0:
+        counts.pop(user_id, None)
+        for board in boards.values():
+            board.discard(user_id)
+        return
+    boards["solved"].set(user_id, correct)
+    if answered >= MIN_ANSWERS:
+        boards["accuracy"].set(user_id, correct * 1000 // answered)  # в десятых долях процента
+    else:
+        boards["accuracy"].discard(user_id)
+
+
+def _apply(rows) -> None:
+    """Строки из БД (user_id, answered, correct, name, updated_at): итог = БД + свои незаписанные приращения."""
+    global synced_at
+    own = pending.get(week, {})
+    for user_id, answered, correct, name, updated_at in rows:
+        extra_answered, extra_correct = own.get(user_id, (0, 0))
+        counts[user_id] = (answered + extra_answered, correct + extra_correct)
+        if name:
+            names.setdefault(user_id, name)
+        _index(user_id)
+        if synced_at is None or updated_at > synced_at:
+            synced_at = updated_at
+
+
+def _rotate(new_week) -> None:
+    global week, synced_at
+    if new_week != week:
+        log.info("Leaderboard: week %s -> %s", week, new_week)
+    week = new_week
+    synced_at = None
+    counts.clear()
+    boards["solved"] = RankIndex()
+    boards["accuracy"] = RankIndex()
+    # Рейтинг новой недели пуст: имена нужны только незаписанным приращениям прошлой (flush),
+    # остальные подтянутся с ответами и из таблицы — иначе словарь рос бы от недели к неделе
+    kept = {user_id: names[user_id] for delta in pending.values() for user_id in delta if user_id in names}
+    names.clear()
+    names.update(kept)
+
+
+def load() -> None:
+    """Загрузка текущей недели из БД (блокирующая — вызывать из потока)."""
+    _rotate(week_start())
+    _apply(leaderboard_load(week))
+
+
+def record(user_id: int, is_correct: bool, name: str = None) -> None:
+    current = week_start()
+    if current != week:
+        _rotate(current)
+    inc = 1 if is_correct else 0
+    answered, correct = counts.get(user_id, (0, 0))
+    counts[user_id] = (answered + 1, correct + inc)
+    delta = pending.setdefault(week, {})
+    answered, correct = delta.get(user_id, (0, 0))
+    delta[user_id] = (answered + 1, correct + inc)
+    if name:
+        names[user_id] = name
+    _index(user_id)
+
+
+def forget(user_id: int) -> None:
+    """Пользователь сбросил статистику (/reset); строки в БД обнуляет reset_user_stats."""
+    counts.pop(user_id, None)
+    names.pop(user_id, None)
+    for delta in pending.values():
+        delta.pop(user_id, None)
+    _index(user_id)
+
+
+def rank(user_id: int, board: str = "solved"):
+    """(место, всего в рейтинге) или None."""
+    index = boards[board]
+    place = index.rank(user_id)
+    return (place, len(index)) if place is not None else None
+
+
+def top(board: str = "solved", n: int = 10):
+    """
+    [(место, user_id, имя, ответов, верных)]. Внутри равного счёта выше тот, у кого
+    по верным ответам меньше попыток, а по точности — больше ответов.
+    """
+    sign = -1 if board == "accuracy" else 1
+    result = []
+    for place, _score, users in boards[board].top(n):
+        for user_id in sorted(users, key=lambda u: sign * counts[u][0]):
+            answered, correct = counts[user_id]
+            result.append((place, user_id, names.get(user_id), answered, correct))
+    return result[:n]
+
+
+async def flush() -> None:
+    global pruned_for
+    current = week_start()
+    if current != week:
+        _rotate(current)
+    if config.WORKER_INDEX == 0 and pruned_for != current:
+        await asyncio.to_thread(leaderboard_prune, current - timedelta(weeks=1))
+        pruned_for = current
+    for batch_week in sorted(pending):
+        batch = pending.pop(batch_week)
+        if not batch:
+            continue
+        rows = {user_id: (answered, correct, names.get(user_id)) for user_id, (answered, correct) in batch.items()}
+        try:
+            await asyncio.to_thread(leaderboard_add, batch_week, rows)
+        except storage.Error:
+            # Вернём приращения, чтобы записать их в следующий раз
+            delta = pending.setdefault(batch_week, {})
+            for user_id, (answered, correct) in batch.items():
+                a, c = delta.get(user_id, (0, 0))
+                delta[user_id] = (a + answered, c + correct)
+            raise
+    since = synced_at - SYNC_OVERLAP if synced_at is not None else None
+    rows = await asyncio.to_thread(leaderboard_load, current, since)
+    if week == current:  # неделя не сменилась, пока шёл запрос
+        _apply(rows)
+
+
+async def flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except storage.Error as e:
+            log.warning("Leaderboard flush failed: %s", e)
@@ -0,0 +1,145 @@
+"""
+Профилирование живого процесса по запросу (/profile N у администратора или SIGUSR1).
+В многопроцессном режиме /profile снимает только воркер, принявший команду; SIGUSR1
+супервизору пересылается всем воркерам (файлы profile-w<N>-...).
+
+Семплирующий профайлер: отдельный поток раз в SAMPLE_INTERVAL снимает стеки всех потоков
+через sys._current_frames() — и цикла событий, и потоков to_thread, где работают запросы к БД.
+Код бота не инструментируется, так что накладные расходы — один обход стеков на семпл.
+Результат — файл в формате folded stacks ("поток;f1;f2;f3 N"), его понимают flamegraph.pl
+и speedscope.
+
+На время сессии цикл событий переводится в отладочный режим с порогом SLOW_CALLBACK:
+asyncio пишет предупреждение о каждом колбэке/шаге задачи дольше порога, они
+собираются в отдельный файл. Отладочный режим сам по себе не бесплатный (запоминает
+место создания каждого колбэка), поэтому длительность сессии ограничена MAX_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005
+SLOW_CALLBACK = 0.1
+MAX_SECONDS = 120
+TOP_FUNCTIONS = 10
+
+# Листовые кадры простаивающих потоков: ожидание в select() и свободный воркер пула
+IDLE_FRAMES = {("select", "selectors.py"), ("_worker", "thread.py")}
+
+active = False
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.loop_thread = threading.get_ident()  # создаётся из потока цикла событий
+        self.stacks = Counter()
+        self.samples = 0
+        self.loop_idle = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (code.co_name, os.path.basename(code.co_filename)) in IDLE_FRAMES:
+                    if ident == self.loop_thread:
+                        self.loop_idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def top_functions(self, n: int = TOP_FUNCTIONS):
+        """Самые частые листовые кадры (собственное время): [(функция, семплов)]."""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
+
+
+class _SlowCallbacks(logging.Handler):
+    """Сбор предупреждений asyncio о медленных колбэках за время сессии."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.getMessage()}")
+
+
+def _write(path: str, lines) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(line + "\n" for line in lines)
+
+
+async def run(seconds: float, out_dir: str, tag: str = "") -> dict:
+    """
+    Профилирует текущий процесс `seconds` секунд и пишет в out_dir два файла:
+    profile-<tag><время>.folded и .slow.log. Возвращает сводку.
+    Одновременно идёт не больше одной сессии (RuntimeError).
+    """
+    global active
+    if active:
+        raise RuntimeError("profiling is already running")
+    active = True
+    seconds = min(seconds, MAX_SECONDS)
+    loop = asyncio.get_running_loop()
+    debug, slow_duration = loop.get_debug(), loop.slow_callback_duration
+    slow = _SlowCallbacks()
+    asyncio_log = logging.getLogger("asyncio")
+    sampler = Sampler()
+    try:
+        asyncio_log.addHandler(slow)
+        loop.slow_callback_duration = SLOW_CALLBACK
+        loop.set_debug(True)
+        sampler.start()
+        await asyncio.sleep(seconds)
+    finally:
+        loop.set_debug(debug)
+        loop.slow_callback_duration = slow_duration
+        asyncio_log.removeHandler(slow)
+        await asyncio.to_thread(sampler.stop)
+        active = False
+
+    base = os.path.join(out_dir, f"profile-{tag}{time.strftime('%Y%m%d-%H%M%S')}")
+    folded = [f"{stack} {count}" for stack, count in sampler.stacks.most_common()]
+    await asyncio.to_thread(_write, base + ".folded", folded)
+    await asyncio.to_thread(_write, base + ".slow.log", slow.records)
+    return {
+        "seconds": seconds,
+        "samples": sampler.samples,
+        "stacks": sum(sampler.stacks.values()),
+        "loop_busy": 1 - sampler.loop_idle / sampler.samples if sampler.samples else 0.0,
+        "top": sampler.top_functions(),
+        "slow_callbacks": len(slow.records),
+        "folded_path": base + ".folded",
+        "slow_path": base + ".slow.log",
+    }
@@ -0,0 +1,273 @@
+"""
+Воспроизведение записанного потока апдейтов (capture.py) — для замеров и поиска регрессий.
+
+    python replay.py capture/capture-0.jsonl* [--speed 1|10|max] [--sqlite replay.db]
+                     [--questions questions.csv] [--out new.json] [--compare old.json]
+
+Бот поднимается целиком (startup/shutdown, фоновые задачи), но Bot API заменён заглушкой
+(--api-latency мс на вызов), а база — локальная: --sqlite ФАЙЛ (пустую можно наполнить
+из --questions) или та, что задана в окружении (DB_*). Файлы нескольких воркеров и ротации
+сливаются по времени получения. Паузы между апдейтами берутся из записи и делятся на --speed;
+max — без пауз. Апдейты одного пользователя обрабатываются по очереди в записанном порядке
+(живой пользователь ждёт ответа, прежде чем нажать следующую кнопку), разных — параллельно;
+--concurrency ограничивает число одновременно обрабатываемых (по умолчанию без ограничения,
+как при long polling). Фоновые задачи бота работают по-настоящему, в том числе возобновление
+рассылок, — поэтому база должна быть локальной копией, а не боевой.
+
+Задержка апдейта — от момента, когда он должен был прийти, до конца обработки, так что
+очередь при перегрузке в неё входит. Пропускная способность имеет смысл при --speed max.
+Выбор вопросов случайный, поэтому random фиксируется (--seed): две сборки на одной записи
+получают одинаковый поток. --out сохраняет отчёт в JSON, --compare печатает разницу
+с отчётом другой сборки.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, Update
+
+PERCENTILES = (50, 95, 99)
+
+
+class StubSession(BaseSession):
+    """Bot API без сети: считает вызовы, на отправку/правку сообщения отвечает Message."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.__returning__ is Message:
+            chat_id = getattr(method, "chat_id", None)
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b""
+
+    async def close(self):
+        pass
+
+
+def read_capture(paths) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # недописанная строка
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def update_user(raw: dict):
+    for key in ("message", "callback_query", "edited_message", "inline_query"):
+        sender = (raw.get(key) or {}).get("from")
+        if sender:
+            return sender["id"]
+    return None
+
+
+def update_kind(raw: dict) -> str:
+    """Вид апдейта для отчёта: команда, префикс callback_data или тип апдейта."""
+    message = raw.get("message")
+    if message:
+        text = message.get("text") or ""
+        return text.split()[0].split("@")[0] if text.startswith("/") else "message"
+    callback = raw.get("callback_query")
+    if callback:
+        return "callback:" + (callback.get("data") or "").split("_")[0]
+    return next((key for key in raw if key != "update_id"), "other")
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f"p{p}": round(values[int(p / 100 * (len(values) - 1))], 2) for p in PERCENTILES}
+    result["max"] = round(values[-1], 2)
+    return result
+
+
+def build_label() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def replay(app, records, speed, concurrency, session) -> dict:
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency) if concurrency else contextlib.nullcontext()
+    latencies = defaultdict(list)  # вид апдейта -> [мс]
+    errors = Counter()
+    last_task = {}                 # user_id -> задача его предыдущего апдейта
+
+    async def run_one(raw, due, previous):
+        update = Update.model_validate(raw, context={"bot": app.bot})
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with semaphore:
+            try:
+                await app.dp.feed_update(app.bot, update)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+        latencies[update_kind(raw)].append((loop.time() - due) * 1000)
+
+    await app.dp.emit_startup(bot=app.bot)
+    t0 = records[0]["t"]
+    start = loop.time()
+    tasks = []
+    for record in records:
+        due = start if speed is None else start + (record["t"] - t0) / speed
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        user_id = update_user(record["update"])
+        task = asyncio.create_task(run_one(record["update"], due, last_task.get(user_id)))
+        if user_id is not None:
+            last_task[user_id] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    seconds = loop.time() - start
+    await app.dp.emit_shutdown(bot=app.bot)
+
+    all_latencies = [ms for values in latencies.values() for ms in values]
+    return {
+        "build": build_label(),
+        "updates": len(records),
+        "speed": speed or "max",
+        "seconds": round(seconds, 3),
+        "throughput": round(len(records) / seconds, 1) if seconds else None,
+        "latency_ms": percentiles(all_latencies),
+        "captured_ms": percentiles([r["ms"] for r in records if "ms" in r]),
+        "by_kind": {
+            kind: {"count": len(values), **percentiles(values)}
+            for kind, values in sorted(latencies.items(), key=lambda item: -len(item[1]))
+        },
+        "errors": dict(errors),
+        "captured_errors": dict(Counter(r["error"] for r in records if r.get("error"))),
+        "api_calls": dict(session.calls.most_common()),
+    }
+
+
+def print_report(report, out=sys.stdout) -> None:
+    print(f"Build {report['build']}: {report['updates']} updates in {report['seconds']} s "
+          f"(speed {report['speed']}), {report['throughput']} updates/s", file=out)
+    print(f"Latency, ms: {report['latency_ms']}", file=out)
+    print(f"Captured handling time, ms: {report['captured_ms']}", file=out)
+    for kind, stats in report["by_kind"].items():
+        print(f"  {kind:<24} {stats}", file=out)
+    if report["errors"]:
+        print(f"Errors: {report['errors']} (captured: {report['captured_errors']})", file=out)
+    print(f"API calls: {report['api_calls']}", file=out)
+
+
+def _delta(new, old) -> str:
+    if new is None or old is None:
+        return "n/a"
+    change = f" ({(new - old) / old * 100:+.1f}%)" if old else ""
+    return f"{old} -> {new}{change}"
+
+
+def print_comparison(report, base, out=sys.stdout) -> None:
+    print(f"\n{base['build']} -> {report['build']}", file=out)
+    if base["updates"] != report["updates"] or base["speed"] != report["speed"]:
+        print("Warning: reports come from different captures or speeds", file=out)
+    print(f"  throughput, updates/s: {_delta(report['throughput'], base['throughput'])}", file=out)
+    for key in report["latency_ms"]:
+        print(f"  latency {key}, ms: {_delta(report['latency_ms'][key], base['latency_ms'].get(key))}", file=out)
+    for kind, stats in report["by_kind"].items():
+        old = base["by_kind"].get(kind, {})
+        print(f"  {kind:<24} p95: {_delta(stats.get('p95'), old.get('p95'))}", file=out)
+    calls = set(report["api_calls"]) | set(base["api_calls"])
+    for method in sorted(calls):
+        new, old = report["api_calls"].get(method, 0), base["api_calls"].get(method, 0)
+        if new != old:
+            print(f"  API {method}: {old} -> {new}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured update stream against a stubbed Bot API")
+    parser.add_argument("files", nargs="+", help="capture files (capture-*.jsonl*)")
+    parser.add_argument("--speed", default="1", help="1, N (times faster) or max")
+    parser.add_argument("--concurrency", type=int, default=0, help="updates handled at the same time (0: no limit)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency, ms")
+    parser.add_argument("--sqlite", help="use an SQLite database file instead of DB_* settings")
+    parser.add_argument("--questions", help="CSV to fill an empty question bank from")
+    parser.add_argument("--app", default="bot", help="bot module (bot or test_bot)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="save the report as JSON")
+    parser.add_argument("--compare", help="JSON report of another build to compare with")
+    args = parser.parse_args()
+    speed = None if args.speed == "max" else float(args.speed)
+
+    # До импорта config: своя база, состояние во временном каталоге, без записи апдейтов и HTTP-проверок
+    if args.sqlite:
+        os.environ["DB_BACKEND"] = "sqlite"
+        os.environ["SQLITE_PATH"] = args.sqlite
+    state_dir = tempfile.mkdtemp(prefix="replay-")
+    os.environ["CHECKPOINT_DIR"] = os.environ["JOURNAL_DIR"] = state_dir
+    os.environ["CAPTURE_DIR"] = ""
+    os.environ["HEALTH_PORT"] = "0"
+    os.environ.setdefault("BOT_TOKEN", "123456:replay")
+    os.environ.setdefault("BOT_TOKEN_TEST", os.environ["BOT_TOKEN"])
+
+    records = read_capture(args.files)
+    if not records:
+        parser.error("no updates in the capture")
+
+    app = importlib.import_module(args.app)
+    import config
+    import storage
+    storage.init_db()
+    if args.questions and not storage.get_bank_sizes():
+        from dedupe import read_csv
+        storage.insert_questions(read_csv(args.questions))
+    app.set_question_bank(storage.load_questions(config.DEFAULT_BANK))
+    session = StubSession(args.api_latency / 1000)
+    app.bot.session = session
+    app.dp.include_router(app.router)
+
+    random.seed(args.seed)
+    started = time.perf_counter()
+    report = asyncio.run(replay(app, records, speed, args.concurrency, session))
+    print(f"Replayed in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Полнотекстовый поиск по банку вопросов (/find).
+
+Инвертированный индекс строится в памяти при загрузке банка: токен -> {номер вопроса: вес}.
+Нормализация: нижний регистр и ё -> е. Слова запроса ищутся по префиксу
+(по отсортированному словарю через bisect), совпадения всех слов обязательны,
+ранжирование — сумма idf-весов, точное совпадение слова весит больше префиксного,
+слова из текста вопроса — больше, чем из вариантов ответа.
+"""
+import re
+from bisect import bisect_left
+from math import log
+
+TOKEN_RE = re.compile(r"\w+")
+
+QUESTION_WEIGHT = 1.0
+OPTION_WEIGHT = 0.3
+PREFIX_PENALTY = 0.7
+MIN_PREFIX = 2  # более короткие слова ищутся только точно
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(normalize(text or ""))
+
+
+class SearchIndex:
+    def __init__(self, questions):
+        self.questions = questions
+        postings = {}
+        for doc_id, q in enumerate(questions):
+            weights = {}
+            for token in tokenize(q["question"]):
+                weights[token] = max(weights.get(token, 0.0), QUESTION_WEIGHT)
+            for option in q["options"]:
+                for token in tokenize(option):
+                    weights[token] = max(weights.get(token, 0.0), OPTION_WEIGHT)
+            for token, weight in weights.items():
+                postings.setdefault(token, {})[doc_id] = weight
+
+        n = max(len(questions), 1)
+        self.idf = {token: log(1 + n / len(docs)) for token, docs in postings.items()}
+        self.postings = postings
+        self.vocab = sorted(postings)
+
+    def _expand(self, term: str):
+        if len(term) < MIN_PREFIX:
+            if term in self.postings:
+                yield term
+            return
+        i = bisect_left(self.vocab, term)
+        while i < len(self.vocab) and self.vocab[i].startswith(term):
+            yield self.vocab[i]
+            i += 1
+
+    def search(self, query: str, limit: int = 50) -> list[dict]:
+        """Вопросы, содержащие все слова запроса (по префиксу), от лучших к худшим."""
+        scores = None
+        for term in dict.fromkeys(tokenize(query)):
+            term_scores = {}
+            for token in self._expand(term):
+                boost = self.idf[token] * (1.0 if token == term else PREFIX_PENALTY)
+                for doc_id, weight in self.postings[token].items():
+                    score = boost * weight
+                    if score > term_scores.get(doc_id, 0.0):
+                        term_scores[doc_id] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc_id: s + term_scores[doc_id] for doc_id, s in scores.items() if doc_id in term_scores}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))[:limit]
+        return [self.questions[doc_id] for doc_id in ranked]
@@ -3,12 +3,43 @@ set -euo pipefail
 
 BASE_DIR="$(cd -- "$(dirname -- "${BASH_SOURCE[0]}")" && pwd -P)"
 PID_FILE="$BASE_DIR/bot.pid"
+# Коды выхода: 0 — работает и готов, 1 — PID-файл без процесса, 2 — процесс есть, но не готов
+# или не отвечает на /readyz, 3 — не работает
+HEALTH_URL="http://127.0.0.1:${HEALTH_PORT:-8080}/readyz"
+
+if [[ -x "$BASE_DIR/.venv/bin/python" ]]; then
+  PYTHON="$BASE_DIR/.venv/bin/python"
+else
+  PYTHON="$(command -v python3 || command -v python)"
+fi
+
+# Готовность по /readyz (health.py): банк, БД, задержка цикла событий, время старта
+check_ready() {
+  "$PYTHON" - "$HEALTH_URL" <<'PY'
+import json, sys, urllib.error, urllib.request
+
+try:
+    with urllib.request.urlopen(sys.argv[1], timeout=3) as resp:
+        data = json.load(resp)
+except urllib.error.HTTPError as e:
+    data = json.load(e)
+except (OSError, ValueError) as e:
+    print(f"   ⚠️ {sys.argv[1]} не отвечает: {e}")
+    sys.exit(2)
+
+print(f"   {'🟢 готов' if data['ready'] else '🟡 запускается'}, работает {data['uptime']} с")
+print(f"   банк: {data['bank']} вопросов, БД: {data['db']}, задержка цикла событий: {data['loop_lag_ms']} мс")
+if data["startup_ms"]:
+    print("   старт: " + ", ".join(f"{name} {ms:.0f} мс" for name, ms in data["startup_ms"].items()))
+sys.exit(0 if data["ready"] and data["bank"] else 2)
+PY
+}
 
 if [[ -f "$PID_FILE" ]]; then
   PID="$(cat "$PID_FILE")"
   if kill -0 "$PID" 2>/dev/null; then
     echo "✅ Бот запущен (PID $PID)"
-    exit 0
+    check_ready
   else
     echo "⚠️ PID-файл есть, но процесса нет. Удалите $PID_FILE при необходимости."
     exit 1
@@ -17,9 +48,9 @@ else
 
   if pgrep -f "[p]ython.*bot.py" >/dev/null 2>&1; then
     echo "✅ Бот запущен (найден по имени процесса), но нет bot.pid"
-    exit 0
+    check_ready
+    exit $?
   fi
   echo "❌ Бот не работает"
   exit 3
 fi
-
@@ -9,7 +9,9 @@ stop_pid() {
   if kill -0 "$pid" 2>/dev/null; then
     kill "$pid" 2>/dev/null || true
 
-    for _ in {1..20}; do
+    # Бот дообрабатывает текущие апдейты и сохраняет сессии — даём ему до 45 секунд
+    # (в многопроцессном режиме супервизор ждёт воркеров до 35 секунд)
+    for _ in {1..90}; do
       if kill -0 "$pid" 2>/dev/null; then
         sleep 0.5
       else
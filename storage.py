@@ -0,0 +1,16 @@
+"""
+Выбор хранилища: Postgres (database.py, по умолчанию) или встроенный SQLite
+(database_sqlite.py, DB_BACKEND=sqlite) для одиночных установок и локальных замеров.
+
+Оба модуля реализуют один и тот же набор функций (__all__), плюс Error — базовый класс
+ошибок драйвера и CONNECTION_ERRORS — ошибки недоступности БД. Остальной код
+импортирует всё отсюда.
+"""
+import config
+
+if config.DB_BACKEND == "sqlite":
+    from database_sqlite import *  # noqa: F401,F403
+elif config.DB_BACKEND == "postgres":
+    from database import *  # noqa: F401,F403
+else:
+    raise ValueError(f"Unknown DB_BACKEND: {config.DB_BACKEND!r} (expected postgres or sqlite)")
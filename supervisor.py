@@ -0,0 +1,259 @@
+"""
+Многопроцессный режим: один приёмник апдейтов и N процессов-воркеров.
+
+Приёмник забирает апдейты через getUpdates (сырой JSON, без разбора в модели aiogram)
+и раскладывает их по воркерам консистентным хешем от пользователя (в группах — от чата),
+поэтому всё in-memory состояние пользователя живёт в одном процессе.
+Банк вопросов по умолчанию загружается из БД один раз и передаётся воркерам аргументом
+при запуске (у каждого воркера своя копия в памяти), остальные банки каждый воркер
+загружает сам при первом обращении (banks.py).
+
+Супервизор следит за воркерами: упавший воркер перезапускается с новой очередью,
+в неё переносятся апдейты, которые он не успел забрать.
+
+Включается переменной окружения WORKERS > 1 (см. bot.main).
+"""
+import asyncio
+import importlib
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import sys
+import time
+from contextlib import suppress
+
+import aiohttp
+
+API_URL = "https://api.telegram.org/bot{token}/{method}"
+POLL_TIMEOUT = 30
+# Воркер дообрабатывает апдейты до DRAIN_TIMEOUT (20 с, bot.py), затем дописывает данные
+# и сохраняет контрольную точку — ждём его с запасом, потом убиваем
+STOP_TIMEOUT = 35
+WATCH_INTERVAL = 1
+
+log = logging.getLogger("supervisor")
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach): при смене числа воркеров переезжает минимум ключей."""
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+GROUP_COMMANDS = ("/quiz", "/quiz_stop")  # команды групповой викторины (bot.group_quiz_handler и др.)
+
+
+def _group_scoped(event: dict) -> bool:
+    """Апдейт групповой викторины: её состояние живёт в воркере чата."""
+    if "data" in event:
+        return (event["data"] or "").startswith("gq_")
+    words = (event.get("text") or "").split(maxsplit=1)
+    return bool(words) and words[0].split("@", 1)[0] in GROUP_COMMANDS
+
+
+def route_key(update: dict) -> int:
+    """
+    Ключ шардирования: id чата для групповой викторины, иначе id пользователя.
+    Остальные команды в группах (/stats, /bank, /exam...) работают с личной сессией
+    автора и идут в его воркер. Ответы на викторину обрабатывает воркер группы: личные
+    сессии и кэши участников он не трогает (bot.owns_user), только общие данные — логи,
+    user_totals, рейтинг и сложность вопросов.
+    """
+    for kind, event in update.items():
+        if kind == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat") or {}
+        if chat.get("type") in ("group", "supergroup") and _group_scoped(event):
+            return chat["id"]
+        user = event.get("from")
+        if user:
+            return user["id"]
+        if chat:
+            return chat["id"]
+    return update["update_id"]
+
+
+# ======= Воркер =======
+
+def _import_app(app_name: str):
+    # При spawn модуль точки входа (python bot.py) уже импортирован в воркере как __mp_main__ —
+    # повторный импорт по имени создал бы второй Bot и Dispatcher
+    main = sys.modules.get("__mp_main__")
+    main_file = getattr(main, "__file__", None) or ""
+    if os.path.splitext(os.path.basename(main_file))[0] == app_name:
+        sys.modules[app_name] = main
+        return main
+    return importlib.import_module(app_name)
+
+
+def worker_main(index: int, app_name: str, updates, questions, restore: bool = True):
+    # WORKER_INDEX выставляет родитель до запуска процесса (см. _start_worker): config
+    # читается ещё при импорте точки входа, до вызова этой функции
+    # Остановкой воркеров управляет супервизор (None в очереди), сигналы группе процессов
+    # (Ctrl+C, timeout, kill группы) не должны обрывать их до сохранения контрольной точки
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # SIGUSR1 (профиль) обрабатывает бот после старта; до этого пересланный сигнал убил бы воркер
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [worker {index}] %(name)s: %(message)s")
+    app = _import_app(app_name)
+    app.set_question_bank(questions)
+    app.restore_checkpoint = restore
+    asyncio.run(_worker_loop(app, updates))
+
+
+async def _worker_loop(app, updates):
+    from aiogram import types
+
+    loop = asyncio.get_running_loop()
+    app.dp.include_router(app.router)
+    await app.dp.emit_startup(bot=app.bot, dispatcher=app.dp, bots=[app.bot])
+
+    tasks = set()
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            update = types.Update.model_validate(raw, context={"bot": app.bot})
+            task = asyncio.create_task(app.dp.feed_update(app.bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # Уже созданные задачи доходят до session_middleware и попадают в счётчик inflight —
+        # дообработку ждёт on_shutdown (drain_inflight)
+        await asyncio.sleep(0)
+    finally:
+        await app.dp.emit_shutdown(bot=app.bot, dispatcher=app.dp, bots=[app.bot])
+        await app.bot.session.close()
+
+
+# ======= Приёмник =======
+
+async def _get_updates(session, url, params):
+    async with session.post(url, json=params, timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)) as resp:
+        return await resp.json()
+
+
+async def _receive(token: str, queues):
+    url = API_URL.format(token=token, method="getUpdates")
+    offset = None
+    async with aiohttp.ClientSession() as session:
+        while True:
+            params = {"timeout": POLL_TIMEOUT}
+            if offset is not None:
+                params["offset"] = offset
+            try:
+                payload = await _get_updates(session, url, params)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.warning("getUpdates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            if not payload.get("ok"):
+                log.warning("getUpdates error: %s", payload.get("description"))
+                await asyncio.sleep(payload.get("parameters", {}).get("retry_after", 1))
+                continue
+
+            # Раздача без await: отмена приёмника не может прервать пачку на середине
+            for update in payload["result"]:
+                offset = update["update_id"] + 1
+                queues[jump_hash(route_key(update), len(queues))].put(update)
+
+
+def _start_worker(ctx, index: int, app_name: str, updates, questions, restore: bool = True):
+    proc = ctx.Process(
+        target=worker_main, args=(index, app_name, updates, questions, restore), name=f"worker-{index}"
+    )
+    # Дочерний процесс наследует окружение на момент start()
+    previous = os.environ.get("WORKER_INDEX")
+    os.environ["WORKER_INDEX"] = str(index)
+    try:
+        proc.start()
+    finally:
+        if previous is None:
+            os.environ.pop("WORKER_INDEX", None)
+        else:
+            os.environ["WORKER_INDEX"] = previous
+    return proc
+
+
+def _move_updates(old, new) -> int:
+    """Переносит необработанные апдейты упавшего воркера в очередь его замены."""
+    moved = 0
+    while True:
+        try:
+            # Без блокировки: если воркер умер внутри get() и держит блокировку чтения,
+            # остаток очереди не достать — он теряется
+            raw = old.get_nowait()
+        except (queue.Empty, OSError, EOFError):
+            return moved
+        if raw is not None:
+            new.put(raw)
+            moved += 1
+
+
+async def _watch(ctx, procs, queues, app_name, questions):
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        for i, proc in enumerate(procs):
+            if proc.exitcode is None:
+                continue
+            # Новая очередь: у старой блокировка чтения может остаться за мёртвым процессом
+            old, queues[i] = queues[i], ctx.Queue()
+            moved = _move_updates(old, queues[i])
+            # Контрольную точку остановки замена не восстанавливает: упавший воркер уже
+            # обслуживал этих пользователей после неё
+            procs[i] = _start_worker(ctx, i, app_name, queues[i], questions, restore=False)
+            log.warning("Worker %d exited with code %s, restarted (%d queued updates moved)", i, proc.exitcode, moved)
+
+
+def _forward_signal(sig, procs) -> None:
+    for proc in procs:
+        if proc.exitcode is None and proc.pid is not None:
+            with suppress(ProcessLookupError):
+                os.kill(proc.pid, sig)
+
+
+def run(app_name: str, workers: int, questions, token: str):
+    """Запуск супервизора: вызывается из main() бота, когда WORKERS > 1."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [supervisor] %(name)s: %(message)s")
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    procs = [_start_worker(ctx, i, app_name, queues[i], questions) for i in range(workers)]
+    log.info("Started %d workers, bank: %d questions", workers, len(questions))
+
+    async def _main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        # kill -USR1 <pid супервизора> — профиль во всех воркерах, каждый пишет свой файл
+        loop.add_signal_handler(signal.SIGUSR1, _forward_signal, signal.SIGUSR1, procs)
+        receiver = asyncio.create_task(_receive(token, queues))
+        watcher = asyncio.create_task(_watch(ctx, procs, queues, app_name, questions))
+        await stop.wait()
+        watcher.cancel()
+        receiver.cancel()
+        with suppress(asyncio.CancelledError):
+            await receiver
+
+    try:
+        asyncio.run(_main())
+    finally:
+        for q in queues:
+            q.put(None)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for p in procs:
+            p.join(max(deadline - time.monotonic(), 0))
+            if p.is_alive():
+                log.warning("Worker %s did not stop in %d s, killing", p.name, STOP_TIMEOUT)
+                p.kill()
+                p.join()
+        log.info("Workers stopped")